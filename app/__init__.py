@@ -1,19 +1,108 @@
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from flask_mail import Mail
+from app.services.ratelimit import RateLimiter
+from app.services.compression import Compress
+from app.assets import Assets
+from app.services.metrics import metrics
+from app.services.tracing import tracer
+from app.services.profiling import profiler
 
 # create database object globally to be used in models and routes across the app
 db = SQLAlchemy()
 mail = Mail()
+limiter = RateLimiter()
+assets = Assets()
+compress = Compress()
+
+# Every SQLite connection: WAL lets readers work while a writer commits (several pre-forked workers share
+# todo.db), and busy_timeout makes a blocked writer wait for the lock instead of failing immediately.
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__.startswith("sqlite3"):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
 
 def create_app():
     app = Flask(__name__)       # create Flask app instance
 
     # --- Basic Flask Configuration ---
     app.config['SECRET_KEY'] = 'your-secret-key'      # Secret key is used for securely signing the session cookie and other data
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///todo.db'  # Database URI for SQLite database named 'todo.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///todo.db')  # Database URI for SQLite database named 'todo.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False    # Disables event notifications from SQLAlchemy (saves resources)
 
+    # --- Password Hashing ---
+    # Werkzeug method string (algorithm + cost). Changing it upgrades each user's hash on their next login.
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1)))  # 0 = hash on the request thread
+    app.config['PASSWORD_HASH_QUEUE_FACTOR'] = 4     # Hashing jobs allowed in flight per worker process
+    app.config['PASSWORD_HASH_TIMEOUT'] = 10         # Seconds to wait for a queue slot or a hash result
+
+    # --- Rate Limiting (write requests only; keys are an endpoint or a whole blueprint) ---
+    app.config['RATELIMITS'] = {
+        'auth.login': '10/minute',
+        'auth.register': '5/minute',
+        'auth.forgot_password': '5/hour',     # sends real mail and writes a reset token
+        'auth.reset_password': '10/hour',
+        'trips.upload_expense_attachment': '20/minute',
+        'trips': '60/minute',
+    }
+    app.config['RATELIMIT_STORAGE_URL'] = os.environ.get('RATELIMIT_STORAGE_URL')   # e.g. redis://localhost:6379/0; unset = in-process buckets
+    app.config['RATELIMIT_MAX_WRITE_WAIT'] = 1.0     # Seconds writes have recently waited on SQLite's lock before answering 503
+
+    # --- Response Compression ---
+    app.config['COMPRESS_LEVEL'] = 6             # gzip level 1 (fastest) to 9 (smallest)
+    app.config['COMPRESS_MIN_SIZE'] = 1024       # Bytes; smaller responses are sent as they are
+
+    # Compiled templates are cached on disk, so a fresh worker does not re-compile every template
+    jinja_cache_dir = os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(jinja_cache_dir, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(jinja_cache_dir)}
+
+    # --- Trip Sharding ---
+    # Trips and their rows spread over TRIP_SHARDS extra SQLite files (0 = everything in todo.db).
+    # Users, auth and other global tables stay in todo.db. Move trips between shards with `flask rebalance-shards`.
+    from app.services.shards import router as shard_router
+    app.config['TRIP_SHARDS'] = int(os.environ.get('TRIP_SHARDS', 0))
+    app.config['TRIP_SHARD_URI'] = os.environ.get('TRIP_SHARD_URI', 'sqlite:///trips_{shard}.db')
+    shard_router.init_app(app)      # before db.init_app(): adds one SQLALCHEMY_BINDS entry per shard
+
+    # --- Metrics (Prometheus text format at /metrics) ---
+    # Pre-forked workers each count on their own; give them a shared directory to merge their numbers.
+    app.config['METRICS_MULTIPROCESS_DIR'] = os.environ.get('METRICS_MULTIPROCESS_DIR')
+    app.config['METRICS_FLUSH_INTERVAL'] = 5            # Seconds between a worker's snapshots
+    app.config['METRICS_LOCK_WAIT_THRESHOLD'] = 0.1     # A write slower than this counts as a lock wait
+    # /metrics lists every endpoint and its traffic: scrapes send "Authorization: Bearer <METRICS_TOKEN>".
+    # Without a token it is a 404 outside debug mode, unless METRICS_PUBLIC=1 opts in to serving it to anyone
+    # who can reach the app (only for a port that is not exposed publicly).
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['METRICS_PUBLIC'] = os.environ.get('METRICS_PUBLIC') == '1'
+    metrics.init_app(app)
+
+    # --- Request Tracing (slowest recent traces at /admin/traces) ---
+    app.config['TRACE_SAMPLE_RATE'] = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))   # Share of requests traced
+    app.config['TRACE_TRUST_TRACEPARENT'] = os.environ.get('TRACE_TRUST_TRACEPARENT') == '1'   # Only behind a proxy that strips the header from clients
+    app.config['TRACE_FILE'] = os.environ.get('TRACE_FILE')       # OTLP/JSON lines, e.g. instance/traces.jsonl; unset = memory only
+    app.config['TRACE_FILE_MAX_BYTES'] = 50 * 1024 * 1024        # Rotated to <file>.1 beyond this
+    app.config['TRACE_OTLP_ENDPOINT'] = os.environ.get('TRACE_OTLP_ENDPOINT')    # e.g. http://localhost:4318/v1/traces
+    app.config['TRACE_KEEP'] = 100             # Recent traces kept per worker when there is no trace file
+    tracer.init_app(app)
+
+    # --- On-demand profiling (/admin/profile); idle until an admin starts a profile ---
+    app.config['PROFILE_MAX_SECONDS'] = 30      # Longest CPU sampling window
+    app.config['TRACEMALLOC_MAX_SECONDS'] = 600    # Memory tracing stops by itself after this
+    profiler.init_app(app)
+
+    # Accounts allowed on the /admin pages (comma-separated emails)
+    app.config['ADMIN_EMAILS'] = {email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()}
+
     # connect app to db
     db.init_app(app)
 
@@ -23,6 +112,9 @@ def create_app():
     from app.static.about import main_bp
     from app.static.home import view_bp
     from app.routes.trips import trips_bp
+    from app.routes.calendar import calendar_bp
+    from app.routes.sync import sync_bp
+    from app.routes.admin import admin_bp
 
     # Register blueprints for modular route management
     app.register_blueprint(auth_bp)
@@ -30,6 +122,13 @@ def create_app():
     app.register_blueprint(view_bp)
     app.register_blueprint(main_bp)
     app.register_blueprint(trips_bp)
+    app.register_blueprint(calendar_bp)
+    app.register_blueprint(sync_bp)
+    app.register_blueprint(admin_bp)
+
+    # Register maintenance CLI commands
+    from app.commands import register_commands
+    register_commands(app)
 
     app.config.update(
         MAIL_SERVER='smtp.gmail.com',
@@ -40,5 +139,31 @@ def create_app():
         MAIL_PASSWORD='hhvd rhwm kbvf fmsa'
     )
     mail.init_app(app)
+    limiter.init_app(app)
+    assets.init_app(app)     # fingerprinted, precompressed static files (built with `flask build-assets`)
+    compress.init_app(app)
+
+    # Change log for offline sync (/sync); live updates are fed from the same captured changes
+    from app.services.changes import change_feed
+    change_feed.init_app(app)
+
+    # Trending destinations: decayed counters kept in memory, merged into the database periodically
+    from app.services.trending import trending
+    app.config['TRENDING_CHECKPOINT_INTERVAL'] = 60     # Seconds between checkpoints per worker
+    trending.init_app(app)
+
+    # Live trip updates (Server-Sent Events); set EVENTS_BROKER_URL (redis://...) when running several workers
+    from app.services.events import live_updates
+    app.config['EVENTS_BROKER_URL'] = os.environ.get('EVENTS_BROKER_URL')
+    # Every open stream holds a worker thread (gunicorn.conf.py threads): keep half of them for normal requests
+    app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', max(1, int(os.environ.get('WEB_THREADS', 4)) // 2)))
+    app.config['EVENTS_MAX_STREAM_SECONDS'] = 300   # Streams are closed after this; browsers reconnect
+    live_updates.init_app(app)
+
+    # Expense receipts: content-addressed files under instance/attachments, thumbnailed in a process pool
+    from app.services.attachments import attachments
+    app.config['ATTACHMENT_MAX_SIZE'] = int(os.environ.get('ATTACHMENT_MAX_SIZE', 10 * 1024 * 1024))   # Bytes per file
+    app.config['ATTACHMENT_THUMBNAIL_WORKERS'] = int(os.environ.get('ATTACHMENT_THUMBNAIL_WORKERS', 1))    # 0 = on the request thread
+    attachments.init_app(app)
 
     return app
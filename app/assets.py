@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from io import BytesIO
+from flask import request, send_from_directory, url_for
+
+try:        # optional: brotli copies are skipped when the package is missing
+    import brotli
+except ImportError:
+    brotli = None
+
+try:        # optional: resized/WebP image variants are skipped when Pillow is missing
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Build output lives in static/dist/. Files there carry a content hash in their name, so they never change
+# and browsers may cache them forever; manifest.json maps each source file to its fingerprinted copy.
+DIST_DIR = "dist"
+MANIFEST_NAME = "manifest.json"
+CACHE_FOREVER = 31536000        # one year, the conventional "immutable" max-age
+
+SOURCE_EXTENSIONS = {".css", ".js", ".png", ".jpg", ".jpeg", ".svg", ".ico"}
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".json"}
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+IMAGE_VARIANT_WIDTHS = (160, 320, 640, 1280)
+
+#==========================================================================================================
+# BUILD
+#==========================================================================================================
+
+def build(static_folder):
+    """Minify, fingerprint and precompress every static asset; returns the manifest"""
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {"files": {}, "variants": {}}
+
+    sources = sorted(_iter_sources(static_folder), key=lambda path: path.endswith(".css"))  # images before CSS
+    for relative in sources:
+        with open(os.path.join(static_folder, relative), "rb") as fh:
+            content = fh.read()
+
+        extension = os.path.splitext(relative)[1].lower()
+        if extension == ".css":
+            content = minify_css(content.decode("utf-8"), relative, manifest["files"]).encode("utf-8")
+
+        manifest["files"][relative] = _write_fingerprinted(dist, relative, content)
+
+        if extension in IMAGE_EXTENSIONS and Image is not None:
+            manifest["variants"][relative] = _write_image_variants(dist, static_folder, relative)
+
+    with open(os.path.join(dist, MANIFEST_NAME), "w") as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    return manifest
+
+
+def _iter_sources(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != os.path.join(static_folder, DIST_DIR)]
+        for name in files:
+            if os.path.splitext(name)[1].lower() in SOURCE_EXTENSIONS:
+                yield os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, "/")
+
+
+def _write_fingerprinted(dist, relative, content):
+    """Write content under a hashed name (plus .gz/.br copies) and return its path relative to static/"""
+    stem, extension = os.path.splitext(relative)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    target = f"{DIST_DIR}/{stem}.{digest}{extension}"
+
+    path = os.path.join(os.path.dirname(dist), target)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(content)
+
+    if extension.lower() in COMPRESSIBLE_EXTENSIONS:
+        with open(path + ".gz", "wb") as fh:
+            fh.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + ".br", "wb") as fh:
+                fh.write(brotli.compress(content, quality=11))
+    return target
+
+
+def _write_image_variants(dist, static_folder, relative):
+    """Resized copies (original format and WebP) for srcset; returns {format: [(width, path), ...]}"""
+    variants = {}
+    with Image.open(os.path.join(static_folder, relative)) as original:
+        stem, extension = os.path.splitext(relative)
+        widths = [w for w in IMAGE_VARIANT_WIDTHS if w < original.width] + [original.width]
+        for width in widths:
+            height = round(original.height * width / original.width)
+            resized = original.resize((width, height), Image.LANCZOS) if width != original.width else original
+            for fmt, ext, options in (("webp", ".webp", {"quality": 82, "method": 6}),
+                                      (extension.lstrip(".").lower(), extension, {"optimize": True})):
+                buffer = BytesIO()
+                resized.save(buffer, format="WEBP" if fmt == "webp" else original.format, **options)
+                target = _write_fingerprinted(dist, f"{stem}-{width}w{ext}", buffer.getvalue())
+                variants.setdefault(fmt, []).append((width, target))
+    return variants
+
+#==========================================================================================================
+
+_CSS_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+_CSS_STRING = re.compile(r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')")
+_CSS_URL = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+
+def minify_css(css, relative=None, fingerprinted=None):
+    """Strip comments and whitespace; local url() references are pointed at their fingerprinted copies"""
+    css = _CSS_COMMENT.sub("", css)
+
+    # Minify only outside string literals, so content: "a  b" and quoted URLs survive untouched
+    parts = _CSS_STRING.split(css)
+    for i in range(0, len(parts), 2):
+        chunk = re.sub(r"\s+", " ", parts[i])
+        chunk = re.sub(r"\s*([{};,>])\s*", r"\1", chunk)
+        chunk = re.sub(r":\s+", ":", chunk)    # "a:hover" selectors never contain a space after the colon
+        parts[i] = chunk.replace(";}", "}")
+    css = "".join(parts).strip()
+
+    if relative and fingerprinted:
+        css_dir = os.path.dirname(relative)
+        output_dir = os.path.dirname(f"{DIST_DIR}/{relative}")
+
+        def rewrite(match):
+            url = match.group(2)
+            if re.match(r"^(?:[a-z]+:|/|#)", url):
+                return match.group(0)
+            source = os.path.normpath(os.path.join(css_dir, url)).replace(os.sep, "/")
+            if source not in fingerprinted:
+                return match.group(0)
+            target = os.path.relpath(fingerprinted[source], output_dir)
+            return f"url({target.replace(os.sep, '/')})"
+
+        css = _CSS_URL.sub(rewrite, css)
+    return css
+
+#==========================================================================================================
+# RUNTIME
+#==========================================================================================================
+
+class Assets:
+    """Serve the built assets: url_for('static') resolves to fingerprinted files, sent precompressed"""
+
+    def __init__(self, app=None):
+        self.files = {}
+        self.variants = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.load_manifest()
+
+        app.url_defaults(self._fingerprint_url)
+        app.view_functions["static"] = self._send_static
+        app.jinja_env.globals["image_srcset"] = self.image_srcset
+        app.extensions["assets"] = self
+
+    def load_manifest(self):
+        """Read the manifest written by `flask build-assets`; without one, files are served as they are"""
+        path = os.path.join(self.static_folder, DIST_DIR, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path) as fh:
+                manifest = json.load(fh)
+            self.files, self.variants = manifest["files"], manifest["variants"]
+        else:
+            self.files, self.variants = {}, {}
+
+    def image_srcset(self, filename, fmt=None):
+        """srcset value listing the resized variants of an image ('' when none were built)"""
+        variants = self.variants.get(filename, {})
+        fmt = fmt or os.path.splitext(filename)[1].lstrip(".").lower()
+        return ", ".join(f"{url_for('static', filename=path)} {width}w" for width, path in variants.get(fmt, []))
+
+    def _fingerprint_url(self, endpoint, values):
+        if endpoint == "static" and values.get("filename") in self.files:
+            values["filename"] = self.files[values["filename"]]
+
+    def _send_static(self, filename):
+        if not filename.startswith(DIST_DIR + "/"):
+            return send_from_directory(self.static_folder, filename)
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        accepted = request.accept_encodings
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if accepted[encoding] and os.path.exists(os.path.join(self.static_folder, filename + suffix)):
+                response = send_from_directory(self.static_folder, filename + suffix, mimetype=mimetype,
+                                               max_age=CACHE_FOREVER)
+                response.headers["Content-Encoding"] = encoding
+                break
+        else:
+            response = send_from_directory(self.static_folder, filename, mimetype=mimetype, max_age=CACHE_FOREVER)
+
+        response.headers["Cache-Control"] = f"public, max-age={CACHE_FOREVER}, immutable"
+        response.vary.add("Accept-Encoding")
+        return response
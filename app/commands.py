@@ -0,0 +1,134 @@
+import click
+import csv
+import os
+from datetime import datetime, timedelta
+from flask import current_app
+from app import assets
+from app.assets import build
+from app.services import recommendations, geo, archive, shards, tracing
+from app.services.destinations import backfill_catalogue
+from app.services.trending import trending
+from app.models import PasswordResetToken, ChangeLog, FavoriteDestination, ItineraryItem, ChecklistTemplate
+from app.models import ExpenseAttachment
+from app.services.attachments import attachments
+
+CHECKLIST_TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), "data", "checklist_templates.csv")
+
+#==========================================================================================================
+
+# Maintenance commands, run with `flask --app run <command>`
+def register_commands(app):
+
+    @app.cli.command("purge-reset-tokens")
+    @click.option("--batch-size", default=500, show_default=True, help="Rows deleted per transaction.")
+    def purge_reset_tokens(batch_size):
+        """Delete used and expired password reset tokens."""
+        purged = PasswordResetToken.purge_expired(batch_size=batch_size)
+        click.echo(f"Purged {purged} password reset tokens.")
+
+    @app.cli.command("prune-change-log")
+    @click.option("--days", default=90, show_default=True, help="Keep entries newer than this.")
+    @click.option("--batch-size", default=500, show_default=True, help="Rows deleted per transaction.")
+    def prune_change_log(days, batch_size):
+        """Delete old sync change log entries; clients older than that fetch a full snapshot."""
+        pruned = ChangeLog.prune(datetime.utcnow() - timedelta(days=days), batch_size=batch_size)
+        click.echo(f"Pruned {pruned} change log entries.")
+
+    @app.cli.command("rebuild-recommendations")
+    @click.option("--batch-size", default=1000, show_default=True, help="Rows inserted per statement.")
+    def rebuild_recommendations(batch_size):
+        """Recompute the destination co-occurrence matrix from every user's favorites."""
+        pairs = recommendations.rebuild(batch_size=batch_size)
+        click.echo(f"Rebuilt {pairs} destination co-occurrence pairs.")
+
+    @app.cli.command("rebuild-trending")
+    def rebuild_trending():
+        """Recompute the trending destination counters from favorite and trip history."""
+        count = trending.rebuild()
+        click.echo(f"Rebuilt trending counters for {count} destinations.")
+
+    @app.cli.command("backfill-destination-catalogue")
+    @click.option("--batch-size", default=500, show_default=True, help="Rows handled per transaction.")
+    def backfill_destination_catalogue(batch_size):
+        """Key the destination catalogue and link existing trip destinations to it (safe to re-run)."""
+        keyed, merged, linked = backfill_catalogue(batch_size=batch_size)
+        click.echo(f"Keyed {keyed} catalogue entries, merged {merged} duplicates, linked {linked} trip destinations.")
+        if merged:
+            click.echo("Destination ids changed: run `flask rebuild-recommendations` next.")
+
+    @app.cli.command("geocode")
+    @click.option("--batch-size", default=500, show_default=True, help="Rows updated per transaction.")
+    def geocode(batch_size):
+        """Fill missing coordinates from the offline gazetteer and rebuild the spatial indexes."""
+        for model in (FavoriteDestination, ItineraryItem):
+            located = geo.geocode_missing(model, batch_size=batch_size)
+            indexed = 0
+            for shard in shards.router.shards() if model is ItineraryItem else [shards.GLOBAL_SHARD]:
+                with shards.pinned(shard):
+                    indexed += geo.rebuild_spatial_index(model)
+            click.echo(f"{model.__tablename__}: located {located} rows, {indexed} in the spatial index.")
+
+    @app.cli.command("build-assets")
+    def build_assets():
+        """Minify, fingerprint and precompress static files into static/dist/."""
+        manifest = build(current_app.static_folder)
+        assets.load_manifest()
+        click.echo(f"Built {len(manifest['files'])} assets and {len(manifest['variants'])} image variant sets.")
+
+    @app.cli.command("seed-checklist-templates")
+    def seed_checklist_templates():
+        """Create the built-in checklist templates (packing list, visa steps) that do not exist yet."""
+        with open(CHECKLIST_TEMPLATES_PATH, newline="", encoding="utf-8") as fh:
+            rows = [(row["template"], row["title"], int(row["due_offset_days"]) if row["due_offset_days"] else None)
+                    for row in csv.DictReader(fh)]
+        created = ChecklistTemplate.seed_builtins(rows)
+        click.echo(f"Created {created} checklist templates.")
+
+    @app.cli.command("archive-trips")
+    @click.option("--days", default=365, show_default=True, help="Archive trips that ended more than this many days ago.")
+    @click.option("--batch-size", default=50, show_default=True, help="Trips moved per transaction.")
+    def archive_trips(days, batch_size):
+        """Move finished trips into compressed archive documents, out of the hot tables."""
+        archived = archive.archive_trips((datetime.utcnow() - timedelta(days=days)).date(), batch_size=batch_size)
+        click.echo(f"Archived {archived} trips.")
+
+    @app.cli.command("purge-attachments")
+    @click.option("--grace", default=3600, show_default=True, help="Keep files written within this many seconds.")
+    def purge_attachments(grace):
+        """Delete stored receipt files that no expense references any more."""
+        purged = attachments.purge(ExpenseAttachment.referenced_hashes(), grace_seconds=grace)
+        click.echo(f"Purged {purged} receipt files.")
+
+    @app.cli.command("rebalance-shards")
+    @click.option("--limit", type=int, default=None, help="Move at most this many trips.")
+    @click.option("--dry-run", is_flag=True, help="Only print the moves.")
+    def rebalance_shards(limit, dry_run):
+        """Even out trips across the trip shards, moving trips off the global database first."""
+        if not shards.router.enabled:
+            raise click.ClickException("Trip sharding is off (TRIP_SHARDS = 0).")
+        moves = shards.rebalance(limit=limit, dry_run=dry_run)
+        for trip_id, source, target in moves:
+            click.echo(f"trip {trip_id}: shard {source} -> {target}")
+        counts = ", ".join(f"{shard}: {count}" for shard, count in shards.trip_counts().items())
+        click.echo(f"{'Would move' if dry_run else 'Moved'} {len(moves)} trips. Trips per shard: {counts}.")
+
+    @app.cli.command("trace-report")
+    @click.argument("path", required=False)
+    @click.option("--top", default=10, show_default=True, help="Slowest traces listed.")
+    def trace_report(path, top):
+        """Summarise a trace file (TRACE_FILE by default): where the time went, and the slowest requests."""
+        path = path or current_app.config["TRACE_FILE"]
+        if not path or not os.path.exists(path):
+            raise click.ClickException(f"No trace file at {path!r}.")
+        documents = tracing.read_trace_file(path)
+        click.echo(f"{len(documents)} traces in {path}\n")
+        click.echo(f"{'self ms':>10} {'total ms':>10} {'calls':>7}  span")
+        for name, calls, total_ms, self_ms in tracing.self_time_by_name(documents)[:25]:
+            click.echo(f"{self_ms:10.1f} {total_ms:10.1f} {calls:7}  {name}")
+
+        charts = sorted((tracing.flame(document) for document in documents), key=lambda chart: chart[0], reverse=True)
+        for total_ms, rows in charts[:top]:
+            click.echo(f"\n{total_ms:.1f} ms  {rows[0][0]['name']}")
+            for span, depth, _, _, ms in rows:
+                label = " ".join(span["attributes"].get("db.statement", "").split())[:80]
+                click.echo(f"  {ms:9.2f}  {'  ' * depth}{span['name']} {label}".rstrip())
@@ -1,11 +1,63 @@
 from app import db
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask import session
 from datetime import datetime, timedelta
 import secrets
+import hashlib
+import time
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
 from flask_mail import Message
 from flask import current_app
 from app import mail
+from app.services import timeline, passwords, recommendations, geo, pagination, shards, search, archive
+from app.services.trending import trending
+from app.services.metrics import metrics
+from app.services.tracing import traced
+from app.services.destinations import destination_key
+
+#==========================================================================================================
+# OPTIMISTIC CONCURRENCY
+#==========================================================================================================
+
+# Trip, Budget, ItineraryItem and Expense carry a version column (SQLAlchemy version_id_col). Every UPDATE
+# is "... WHERE id = ? AND version = ?" and bumps the version, so a write based on a stale read matches no
+# row and fails instead of silently overwriting a participant's change. Nothing is locked while users edit.
+
+class EditConflict(Exception):
+    """Someone else saved the row first; `current` is the row as it is now stored"""
+
+    def __init__(self, current):
+        super().__init__(f"{type(current).__name__} {current.id} was changed by someone else")
+        self.current = current
+
+
+def _check_version(obj, expected):
+    """Reject an edit made on an older version than the stored one (the version the form was rendered with)"""
+    if expected is not None and expected != obj.version:
+        raise EditConflict(obj)
+
+
+def _commit_or_conflict(obj):
+    """Commit; losing a race against a concurrent commit becomes an EditConflict carrying the fresh state"""
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        db.session.refresh(obj)
+        raise EditConflict(obj)
+
+
+def _retry_on_conflict(operation, attempts=3):
+    """Run a read-modify-write (e.g. adding to a budget total) again on fresh state when a concurrent commit
+    wins; the rollback expires every loaded object, so the next attempt re-reads them"""
+    for attempt in range(attempts):
+        try:
+            return operation()
+        except StaleDataError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
 
 #==========================================================================================================
 
@@ -36,25 +88,66 @@ user_favorite_destinations = db.Table(
 class PasswordResetToken(db.Model):
     __tablename__ = "password_reset_tokens"
 
+    PURGE_INTERVAL = timedelta(minutes=10)     # how often issuing a token also purges dead rows
+    _last_purge = None
+
     id = db.Column(db.Integer, primary_key=True)
-    token = db.Column(db.String(100), unique=True, nullable=False)
+    # Only the SHA-256 of the token is stored (fixed length, unique index); the raw token exists only in the email
+    token_hash = db.Column("token", db.String(64), unique=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=False)
     used = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index("ix_password_reset_tokens_user_used", "user_id", "used"),
+        db.Index("ix_password_reset_tokens_expires_at", "expires_at"),
+    )
+
     # Relationship to user
     user = db.relationship("User", backref=db.backref("reset_tokens", lazy=True))
 
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
     @classmethod
     def generate_token(cls, user, expires_in=3600):
         token = secrets.token_urlsafe(32)
         expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
-        reset_token = cls(token=token, user=user, expires_at=expires_at)
+
+        # Only the newest link works: retire the user's outstanding tokens in one UPDATE
+        cls.query.filter_by(user_id=user.id, used=False).update({"used": True}, synchronize_session=False)
+
+        reset_token = cls(token_hash=cls.hash_token(token), user=user, expires_at=expires_at)
         db.session.add(reset_token)
         db.session.commit()
+
+        now = datetime.utcnow()
+        if cls._last_purge is None or now - cls._last_purge > cls.PURGE_INTERVAL:
+            cls._last_purge = now
+            cls.purge_expired()
         return token
 
+    @classmethod
+    def find(cls, token):
+        """Look up a raw token by its hash (a single unique-index probe)"""
+        return cls.query.filter_by(token_hash=cls.hash_token(token)).first()
+
+    @classmethod
+    def purge_expired(cls, batch_size=500):
+        """Delete used and expired tokens in small batches, so the writer lock is never held for long"""
+        purged = 0
+        while True:
+            batch = db.session.query(cls.id).filter(
+                db.or_(cls.used.is_(True), cls.expires_at < datetime.utcnow())
+            ).limit(batch_size).subquery()
+            deleted = cls.query.filter(cls.id.in_(db.select(batch.c.id))).delete(synchronize_session=False)
+            db.session.commit()
+            purged += deleted
+            if deleted < batch_size:
+                return purged
+
     def is_valid(self):
         return not self.used and datetime.utcnow() < self.expires_at
 
@@ -66,13 +159,20 @@ class PasswordResetToken(db.Model):
         if not self.is_valid():
             raise ValueError("Token is invalid or expired.")
 
-        self.user.password = generate_password_hash(new_password)
+        self.user.password = passwords.hash_password(new_password)
         self.mark_as_used()
         db.session.commit()
 
     def send_email(to_email, subject, body):
         msg = Message(subject=subject, recipients=[to_email], body=body, sender=current_app.config['MAIL_USERNAME'])
-        mail.send(msg)
+        start = time.perf_counter()
+        try:
+            mail.send(msg)
+        except Exception:
+            metrics.inc("mail_sent_total", result="error")
+            raise
+        metrics.inc("mail_sent_total", result="sent")
+        metrics.observe("mail_send_duration_seconds", time.perf_counter() - start)
 
 #==========================================================================================================
 
@@ -83,9 +183,14 @@ class User(db.Model):
     username = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
+    calendar_token = db.Column(db.String(64), nullable=True)     # Secret part of the user's calendar feed URL
+
+    __table_args__ = (db.Index("ix_user_calendar_token", "calendar_token", unique=True),)
 
     # Relationships
-    shared_expenses = db.relationship("Expense", secondary=expense_shared, backref="users_shared")
+    # Read-only mirror of Expense.shared_users: two writable relationships over one table delete its rows twice
+    shared_expenses = db.relationship("Expense", secondary=expense_shared, viewonly=True,
+                                      backref=db.backref("users_shared", viewonly=True))
     favorite_destinations = db.relationship(
         "FavoriteDestination", 
         secondary=user_favorite_destinations, 
@@ -95,20 +200,26 @@ class User(db.Model):
 
     # Functions
     @classmethod
+    @traced
     def register(cls, username, email, password):
         if cls.query.filter_by(email=email).first():
             return None
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = passwords.hash_password(password)
         user = cls(username=username, email=email, password=hashed_password)
         db.session.add(user)
         db.session.commit()
         return user
     
     @classmethod
+    @traced
     def authenticate(cls, email, password):
         user = cls.query.filter_by(email=email).first()
-        if user and check_password_hash(user.password, password):
+        if user and passwords.verify_password(user.password, password):
+            # Upgrade hashes made with an older algorithm/cost while we still have the plain password
+            if passwords.needs_rehash(user.password):
+                user.password = passwords.hash_password(password)
+                db.session.commit()
             return user
         return None
     
@@ -125,42 +236,72 @@ class User(db.Model):
 
     def add_favorite_destination(self, name, country=None, description=None, image_url=None):
         """Add a destination to user's favorites"""
-        # Check if destination already exists
-        destination = FavoriteDestination.query.filter_by(name=name).first()
-        
-        if not destination:
-            destination = FavoriteDestination(
-                name=name,
-                country=country,
-                description=description,
-                image_url=image_url
-            )
-            db.session.add(destination)
-            db.session.flush()
-        
+        destination = FavoriteDestination.get_or_create(
+            name,
+            country=country,
+            description=description,
+            image_url=image_url
+        )
+
         # Check if user already has this destination favorited
-        if destination not in self.favorite_destinations:
+        if not self.has_favorite(destination.id):
+            others = [dest.id for dest in self.favorite_destinations]
             self.favorite_destinations.append(destination)
+            DestinationCooccurrence.adjust(destination.id, others, 1)
             db.session.commit()
+            recommendations.invalidate([destination.id] + others, self.id)
+            trending.record(destination.name)
             return destination
+        db.session.commit()
         return None
 
     def remove_favorite_destination(self, destination):
         """Remove a destination from user's favorites"""
         if destination in self.favorite_destinations:
             self.favorite_destinations.remove(destination)
+            others = [dest.id for dest in self.favorite_destinations]
+            DestinationCooccurrence.adjust(destination.id, others, -1)
             db.session.commit()
+            recommendations.invalidate([destination.id] + others, self.id)
             return True
         return False
 
     def is_destination_favorited(self, destination_name):
         """Check if a destination is in user's favorites"""
-        return any(dest.name.lower() == destination_name.lower() for dest in self.favorite_destinations)
+        return db.session.query(
+            db.select(user_favorite_destinations.c.user_id)
+            .join(FavoriteDestination, FavoriteDestination.id == user_favorite_destinations.c.destination_id)
+            .where(user_favorite_destinations.c.user_id == self.id,
+                   FavoriteDestination.key == destination_key(destination_name))
+            .exists()
+        ).scalar()
+
+    def has_favorite(self, destination_id):
+        """Primary-key probe of user_favorite_destinations"""
+        return db.session.query(
+            db.select(user_favorite_destinations.c.user_id)
+            .where(user_favorite_destinations.c.user_id == self.id,
+                   user_favorite_destinations.c.destination_id == destination_id)
+            .exists()
+        ).scalar()
 
     def get_favorite_destinations(self):
         """Get all favorite destinations for this user"""
         return self.favorite_destinations
 
+    @property
+    def trips(self):
+        """The user's trips. Not a relationship: trip_users is global while trips may live on trip shards,
+        and one statement cannot join across databases."""
+        return shards.trips_for_user(self.id)
+
+    def get_calendar_token(self, reset=False):
+        """Get (or create) the token that identifies this user's calendar feed"""
+        if reset or not self.calendar_token:
+            self.calendar_token = secrets.token_urlsafe(32)
+            db.session.commit()
+        return self.calendar_token
+
     def __repr__(self):
         return f"<User {self.username}>"
 
@@ -172,10 +313,44 @@ class FavoriteDestination(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False, unique=True)
+    key = db.Column(db.String(250), nullable=True)     # destination_key(name); the canonical catalogue key
     country = db.Column(db.String(100))
     description = db.Column(db.Text)
     image_url = db.Column(db.String(500))
+    latitude = db.Column(db.Float, nullable=True)       # Optional; geocoded from the offline gazetteer
+    longitude = db.Column(db.Float, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_favorite_destination_key", "key", unique=True),)
+
+    @db.validates("name")
+    def _set_key(self, field, name):
+        self.key = destination_key(name)
+        return name
+
+    @classmethod
+    def get_or_create(cls, name, country=None, description=None, image_url=None):
+        """Catalogue entry for a destination name, created on first use; missing details are filled in"""
+        key = destination_key(name)
+        with db.session.no_autoflush:
+            destination = cls.query.filter_by(key=key).first()
+            if destination is None:
+                # Rows from before the catalogue have no key until `flask backfill-destination-catalogue`
+                # runs; adopt one with the same name instead of inserting a duplicate
+                destination = cls.query.filter(cls.key.is_(None), db.or_(
+                    cls.name == name.strip(), db.func.lower(db.func.trim(cls.name)) == key)).first()
+                if destination is not None:
+                    destination.key = key
+        if destination is None:
+            destination = cls(name=name.strip(), country=country, description=description, image_url=image_url)
+            destination.locate()
+            db.session.add(destination)
+            db.session.flush()
+        else:
+            for field, value in (("country", country), ("description", description), ("image_url", image_url)):
+                if value and not getattr(destination, field):
+                    setattr(destination, field, value)
+        return destination
     
     def update_details(self, name=None, country=None, description=None, image_url=None):
         """Update destination details"""
@@ -190,14 +365,35 @@ class FavoriteDestination(db.Model):
         db.session.commit()
         return self
 
+    def locate(self):
+        """Fill in coordinates from the gazetteer when they are missing; returns True if found"""
+        if self.latitude is None or self.longitude is None:
+            point = geo.geocode(self.name)
+            if point:
+                self.latitude, self.longitude = point
+        return self.latitude is not None
+
+    def distance_to(self, other):
+        if None in (self.latitude, self.longitude, other.latitude, other.longitude):
+            return None
+        return geo.haversine_km(self.latitude, self.longitude, other.latitude, other.longitude)
+
     def get_favorite_count(self):
         """Get the number of users who favorited this destination"""
         return self.users_who_favorited.count()
 
     @classmethod
+    def public(cls):
+        """Catalogue entries someone has favorited. Trip destinations are catalogued too (a trip's free text,
+        typed coordinates), but stay private to the trip until a user favorites them."""
+        fans = user_favorite_destinations
+        return cls.query.filter(db.exists().where(fans.c.destination_id == cls.id))
+
+    @classmethod
+    @traced
     def get_popular_destinations(cls, limit=10):
         """Get most favorited destinations"""
-        destinations = cls.query.all()
+        destinations = cls.public().all()
         sorted_destinations = sorted(
             destinations, 
             key=lambda d: d.get_favorite_count(), 
@@ -208,7 +404,7 @@ class FavoriteDestination(db.Model):
     @classmethod
     def search_destinations(cls, query):
         """Search destinations by name or country"""
-        return cls.query.filter(
+        return cls.public().filter(
             db.or_(
                 cls.name.ilike(f"%{query}%"),
                 cls.country.ilike(f"%{query}%")
@@ -220,6 +416,66 @@ class FavoriteDestination(db.Model):
 
 #==========================================================================================================
 
+class DestinationCooccurrence(db.Model):
+    """Sparse destination x destination matrix: how many users favorited both destinations.
+
+    Each pair is stored in both directions, so the neighbours of a destination, best first, are one range
+    scan of the (destination_id, count) index. Pairs nobody shares have no row.
+    """
+    __tablename__ = "destination_cooccurrence"
+
+    destination_id = db.Column(db.Integer, db.ForeignKey("favorite_destination.id"), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey("favorite_destination.id"), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index("ix_destination_cooccurrence_rank", "destination_id", "count"),)
+
+    @classmethod
+    def adjust(cls, destination_id, other_ids, delta):
+        """Add delta to the pairs (destination, other) and (other, destination); O(len(other_ids))"""
+        rows = [{"destination_id": a, "other_id": b, "count": delta}
+                for other_id in other_ids if other_id != destination_id
+                for a, b in ((destination_id, other_id), (other_id, destination_id))]
+        if not rows:
+            return
+        statement = sqlite_insert(cls).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=["destination_id", "other_id"],
+            set_={"count": cls.count + statement.excluded.count},
+        )
+        db.session.execute(statement)
+        if delta < 0:
+            cls.query.filter(
+                db.or_(cls.destination_id == destination_id, cls.other_id == destination_id), cls.count <= 0
+            ).delete(synchronize_session=False)
+
+#==========================================================================================================
+
+class DestinationTrend(db.Model):
+    """Checkpointed trending counters, one row per destination key (see app/services/trending.py).
+
+    Each score_<window> column is a log-space decayed count, so ordering by it ranks destinations.
+    """
+    __tablename__ = "destination_trend"
+
+    key = db.Column(db.String(250), primary_key=True)
+    name = db.Column(db.String(250), nullable=False)
+    score_day = db.Column(db.Float, nullable=True)
+    score_week = db.Column(db.Float, nullable=True)
+    score_month = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_destination_trend_day", "score_day"),
+        db.Index("ix_destination_trend_week", "score_week"),
+        db.Index("ix_destination_trend_month", "score_month"),
+    )
+
+    def __repr__(self):
+        return f"<DestinationTrend {self.key}>"
+
+#==========================================================================================================
+
 class Task(db.Model):
     # Attributes
     __tablename__ = 'task'
@@ -229,11 +485,22 @@ class Task(db.Model):
     due_time = db.Column(db.Time, nullable=True)
     status = db.Column(db.String(20), default="Pending")
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    trip_id = db.Column(db.Integer, db.ForeignKey('trip.id'), nullable=True)   # Set for a trip's shared checklist
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    STATUSES = ("Pending", "Working", "Done")
+    PAGE_SIZE = 50
+
+    # Serve the task list (by user) and the trip checklists (by trip): filter by status, ordered by due date/time
+    __table_args__ = (
+        db.Index("ix_task_user_status_due", "user_id", "status", "due_date", "due_time"),
+        db.Index("ix_task_trip_status_due", "trip_id", "status", "due_date", "due_time"),
+    )
 
     # Functions
     @classmethod
-    def create(cls, title, user_id, due_date, due_time):
-        task = cls(title=title, user_id=user_id, due_date=due_date, due_time=due_time)
+    def create(cls, title, user_id, due_date, due_time, trip_id=None):
+        task = cls(title=title, user_id=user_id, due_date=due_date, due_time=due_time, trip_id=trip_id)
         db.session.add(task)
         db.session.commit()
         return task
@@ -258,13 +525,177 @@ class Task(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    @classmethod
+    @traced
+    def page(cls, user_id, status=None, due_from=None, due_to=None, cursor=None, limit=PAGE_SIZE):
+        """One page of a user's own tasks in (status, due_date, due_time, id) order; returns (tasks, next cursor).
+
+        Trip checklist items the user added are not personal tasks: they belong to the trip's checklist.
+        """
+        order = [cls.status, cls.due_date, cls.due_time, cls.id]
+        query = cls.query.filter(cls.user_id == user_id, cls.trip_id.is_(None))
+        if status:
+            query = query.filter(cls.status == status)
+        if due_from:
+            query = query.filter(cls.due_date >= due_from)
+        if due_to:
+            query = query.filter(cls.due_date <= due_to)
+        if cursor:
+            after = pagination.decode_cursor(cursor, order)
+            if after:
+                query = query.filter(pagination.keyset_after(order, after))
+
+        tasks = query.order_by(*order).limit(limit + 1).all()
+        next_cursor = None
+        if len(tasks) > limit:
+            tasks = tasks[:limit]
+            last = tasks[-1]
+            next_cursor = pagination.encode_cursor([last.status, last.due_date, last.due_time, last.id])
+        return tasks, next_cursor
+
+    @classmethod
+    @traced
+    def bulk_toggle(cls, user_id, task_ids):
+        """Advance every selected task to its next status in one UPDATE; returns the number changed"""
+        following = db.case(
+            (cls.status == "Pending", "Working"),
+            (cls.status == "Working", "Done"),
+            else_="Pending",
+        )
+        return cls._bulk_update(user_id, task_ids, following)
+
+    @classmethod
+    @traced
+    def bulk_set_status(cls, user_id, task_ids, status):
+        return cls._bulk_update(user_id, task_ids, status)
+
+    @classmethod
+    @traced
+    def bulk_delete(cls, user_id, task_ids):
+        """Delete the selected tasks in one DELETE; returns the number deleted"""
+        statement = db.delete(cls).where(cls.user_id == user_id, cls.trip_id.is_(None), cls.id.in_(task_ids)) \
+            .returning(cls.id, cls.trip_id)
+        deleted = db.session.execute(statement, execution_options={"synchronize_session": False}).all()
+        cls._record_changes("delete", deleted, user_id)
+        db.session.commit()
+        return len(deleted)
+
+    @classmethod
+    def _bulk_update(cls, user_id, task_ids, status):
+        statement = db.update(cls).where(cls.user_id == user_id, cls.trip_id.is_(None), cls.id.in_(task_ids)) \
+            .values(status=status).returning(cls.id, cls.trip_id)
+        updated = db.session.execute(statement, execution_options={"synchronize_session": False}).all()
+        cls._record_changes("update", updated, user_id)
+        db.session.commit()
+        return len(updated)
+
+    @staticmethod
+    def _record_changes(op, rows, user_id):
+        # Checklist tasks are logged under their trip, so every participant's client sees the change
+        by_trip = {}
+        for task_id, trip_id in rows:
+            by_trip.setdefault(trip_id, []).append(task_id)
+        for trip_id, task_ids in by_trip.items():
+            ChangeLog.record("task", op, task_ids, trip_id=trip_id, user_id=user_id)
+
+    @classmethod
+    def checklist(cls, trip_id):
+        """A trip's shared checklist, open items first, each group by due date/time"""
+        return cls.query.filter_by(trip_id=trip_id).order_by(
+            cls.status == "Done", cls.due_date, cls.due_time, cls.id).all()
+
+    @classmethod
+    def checklist_progress(cls, trip_id):
+        """(done, total) for a trip's checklist, counted in the trip index"""
+        done, total = db.session.query(
+            db.func.count(db.case((cls.status == "Done", 1))), db.func.count(cls.id)
+        ).filter(cls.trip_id == trip_id).one()
+        return done, total
+
     @classmethod
     def clear_user_tasks(cls, user_id):
-        cls.query.filter_by(user_id=user_id).delete()
+        """Delete the user's own to-do list; the checklists of their trips are shared and stay"""
+        tasks = db.session.query(cls.id, cls.trip_id).filter_by(user_id=user_id, trip_id=None).all()
+        cls.query.filter_by(user_id=user_id, trip_id=None).delete()
+        cls._record_changes("delete", tasks, user_id)
         db.session.commit()
 
 #==========================================================================================================
 
+class ChecklistTemplate(db.Model):
+    """Reusable checklist (packing list, visa steps) copied into a trip's tasks.
+
+    Templates without an owner are built in and offered to everyone (see `flask seed-checklist-templates`).
+    """
+    __tablename__ = "checklist_template"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    items = db.relationship("ChecklistTemplateItem", backref="template", lazy=True, cascade="all, delete-orphan",
+                            order_by="ChecklistTemplateItem.position")
+
+    @classmethod
+    def available_to(cls, user_id):
+        """Built-in templates and the user's own, with their item counts"""
+        item_count = db.select(db.func.count(ChecklistTemplateItem.id)) \
+            .where(ChecklistTemplateItem.template_id == cls.id).scalar_subquery()
+        return db.session.query(cls, item_count).filter(
+            db.or_(cls.user_id.is_(None), cls.user_id == user_id)).order_by(cls.user_id.isnot(None), cls.name).all()
+
+    @classmethod
+    def seed_builtins(cls, rows):
+        """Create missing built-in templates from (template, title, due_offset_days) rows; returns the count"""
+        existing = {name for name, in db.session.query(cls.name).filter(cls.user_id.is_(None))}
+        created = {}
+        for position, (name, title, offset) in enumerate(rows):
+            if name in existing:
+                continue
+            if name not in created:
+                created[name] = cls(name=name)
+                db.session.add(created[name])
+            created[name].items.append(ChecklistTemplateItem(position=position, title=title, due_offset_days=offset))
+        db.session.commit()
+        return len(created)
+
+    @classmethod
+    @traced
+    def from_trip(cls, name, trip, user_id):
+        """Save a trip's checklist as a template; due dates become offsets from the trip's start"""
+        template = cls(name=name, user_id=user_id)
+        db.session.add(template)
+        db.session.flush()
+
+        offset = db.cast(db.func.julianday(Task.due_date) - db.func.julianday(db.literal(trip.start_date.isoformat())),
+                         db.Integer)
+        position = db.func.row_number().over(order_by=(Task.due_date, Task.due_time, Task.id))
+        rows = db.select(db.literal(template.id), position, Task.title, offset).where(Task.trip_id == trip.id)
+        db.session.execute(db.insert(ChecklistTemplateItem).from_select(
+            ["template_id", "position", "title", "due_offset_days"], rows))
+        db.session.commit()
+        return template
+
+    def __repr__(self):
+        return f"<ChecklistTemplate {self.name}>"
+
+
+class ChecklistTemplateItem(db.Model):
+    __tablename__ = "checklist_template_item"
+
+    id = db.Column(db.Integer, primary_key=True)
+    template_id = db.Column(db.Integer, db.ForeignKey("checklist_template.id"), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    title = db.Column(db.String(100), nullable=False)
+    due_offset_days = db.Column(db.Integer, nullable=True)     # Days from the trip's start; negative = before departure
+
+    __table_args__ = (db.Index("ix_checklist_template_item_template", "template_id", "position"),)
+
+    def __repr__(self):
+        return f"<ChecklistTemplateItem {self.title}>"
+
+#==========================================================================================================
+
 class Trip(db.Model):
     # Attributes
     __tablename__ = "trip"
@@ -273,6 +704,9 @@ class Trip(db.Model):
     start_date = db.Column(db.Date, nullable=False)
     end_date = db.Column(db.Date, nullable=False)
     description = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
     destinations = db.relationship(
         "TripDestination",
         backref="trip",
@@ -281,13 +715,35 @@ class Trip(db.Model):
     )
 
     # Relationships
-    itinerary = db.relationship("ItineraryItem", backref="trip", lazy=True, cascade="all, delete-orphan")
+    itinerary = db.relationship(
+        "ItineraryItem",
+        backref="trip",
+        lazy=True,
+        cascade="all, delete-orphan",
+        order_by="(ItineraryItem.date, ItineraryItem.time, ItineraryItem.id)"
+    )
     budget = db.relationship("Budget", backref="trip", uselist=False, cascade="all, delete-orphan")
-    participants = db.relationship("User", secondary=trip_users, backref=db.backref("trips", lazy="dynamic"))
+    participants = db.relationship("User", secondary=trip_users)
     reviews = db.relationship("Review", backref="trip", lazy=True, cascade="all, delete-orphan")
+    tasks = db.relationship("Task", backref="trip", lazy=True, cascade="all, delete-orphan")
 
     # Functions 
     @classmethod
+    def with_budget(cls, trip_id):
+        """The trip with everything budget.html reads already loaded, for pages rendered as a stream.
+
+        A streamed template renders after the request's session has been removed, so any lazy load (or
+        attribute expired by a commit earlier in the request) would fail partway through the page.
+        """
+        return cls.query.options(
+            selectinload(cls.destinations),
+            selectinload(cls.budget).selectinload(Budget.planned_budgets),
+            selectinload(cls.budget).selectinload(Budget.expenses).options(
+                selectinload(Expense.shared_users), selectinload(Expense.attachments)),
+        ).populate_existing().get(trip_id)
+
+    @classmethod
+    @traced
     def create(cls, title, destinations, start_date, end_date, description, participant):
         trip = cls(
             title=title,
@@ -300,20 +756,20 @@ class Trip(db.Model):
 
         for dest in destinations:
             if dest.strip():
-                trip.destinations.append(TripDestination(name=dest.strip()))
+                trip.destinations.append(TripDestination.for_name(dest))
 
         trip.participants.append(participant)
         db.session.commit()
         return trip
     
-    def update_details(self, title=None, destinations=None, start_date=None, end_date=None, description=None):
+    @traced
+    def update_details(self, title=None, destinations=None, start_date=None, end_date=None, description=None,
+                       version=None):
+        _check_version(self, version)
         if title: 
             self.title = title
         if destinations:
-            self.destinations = []
-            for dest in destinations:
-                if dest.strip():
-                    self.destinations.append(TripDestination(name=dest.strip()))
+            self._set_destinations(destinations)
         if start_date: 
             self.start_date = start_date
         if end_date: 
@@ -321,15 +777,57 @@ class Trip(db.Model):
         if description is not None: 
             self.description = description
 
-        db.session.commit()
+        # Destination changes do not touch the trip row; updating it bumps the version for them too
+        self.updated_at = datetime.utcnow()
+        _commit_or_conflict(self)
         return self
 
-    def add_itinerary_item(self, title, date, location=None, notes=None, time=None):
-        item = ItineraryItem(title=title, date=date, location=location, notes=notes, time=time, trip_id=self.id)
+    def _set_destinations(self, names):
+        """Apply the new destination list as a diff: unchanged destinations keep their rows (and favorites)"""
+        wanted = {}
+        for name in names:
+            if name.strip():
+                wanted.setdefault(destination_key(name), name)
+        for dest in list(self.destinations):
+            if wanted.pop(destination_key(dest.name), None) is None:
+                self.destinations.remove(dest)
+        for name in wanted.values():
+            self.destinations.append(TripDestination.for_name(name))
+
+    @traced
+    def add_itinerary_item(self, title, date, location=None, notes=None, time=None, duration_minutes=None):
+        item = ItineraryItem(
+            title=title,
+            date=date,
+            location=location,
+            notes=notes,
+            time=time,
+            duration_minutes=duration_minutes,
+            trip_id=self.id
+        )
+        item.locate()
         db.session.add(item)
         db.session.commit()
+        item.warnings = timeline.validate_item(item)   # overlaps / out-of-range dates, checked against that day only
         return item
 
+    @traced
+    def get_timeline(self):
+        """Itinerary bucketed by day with overlap and date-range checks"""
+        return timeline.build_timeline(self)
+
+    @traced
+    def suggest_routes(self, trip_timeline=None):
+        """{date: (ordered stops, route km, current km)} for days with 3+ located stops that can be shortened"""
+        routes = {}
+        for day in (trip_timeline or self.get_timeline()).days:
+            stops = [item for item in day.items if item.latitude is not None and item.longitude is not None]
+            if len(stops) >= 3:
+                ordered, route_km, current_km = geo.order_stops(stops)
+                if route_km < current_km - 0.05:
+                    routes[day.date] = (ordered, route_km, current_km)
+        return routes
+
     def init_budget(self):
         if not self.budget:
             budget = Budget(total_planned=0.0, total_spent=0.0, trip_id=self.id)
@@ -337,25 +835,29 @@ class Trip(db.Model):
             db.session.commit()
         return self.budget
 
+    @traced
     def add_expense(self, amount, category, description, shared_friends=None):
         if not self.budget:
             self.init_budget()
 
-        expense = Expense(
-            amount=amount,
-            description=description,
-            budget_id=self.budget.id,
-            category=category
-        )
-        if shared_friends:
-            for user in shared_friends:
-                if user in User.query.all() and user not in expense.shared_users:
-                    if user in self.participants:
-                        expense.shared_users.append(user)
-        self.budget.total_spent += amount  
-        db.session.add(expense)
-        db.session.commit()
-        return expense
+        def add():
+            expense = Expense(
+                amount=amount,
+                description=description,
+                budget_id=self.budget.id,
+                category=category
+            )
+            if shared_friends:
+                for user in shared_friends:
+                    if user in User.query.all() and user not in expense.shared_users:
+                        if user in self.participants:
+                            expense.shared_users.append(user)
+            self.budget.total_spent += amount       # read-modify-write: retried if another expense lands first
+            db.session.add(expense)
+            db.session.commit()
+            return expense
+
+        return _retry_on_conflict(add)
 
     def share_with(self, user):
         if user not in self.participants:
@@ -372,25 +874,121 @@ class Trip(db.Model):
     def get_participant_ids(self):
         return [user.id for user in self.participants]
     
+    @traced
     def delete_trip(self):
-        for item in self.itinerary:
-            db.session.delete(item)
-
-        if self.budget:
-            for expense in self.budget.expenses:
-                db.session.delete(expense)
-            db.session.delete(self.budget)
-
+        # Itinerary, budget (with its expenses), destinations, reviews and tasks go with it through the
+        # relationship cascades, in one flush. Deleting them by hand first made the cascade delete some rows
+        # twice, which versioned rows report as a conflict.
         db.session.delete(self)
         db.session.commit()
 
-    def delete_all_trips(self):
-        for trip in self.trips:
-            trip.delete_trip()  
+    @classmethod
+    def delete_all_trips(cls, user):
+        for trip in shards.trips_for_user(user.id):
+            trip.delete_trip()
         db.session.commit()
 
     def add_destination(self, name: str):
-        self.destinations.append(TripDestination(name=name))
+        self.destinations.append(TripDestination.for_name(name))
+        db.session.commit()
+
+    def has_destination(self, destination_id):
+        """Whether the catalogue destination is already part of this trip (indexed lookup)"""
+        return TripDestination.query.filter_by(trip_id=self.id, destination_id=destination_id).first() is not None
+
+    @traced
+    def apply_checklist_template(self, template, user_id):
+        """Copy a template's items into this trip's checklist with one INSERT ... SELECT; returns the count.
+
+        Due dates are computed in SQL from the trip's start date and each item's day offset.
+        """
+        items = ChecklistTemplateItem.__table__
+        due_date = db.func.date(db.literal(self.start_date.isoformat()),
+                                db.cast(items.c.due_offset_days, db.String) + " days")
+        rows = db.select(items.c.title, due_date, db.literal("Pending"), db.literal(user_id),
+                         db.literal(self.id), db.literal(datetime.utcnow())) \
+            .where(items.c.template_id == template.id).order_by(items.c.position)
+        statement = db.insert(Task).from_select(
+            ["title", "due_date", "status", "user_id", "trip_id", "updated_at"], rows).returning(Task.id)
+        task_ids = db.session.execute(statement).scalars().all()
+        ChangeLog.record("task", "insert", task_ids, trip_id=self.id, user_id=user_id)
+        db.session.commit()
+        return len(task_ids)
+
+    @traced
+    def clone(self, title, start_date, owner, include_participants=False):
+        """Copy this trip to a new start date with set-based INSERT ... SELECT statements, in one transaction.
+
+        Destinations, the itinerary (dates shifted with the trip), planned budgets and the checklist (reset
+        to Pending) are copied inside SQLite without loading a row into the ORM; expenses and reviews are
+        not. Returns the new trip id.
+        """
+        with shards.pinned(shards.shard_of(self)):     # the copy lives on the original's shard
+            return self._clone(title, start_date, owner, include_participants)
+
+    def _clone(self, title, start_date, owner, include_participants):
+        shift = f"{(start_date - self.start_date).days:+d} days"
+        now = datetime.utcnow()
+        session = db.session
+
+        trip_id = session.execute(db.insert(Trip).values(
+            title=title, start_date=start_date, end_date=start_date + (self.end_date - self.start_date),
+            description=self.description, updated_at=now).returning(Trip.id)).scalar_one()
+        ChangeLog.record("trip", "insert", [trip_id], trip_id=trip_id)
+
+        # Participants: the owner, plus everyone else on the original when asked
+        user_ids = [owner.id]
+        if include_participants:
+            user_ids += [user_id for user_id in self.get_participant_ids() if user_id != owner.id]
+        session.execute(trip_users.insert(), [{"user_id": user_id, "trip_id": trip_id} for user_id in user_ids])
+        for user_id in user_ids:
+            ChangeLog.record("participant", "insert", [user_id], trip_id=trip_id, user_id=user_id)
+
+        destinations = TripDestination.__table__
+        rows = session.execute(db.insert(destinations).from_select(
+            ["name", "destination_id", "trip_id", "created_at"],
+            db.select(destinations.c.name, destinations.c.destination_id, db.literal(trip_id), db.literal(now))
+            .where(destinations.c.trip_id == self.id)
+        ).returning(destinations.c.id, destinations.c.name)).all()
+        ChangeLog.record("destination", "insert", [row.id for row in rows], trip_id=trip_id)
+
+        items = ItineraryItem.__table__
+        item_ids = session.execute(db.insert(items).from_select(
+            ["title", "date", "location", "notes", "time", "duration_minutes", "latitude", "longitude", "trip_id"],
+            db.select(items.c.title, db.func.date(items.c.date, shift), items.c.location, items.c.notes, items.c.time,
+                      items.c.duration_minutes, items.c.latitude, items.c.longitude, db.literal(trip_id))
+            .where(items.c.trip_id == self.id)
+        ).returning(items.c.id)).scalars().all()
+        if item_ids:
+            geo.index_rows(ItineraryItem, item_ids)
+        ChangeLog.record("itinerary", "insert", item_ids, trip_id=trip_id)
+
+        if self.budget:
+            budget_id = session.execute(db.insert(Budget).values(
+                total_planned=self.budget.total_planned, total_spent=0.0, trip_id=trip_id).returning(Budget.id)
+            ).scalar_one()
+            ChangeLog.record("budget", "insert", [budget_id], trip_id=trip_id)
+            planned = PlannedBudget.__table__
+            planned_ids = session.execute(db.insert(planned).from_select(
+                ["amount", "category", "budget_id"],
+                db.select(planned.c.amount, planned.c.category, db.literal(budget_id))
+                .where(planned.c.budget_id == self.budget.id)
+            ).returning(planned.c.id)).scalars().all()
+            ChangeLog.record("planned_budget", "insert", planned_ids, trip_id=trip_id)
+
+        tasks = Task.__table__
+        task_ids = session.execute(db.insert(tasks).from_select(
+            ["title", "due_date", "due_time", "status", "user_id", "trip_id", "updated_at"],
+            db.select(tasks.c.title, db.func.date(tasks.c.due_date, shift), tasks.c.due_time, db.literal("Pending"),
+                      db.literal(owner.id), db.literal(trip_id), db.literal(now))
+            .where(tasks.c.trip_id == self.id)
+        ).returning(tasks.c.id)).scalars().all()
+        ChangeLog.record("task", "insert", task_ids, trip_id=trip_id, user_id=owner.id)
+
+        session.commit()
+        for row in rows:        # the copied destinations count towards trending, like any new trip destination
+            trending.record(row.name)
+        return trip_id
 
     def get_average_rating(self):
         """Calculate average rating for this trip"""
@@ -414,28 +1012,41 @@ class TripDestination(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
     trip_id = db.Column(db.Integer, db.ForeignKey("trip.id"), nullable=False)
-    is_favorited = db.Column(db.Boolean, default=False)  # Track if this destination is favorited
-    
+    destination_id = db.Column(db.Integer, db.ForeignKey("favorite_destination.id"), nullable=True, index=True)
+    is_favorited = db.Column(db.Boolean, default=False)  # Legacy flag, not per user: use is_favorited_by(user)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)    # Feeds the trending counters
+
+    # Relationships
+    destination = db.relationship("FavoriteDestination", backref=db.backref("trip_destinations", lazy="dynamic"))
+
+    @classmethod
+    def for_name(cls, name):
+        """New trip destination linked to its catalogue entry"""
+        name = name.strip()
+        return cls(name=name, destination=FavoriteDestination.get_or_create(name))
+
+    def is_favorited_by(self, user):
+        """Whether this user has the destination in their favorites (an indexed join, no name matching)"""
+        return self.destination_id is not None and user.has_favorite(self.destination_id)
+
     def mark_as_favorite(self, user):
-        """Mark this trip destination as favorite and add to user's favorites"""
-        self.is_favorited = True
+        """Add this trip destination to the user's favorites"""
         user.add_favorite_destination(self.name)
+        if self.destination_id is None:
+            self.destination = FavoriteDestination.get_or_create(self.name)
         db.session.commit()
         return self
 
     def unmark_as_favorite(self, user):
-        """Unmark this trip destination as favorite"""
-        self.is_favorited = False
-        # Find the favorite destination and remove it from user's favorites
-        fav_dest = FavoriteDestination.query.filter_by(name=self.name).first()
-        if fav_dest:
-            user.remove_favorite_destination(fav_dest)
+        """Remove this trip destination from the user's favorites"""
+        if self.destination is not None:
+            user.remove_favorite_destination(self.destination)
         db.session.commit()
         return self
 
     def toggle_favorite(self, user):
         """Toggle favorite status for this destination"""
-        if self.is_favorited:
+        if self.is_favorited_by(user):
             return self.unmark_as_favorite(user)
         else:
             return self.mark_as_favorite(user)
@@ -454,20 +1065,44 @@ class ItineraryItem(db.Model):
     location = db.Column(db.String(150))
     notes = db.Column(db.Text)
     time = db.Column(db.Time)
+    duration_minutes = db.Column(db.Integer, nullable=True)    # Optional length, used for overlap detection
+    latitude = db.Column(db.Float, nullable=True)               # Optional; geocoded from the location
+    longitude = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
 
     # Relationships
     trip_id = db.Column(db.Integer, db.ForeignKey("trip.id"), nullable=False)
 
+    # Timeline index: serves per-trip listings ordered by day and time
+    __table_args__ = (db.Index("ix_itinerary_item_trip_date_time", "trip_id", "date", "time"),)
+
     # Functions
-    def update(self, title=None, date=None, location=None, notes=None, time=None):
+    def update(self, title=None, date=None, location=None, notes=None, time=None, duration_minutes=None,
+               version=None):
+        _check_version(self, version)
         if title: self.title = title
         if date: self.date = date
-        if location: self.location = location
+        if location and location != self.location:
+            self.location = location
+            self.latitude = self.longitude = None
+            self.locate()
         if notes: self.notes = notes
         if time: self.time = time
-        db.session.commit()
+        if duration_minutes is not None: self.duration_minutes = duration_minutes or None
+        _commit_or_conflict(self)
+        self.warnings = timeline.validate_item(self)
         return self
 
+    def locate(self):
+        """Coordinates from the location ("Colosseum", "48.85, 2.29"); returns True if found"""
+        if self.latitude is None or self.longitude is None:
+            point = geo.geocode(self.location)
+            if point:
+                self.latitude, self.longitude = point
+        return self.latitude is not None
+
     def delete(self):
         db.session.delete(self)
         db.session.commit()
@@ -483,6 +1118,8 @@ class Budget(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     total_planned = db.Column(db.Float, default=0.0)
     total_spent = db.Column(db.Float, default=0.0)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
 
     # Relationships
     trip_id = db.Column(db.Integer, db.ForeignKey("trip.id"), nullable=False)
@@ -490,27 +1127,36 @@ class Budget(db.Model):
     planned_budgets = db.relationship("PlannedBudget", backref="budget", cascade="all, delete-orphan")
 
     # Functions
+    @traced
     def add_expense(self, amount, description, shared_with=None):
-        expense = Expense(amount=amount, description=description, shared_with=shared_with, budget_id=self.id)
-        self.total_spent += amount
-        db.session.add(expense)
-        db.session.commit()
-        return expense
+        def add():
+            expense = Expense(amount=amount, description=description, shared_with=shared_with, budget_id=self.id)
+            self.total_spent += amount
+            db.session.add(expense)
+            db.session.commit()
+            return expense
+        return _retry_on_conflict(add)
     
+    @traced
     def add_planned_budget(self, amount, category):
-        planned_budget = PlannedBudget(amount=amount, category=category, budget_id=self.id)
-        self.total_planned += amount
-        db.session.add(planned_budget)
-        db.session.commit()
-        return planned_budget
+        def add():
+            planned_budget = PlannedBudget(amount=amount, category=category, budget_id=self.id)
+            self.total_planned += amount
+            db.session.add(planned_budget)
+            db.session.commit()
+            return planned_budget
+        return _retry_on_conflict(add)
 
     def calculate_remaining(self):
         return self.total_planned - self.total_spent
     
+    @traced
     def update_totals(self):
-        self.total_planned = sum(pb.amount for pb in self.planned_budgets)
-        self.total_spent = sum(exp.amount for exp in self.expenses)
-        db.session.commit()
+        def recompute():
+            self.total_planned = sum(pb.amount for pb in self.planned_budgets)
+            self.total_spent = sum(exp.amount for exp in self.expenses)
+            db.session.commit()
+        _retry_on_conflict(recompute)
 
     def __repr__(self):
         return f"<Budget Planned={self.total_planned}, Spent={self.total_spent}>"
@@ -551,13 +1197,19 @@ class Expense(db.Model):
     description = db.Column(db.String(200))
     category = db.Column(db.String(50), default="General") 
     status = db.Column(db.String(20), default="Unshared")
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
 
     # Relationships
     budget_id = db.Column(db.Integer, db.ForeignKey("budget.id"), nullable=False)
     shared_users = db.relationship("User", secondary=expense_shared, backref="expenses_shared_with_me")
+    attachments = db.relationship("ExpenseAttachment", backref="expense", lazy=True, cascade="all, delete-orphan",
+                                  order_by="ExpenseAttachment.id")
 
     # Functions
-    def update_details(self, amount=None, description=None, category=None, shared_friends=None):
+    @traced
+    def update_details(self, amount=None, description=None, category=None, shared_friends=None, version=None):
+        _check_version(self, version)
         if amount is not None:
             self.amount = float(amount)
         if description is not None:
@@ -570,7 +1222,7 @@ class Expense(db.Model):
                     if user in self.budget.trip.participants:
                         self.shared_users.append(user)
 
-        db.session.commit()
+        _commit_or_conflict(self)
         self.budget.update_totals()
         return self
     
@@ -588,6 +1240,7 @@ class Expense(db.Model):
             self.shared_users.remove(user)
         db.session.commit()
 
+    @traced
     def delete_expense(self):
         self.remove_all_shared_users()
         db.session.delete(self)
@@ -612,6 +1265,49 @@ class Expense(db.Model):
 
 #==========================================================================================================
 
+class ExpenseAttachment(db.Model):
+    """A receipt attached to an expense. The file itself is stored once per content (app/services/attachments.py),
+    so the same receipt attached to several expenses shares one file; unreferenced files are removed by
+    `flask purge-attachments`.
+    """
+    __tablename__ = "expense_attachment"
+
+    id = db.Column(db.Integer, primary_key=True)
+    expense_id = db.Column(db.Integer, db.ForeignKey("expense.id"), nullable=False, index=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    filename = db.Column(db.String(200), nullable=False)
+    content_type = db.Column(db.String(50), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    uploaded_by = db.Column(db.Integer, db.ForeignKey("user.id"))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def add_all(cls, expense, stored, user_id):
+        """Attach files already written to the store: [(sha256, size, content type, filename), ...]"""
+        rows = [cls(expense=expense, sha256=sha256, size=size, content_type=content_type, filename=filename,
+                    uploaded_by=user_id) for sha256, size, content_type, filename in stored]
+        db.session.add_all(rows)
+        db.session.commit()
+        return rows
+
+    @classmethod
+    def referenced_hashes(cls):
+        """Every stored receipt still in use, by live expenses or by archived trips"""
+        return set(db.session.execute(db.select(cls.sha256).distinct()).scalars()) | archive.attachment_hashes()
+
+    @property
+    def is_image(self):
+        return self.content_type.startswith("image/")
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+    def __repr__(self):
+        return f"<ExpenseAttachment {self.filename} ({self.sha256[:12]})>"
+
+#==========================================================================================================
+
 class Review(db.Model):
     """Trip reviews with ratings"""
     __tablename__ = "review"
@@ -667,4 +1363,113 @@ class Review(db.Model):
         return "★" * self.rating + "☆" * (5 - self.rating)
     
     def __repr__(self):
-        return f"<Review Trip:{self.trip_id} User:{self.user_id} Rating:{self.rating}>"
\ No newline at end of file
+        return f"<Review Trip:{self.trip_id} User:{self.user_id} Rating:{self.rating}>"
+#==========================================================================================================
+
+class ChangeLog(db.Model):
+    """Append-only feed of every insert, update and delete, read by offline clients through /sync.
+
+    Rows are written in the same transaction as the change they describe (see app/services/changes.py).
+    SQLite serialises writers, so seq order is also commit order.
+    """
+    __tablename__ = "change_log"
+
+    seq = db.Column(db.Integer, primary_key=True)
+    entity_type = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)          # insert / update / delete
+    trip_id = db.Column(db.Integer, nullable=True)          # trip the entity belongs to (trip data)
+    user_id = db.Column(db.Integer, nullable=True)          # owner (tasks) or the participant added/removed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_change_log_trip_seq", "trip_id", "seq"),
+        db.Index("ix_change_log_user_seq", "user_id", "seq"),
+        db.Index("ix_change_log_created_at", "created_at"),
+        {"sqlite_autoincrement": True},     # never reuse a seq, even after old rows are pruned
+    )
+
+    @classmethod
+    def record(cls, entity_type, op, entity_ids, trip_id=None, user_id=None):
+        """Log changes made with bulk statements, which bypass the session's flush events"""
+        rows = [dict(entity_type=entity_type, entity_id=entity_id, op=op, trip_id=trip_id, user_id=user_id)
+                for entity_id in entity_ids]
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)     # Core: sharded sessions refuse ORM bulk inserts
+
+    @classmethod
+    def latest_seq(cls):
+        return db.session.query(db.func.max(cls.seq)).scalar() or 0
+
+    @classmethod
+    def oldest_seq(cls):
+        return db.session.query(db.func.min(cls.seq)).scalar()
+
+    @classmethod
+    def prune(cls, before, batch_size=500):
+        """Delete entries older than `before` in small batches; clients behind them must resync"""
+        pruned = 0
+        while True:
+            batch = db.session.query(cls.seq).filter(cls.created_at < before).limit(batch_size).subquery()
+            deleted = cls.query.filter(cls.seq.in_(db.select(batch.c.seq))).delete(synchronize_session=False)
+            db.session.commit()
+            pruned += deleted
+            if deleted < batch_size:
+                return pruned
+
+    def __repr__(self):
+        return f"<ChangeLog {self.seq} {self.op} {self.entity_type}:{self.entity_id}>"
+
+#==========================================================================================================
+
+# Participants of archived trips, so a user's archive can be listed and access checked without the blob
+trip_archive_users = db.Table(
+    "trip_archive_users",
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("trip_id", db.Integer, db.ForeignKey("trip_archive.trip_id"), primary_key=True)
+)
+
+
+class TripArchive(db.Model):
+    """A finished trip moved out of the hot tables: one zlib-compressed JSON document per trip.
+
+    Written by `flask archive-trips` and read through app/services/archive.py, which keeps recently opened
+    trips decompressed in an LRU.
+    """
+    __tablename__ = "trip_archive"
+
+    trip_id = db.Column(db.Integer, primary_key=True, autoincrement=False)     # the id the trip had
+    title = db.Column(db.String(100), nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    participants = db.relationship("User", secondary=trip_archive_users,
+                                   backref=db.backref("archived_trips", lazy="dynamic"))
+
+    def __repr__(self):
+        return f"<TripArchive {self.trip_id} {self.title}>"
+
+#==========================================================================================================
+
+class TripShard(db.Model):
+    """Trips living on another shard than the one their id was allocated on (see app/services/shards.py).
+
+    Only trips moved by `flask rebalance-shards` have a row; every other trip is found from its id alone.
+    """
+    __tablename__ = "trip_shard"
+
+    trip_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.String(10), nullable=False)
+
+    def __repr__(self):
+        return f"<TripShard {self.trip_id} -> {self.shard}>"
+
+#==========================================================================================================
+
+# R*Tree spatial indexes over the optional coordinates (bounding-box and nearest queries, see app/services/geo.py)
+geo.attach_spatial_index(FavoriteDestination)
+geo.attach_spatial_index(ItineraryItem)
+
+# FTS5 indexes behind the trip search (see app/services/search.py)
+search.attach(db.metadata)
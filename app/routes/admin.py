@@ -0,0 +1,130 @@
+import os
+import tempfile
+import time
+from flask import Blueprint, Response, abort, current_app, flash, jsonify, redirect, render_template, request, session
+from flask import url_for
+from app.services import profiling, tracing
+from app.services.profiling import profiler
+from app.services.tracing import tracer
+
+admin_bp = Blueprint("admin", __name__, url_prefix="/admin")
+
+TRACES_SHOWN = 10
+TRACES_SCANNED = 500
+
+#==========================================================================================================
+
+# Operator pages, for the accounts listed in ADMIN_EMAILS. Everyone else gets a 404, not a 403: the pages
+# are not advertised.
+@admin_bp.before_request
+def require_admin():
+    email = (session.get("user_email") or "").lower()
+    if "user_id" not in session or email not in current_app.config["ADMIN_EMAILS"]:
+        abort(404)
+
+#==========================================================================================================
+
+# The slowest of the recently traced requests, each as an icicle chart (children under their parent, width
+# proportional to time), and where the time went across all of them. ?route= narrows to one endpoint.
+@admin_bp.route("/traces")
+def traces():
+    documents = tracer.recent_traces(limit=TRACES_SCANNED)
+    route = request.args.get("route")
+    if route:
+        documents = [document for document in documents
+                     if any(span["attributes"].get("http.route") == route for span in tracing.spans_of(document))]
+
+    charts = sorted((tracing.flame(document) for document in documents), key=lambda chart: chart[0], reverse=True)
+    return render_template("admin_traces.html", charts=charts[:TRACES_SHOWN], scanned=len(documents),
+                           route=route, totals=tracing.self_time_by_name(documents)[:25],
+                           sample_rate=tracer.sample_rate, trust_traceparent=tracer.trust_traceparent,
+                           trace_file=tracer.file)
+
+#==========================================================================================================
+
+# On-demand profiling of the worker that serves the request (its pid is on every page and artifact).
+@admin_bp.route("/profile")
+def profile():
+    return render_template("admin_profile.html", pid=os.getpid(), tracing_memory=profiler.tracing_memory,
+                           max_seconds=profiler.max_seconds, memory_max_seconds=profiler.memory_max_seconds)
+
+#==========================================================================================================
+
+# Samples the worker's other threads for ?seconds= and returns folded stacks, e.g. for
+# `curl -b session=... /admin/profile/cpu?seconds=20 > cpu.folded && flamegraph.pl cpu.folded > cpu.svg`.
+# ?idle=1 keeps the stacks of threads that are only waiting.
+@admin_bp.route("/profile/cpu")
+def profile_cpu():
+    seconds = request.args.get("seconds", 10, type=float)
+    if seconds <= 0:
+        return jsonify({"error": "Invalid seconds"}), 400
+    try:
+        stacks, samples = profiler.cpu(seconds, include_idle=request.args.get("idle", type=int) == 1)
+    except profiling.ProfilerBusy as e:
+        return jsonify({"error": str(e)}), 409
+    return _artifact(stacks, "text/plain", "cpu", "folded", {"X-Profile-Samples": str(samples)})
+
+#==========================================================================================================
+
+@admin_bp.route("/profile/memory/start", methods=["POST"])
+def start_memory_profile():
+    try:
+        profiler.start_memory(request.form.get("seconds", 60, type=float))
+        flash(f"Tracing allocations in worker {os.getpid()}.", "info")
+    except profiling.ProfilerBusy as e:
+        flash(str(e), "warning")
+    return redirect(url_for("admin.profile"))
+
+
+@admin_bp.route("/profile/memory/stop", methods=["POST"])
+def stop_memory_profile():
+    profiler.stop_memory()
+    flash(f"Stopped tracing allocations in worker {os.getpid()}.", "info")
+    return redirect(url_for("admin.profile"))
+
+#==========================================================================================================
+
+# What was allocated since tracing started and is still alive, by line (?key=traceback for whole stacks).
+@admin_bp.route("/profile/memory/diff")
+def memory_diff():
+    key_type = request.args.get("key", "lineno")
+    if key_type not in ("lineno", "filename", "traceback"):
+        return jsonify({"error": "Invalid key"}), 400
+    report = profiler.memory_diff(key_type, limit=request.args.get("limit", 30, type=int))
+    if report is None:
+        return jsonify({"error": f"No memory trace in worker {os.getpid()}"}), 404
+    return Response(report, mimetype="text/plain")
+
+
+# The latest snapshot, for offline analysis with tracemalloc.Snapshot.load()
+@admin_bp.route("/profile/memory/snapshot")
+def memory_snapshot():
+    snapshot = profiler.snapshot()
+    if snapshot is None:
+        return jsonify({"error": f"No memory trace in worker {os.getpid()}"}), 404
+    with tempfile.NamedTemporaryFile(suffix=".tracemalloc") as fh:
+        snapshot.dump(fh.name)
+        data = fh.read()
+    return _artifact(data, "application/octet-stream", "memory", "tracemalloc")
+
+#==========================================================================================================
+
+# The most numerous live objects, and the SQLAlchemy instances the worker still holds per model.
+@admin_bp.route("/profile/objects")
+def object_populations():
+    limit = min(request.args.get("limit", 30, type=int), 500)
+    return jsonify({
+        "pid": os.getpid(),
+        "objects": [{"type": name, "count": count, "bytes": size}
+                    for name, count, size in profiling.object_counts(limit)],
+        "orm_instances": [{"model": name, "in_session": attached, "detached": detached}
+                          for name, attached, detached in profiling.orm_instances()],
+    })
+
+
+def _artifact(data, mimetype, kind, extension, headers=None):
+    name = f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}"
+    response = Response(data, mimetype=mimetype, headers=headers)
+    response.headers["Content-Disposition"] = f"attachment; filename={name}"
+    response.headers["Cache-Control"] = "no-store"
+    return response
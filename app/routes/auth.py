@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, url_for, flash, request, session, redirect, Flask
+from flask import Blueprint, render_template, url_for, flash, request, session, redirect, Flask, abort
 from app.models import User, PasswordResetToken
 
 auth_bp = Blueprint('auth', __name__)   # create Blueprint for auth routes
@@ -79,7 +79,9 @@ def forgot_password():
 #===================================================================================================================
 @auth_bp.route("/reset_password/<token>", methods=["GET", "POST"])
 def reset_password(token):
-    reset_token = PasswordResetToken.query.filter_by(token=token).first_or_404()
+    reset_token = PasswordResetToken.find(token)
+    if not reset_token:
+        abort(404)
 
     if not reset_token.is_valid():
         flash("Invalid or expired token.", "danger")
@@ -0,0 +1,58 @@
+from flask import Blueprint, render_template, url_for, flash, request, session, redirect, Response, stream_with_context
+from app.models import User
+from app.services import ical
+
+calendar_bp = Blueprint("calendar", __name__)
+
+#==========================================================================================================
+
+# Shows the personal feed URL that calendar apps (Google Calendar, Outlook, Apple Calendar) subscribe to.
+@calendar_bp.route("/calendar")
+def calendar_settings():
+    if "user_id" not in session:
+        flash("Please log in to subscribe to your calendar", "warning")
+        return redirect(url_for("auth.login"))
+
+    user = User.query.get(session["user_id"])
+    feed_url = url_for("calendar.calendar_feed", token=user.get_calendar_token(), _external=True)
+    return render_template("calendar.html", feed_url=feed_url)
+
+#==========================================================================================================
+
+# Replaces the feed token, so any previously shared feed URL stops working.
+@calendar_bp.route("/calendar/reset", methods=["POST"])
+def reset_calendar_token():
+    if "user_id" not in session:
+        return redirect(url_for("auth.login"))
+
+    user = User.query.get(session["user_id"])
+    user.get_calendar_token(reset=True)
+    flash("Your calendar link has been reset. Re-subscribe with the new link.", "info")
+    return redirect(url_for("calendar.calendar_settings"))
+
+#==========================================================================================================
+
+# The feed itself. Calendar clients poll it, so an unchanged feed is answered with 304 after a single
+# aggregate query. Clients that send ?sync=<token> (from the X-Sync-Token header) only get changed entries.
+@calendar_bp.route("/calendar/<string:token>.ics")
+def calendar_feed(token):
+    user = User.query.filter_by(calendar_token=token).first_or_404()
+
+    state = ical.feed_state(user.id)
+    etag = ical.feed_etag(state)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    # Fall back to the full feed if the token is unreadable, rows the client knows about were deleted or the
+    # user joined or left a trip
+    sync = ical.parse_sync_token(request.args.get("sync"))
+    since = sync["since"] if sync and ical.token_is_current(sync, user.id) else None
+
+    response = Response(stream_with_context(ical.generate_feed(user.id, since=since)), mimetype="text/calendar")
+    response.set_etag(etag)
+    response.headers["X-Sync-Token"] = ical.make_sync_token(state, user.id)
+    response.headers["X-Sync-Mode"] = "delta" if since else "full"
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
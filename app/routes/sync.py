@@ -0,0 +1,29 @@
+from flask import Blueprint, request, session, jsonify
+from app.services import sync
+
+sync_bp = Blueprint("sync", __name__)
+
+SYNC_PAGE_SIZE = 500
+SYNC_MAX_PAGE_SIZE = 2000
+
+#==========================================================================================================
+
+# Delta sync for offline clients. Without ?since= the client gets a full snapshot and the sequence number
+# to continue from; with it, only what changed afterwards (compacted, one entry per entity). A client keeps
+# calling with the returned "next" until "has_more" is false. 410 means its position was pruned: resync.
+@sync_bp.route("/sync")
+def sync_changes():
+    if "user_id" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    since = request.args.get("since", type=int)
+    limit = min(request.args.get("limit", SYNC_PAGE_SIZE, type=int), SYNC_MAX_PAGE_SIZE)
+    if since is None:
+        return jsonify(sync.snapshot(session["user_id"]))
+    if since < 0 or limit < 1:
+        return jsonify({"error": "Invalid since or limit"}), 400
+
+    try:
+        return jsonify(sync.changes_since(session["user_id"], since, limit))
+    except sync.ResyncRequired:
+        return jsonify({"error": "Change log position expired, fetch a full snapshot"}), 410
@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, url_for, flash, request, session, redirect
 from app import db
 from datetime import datetime
+from urllib.parse import urlsplit
 from app.models import Task
 
 tasks_bp = Blueprint('tasks', __name__)
@@ -12,8 +13,17 @@ def view_tasks():
         return redirect(url_for('auth.login'))
 
     user_id = session['user_id']        # Get user_id from session
-    tasks = Task.query.filter_by(user_id = user_id).all()   # Filter queries of tasks for the logged-in user
-    return render_template('tasks.html', tasks = tasks)     # Render tasks.html template with user's tasks
+
+    # Optional filters (?status=, ?due_from=, ?due_to=) and the keyset cursor of the next page (?after=)
+    status = request.args.get('status') if request.args.get('status') in Task.STATUSES else None
+    due_from = _parse_date(request.args.get('due_from'))
+    due_to = _parse_date(request.args.get('due_to'))
+    tasks, next_cursor = Task.page(user_id, status=status, due_from=due_from, due_to=due_to,
+                                   cursor=request.args.get('after'))
+
+    filters = {'status': status, 'due_from': due_from, 'due_to': due_to}
+    return render_template('tasks.html', tasks=tasks, next_cursor=next_cursor, filters=filters,
+                           statuses=Task.STATUSES)     # Render tasks.html template with one page of the user's tasks
 
 #==========================================================================================================
 @tasks_bp.route('/add', methods=["POST"])
@@ -82,6 +92,34 @@ def clear_tasks():      # Clear all tasks for the logged-in user
 
 #==========================================================================================================
 
+@tasks_bp.route("/bulk", methods = ['POST'])
+def bulk_tasks():       # Toggle, complete or delete every selected task with one statement
+    if 'user_id' not in session or 'user_email' not in session:    # If user not logged in, redirect to login
+        return redirect(url_for('auth.login'))
+
+    user_id = session['user_id']
+    action = request.form.get('action')
+    task_ids = [int(task_id) for task_id in request.form.getlist('task_ids') if task_id.isdigit()]
+
+    if not task_ids:
+        flash('Select at least one task first', 'info')
+    elif action == 'toggle':
+        flash(f'Updated {Task.bulk_toggle(user_id, task_ids)} tasks', 'success')
+    elif action == 'complete':
+        flash(f'Completed {Task.bulk_set_status(user_id, task_ids, "Done")} tasks', 'success')
+    elif action == 'delete':
+        flash(f'Deleted {Task.bulk_delete(user_id, task_ids)} tasks', 'info')
+    else:
+        flash('Unknown action', 'danger')
+
+    next_url = request.form.get('next', '')     # keep the user's filters and page; only local paths
+    parts = urlsplit(next_url)
+    if parts.scheme or parts.netloc or not next_url.startswith('/') or '\\' in next_url:    # browsers read "/\evil" as "//evil"
+        next_url = url_for('tasks.view_tasks')
+    return redirect(next_url)
+
+#==========================================================================================================
+
 @tasks_bp.route("/delete_task/<int:task_id>", methods = ['POST'])
 def delete_task(task_id):
     if 'user_id' not in session or 'user_email' not in session:    # If user not logged in, redirect to login
@@ -94,4 +132,12 @@ def delete_task(task_id):
     else:
         flash('You are not authorized to delete this task', 'danger')   # Unauthorized attempt to delete task
 
-    return redirect(url_for('tasks.view_tasks'))    # Redirect back to tasks view
\ No newline at end of file
+    return redirect(url_for('tasks.view_tasks'))    # Redirect back to tasks view
+
+#==========================================================================================================
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
@@ -1,10 +1,48 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Response, stream_template, get_flashed_messages, abort, send_file
 from app.models import Trip, ItineraryItem, Expense, User, PlannedBudget, FavoriteDestination, TripDestination
-from werkzeug.security import check_password_hash
+from app.models import user_favorite_destinations, Task, ChecklistTemplate, EditConflict, TripArchive, ExpenseAttachment
+from app.services import passwords, recommendations, geo, archive, shards, search
+from app.services.timeline import valid_duration
+from app.services.changes import TRACKED_MODELS, serialize
+from app.services.events import live_updates
+from app.services.trending import trending, WINDOWS, DEFAULT_WINDOW
+from app.services.attachments import attachments, UnsupportedAttachment
 from datetime import datetime
 
 trips_bp = Blueprint("trips", __name__)
 
+#==========================================================================================================
+
+def stream_page(template_name, **context):
+    """Render a long list page as a stream, so the page head is sent before the item loops finish.
+
+    The template renders after the request's database session is gone: the context must already hold
+    everything it reads (no lazy relationships, nothing expired by a commit).
+    """
+    # Flashed messages must leave the session now: once streaming starts the session cookie is already sent
+    get_flashed_messages(with_categories=True)
+    return Response(stream_template(template_name, **context), mimetype="text/html")
+
+
+def edit_conflict(conflict, template_name, **context):
+    """409 for an edit based on an outdated version, carrying the current state to merge with.
+
+    API clients get the stored row as JSON; the form is rendered again with the stored values (and the new
+    version) next to the values the user submitted.
+    """
+    current = conflict.current
+    kind, fields = TRACKED_MODELS[type(current)]
+    state = serialize(current, fields)
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"error": "conflict", "type": kind, "id": current.id, "current": state}), 409
+
+    submitted = {field: value for field, value in request.form.items()
+                 if field in state and value and value != str(state[field] or "")}
+    flash("Someone else saved this while you were editing. The form now shows their version; "
+          "your changes are listed above it.", "warning")
+    return render_template(template_name, submitted=submitted, **context), 409
+
 #==========================================================================================================
 # TRIPS ROUTES
 #==========================================================================================================
@@ -16,8 +54,36 @@ def view_trips():
         flash("Please log in to view your trips", "warning")
         return redirect(url_for("auth.login"))
 
-    trips = Trip.query.all()
-    return render_template("trips.html", trips=trips)
+    trips = shards.trips_for_user(session["user_id"])
+    archived = User.query.get(session["user_id"]).archived_trips.order_by(TripArchive.end_date.desc()).all()
+    return render_template("trips.html", trips=trips, archived=archived)
+
+#==========================================================================================================
+
+@trips_bp.route("/search")
+def search_trips():
+    """Full-text search over the user's trips, itineraries, expenses and checklists"""
+    if "user_id" not in session:
+        flash("Please log in to search your trips", "warning")
+        return redirect(url_for("auth.login"))
+
+    query = request.args.get("q", "").strip()
+    hits = search.search(session["user_id"], query) if query else []
+    return render_template("search.html", hits=hits, query=query)
+
+
+@trips_bp.route("/api/search")
+def search_trips_api():
+    """API endpoint: ranked hits for ?q=, with the matched words wrapped in <mark>"""
+    if "user_id" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    limit = max(1, min(request.args.get("limit", 20, type=int), 100))
+    hits = search.search(session["user_id"], request.args.get("q", ""), limit=limit)
+    return jsonify({"hits": [
+        {"type": hit.kind, "id": hit.id, "trip_id": hit.trip_id, "title": str(hit.title),
+         "snippet": str(hit.snippet) if hit.snippet is not None else None} for hit in hits
+    ]})
 
 #==========================================================================================================
 
@@ -57,7 +123,9 @@ def create_trip():
         flash(f"Trip '{trip.title}' created successfully!", "success")
         return redirect(url_for("trips.view_trips"))
 
-    return render_template("create_trip.html")
+    user = User.query.get(session["user_id"])
+    suggestions = recommendations.recommend_for_user(user, k=6)
+    return render_template("create_trip.html", suggestions=suggestions)
 
 #==========================================================================================================
 
@@ -73,21 +141,26 @@ def edit_trip(trip_id):
 
     if request.method == "POST":
         title = request.form.get("title")
-        destinations = request.form.getlist("destinations")
+        destinations = [name for value in request.form.getlist("destinations") for name in value.split(",")]
         start_date = request.form.get("start_date")
         end_date = request.form.get("end_date")
         description = request.form.get("description")
+        version = request.form.get("version", type=int)
 
         start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
         end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
 
-        trip.update_details(
-            title=title,
-            destinations=destinations,
-            start_date=start_date,
-            end_date=end_date,
-            description=description
-        )
+        try:
+            trip.update_details(
+                title=title,
+                destinations=destinations,
+                start_date=start_date,
+                end_date=end_date,
+                description=description,
+                version=version
+            )
+        except EditConflict as conflict:
+            return edit_conflict(conflict, "edit_trip.html", trip=conflict.current)
 
         flash("Trip updated successfully!", "success")
         return redirect(url_for("trips.view_trips", trip_id=trip.id))
@@ -122,6 +195,31 @@ def share_trip(trip_id):
 
 #==========================================================================================================
 
+@trips_bp.route("/trip/<int:trip_id>/clone", methods=["POST"])
+def clone_trip(trip_id):
+    """Start a new trip from this one: destinations, itinerary, planned budget and checklist are copied"""
+    trip = Trip.query.get_or_404(trip_id)
+    user_id = session.get("user_id")
+
+    if user_id not in trip.get_participant_ids():
+        flash("You do not have permission to copy this trip.", "danger")
+        return redirect(url_for("trips.view_trips"))
+
+    title = request.form.get("title") or f"{trip.title} (copy)"
+    start_date = request.form.get("start_date")
+    if not start_date:
+        flash("Pick a start date for the new trip", "info")
+        return redirect(url_for("trips.trip_detail", trip_id=trip_id))
+
+    start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+    new_trip_id = trip.clone(title, start_date, User.query.get(user_id),
+                             include_participants=bool(request.form.get("include_participants")))
+
+    flash(f"Trip '{title}' created from '{trip.title}'!", "success")
+    return redirect(url_for("trips.trip_detail", trip_id=new_trip_id))
+
+#==========================================================================================================
+
 @trips_bp.route("/respond_trip_share/<int:trip_id>/<string:response>", methods=["POST"])
 def respond_trip_share(trip_id, response):
     """Respond to a trip share request"""
@@ -163,11 +261,41 @@ def delete_trip(trip_id):
 @trips_bp.route("/trip/<int:trip_id>")
 def trip_detail(trip_id):
     """View detailed information about a trip"""
-    trip = Trip.query.get_or_404(trip_id)
+    trip = Trip.query.get(trip_id)
+    if trip is None:
+        return archived_trip(trip_id)
     user_id = session.get("user_id")
     user = User.query.get(user_id) if user_id else None
-    
-    return render_template("trip_detail.html", trip=trip, user=user)
+    checklist_done, checklist_total = Task.checklist_progress(trip_id)
+
+    return render_template("trip_detail.html", trip=trip, user=user,
+                           checklist_done=checklist_done, checklist_total=checklist_total)
+
+#==========================================================================================================
+
+def archived_trip(trip_id, section=None):
+    """Read-only view of a trip that was moved to the archive (decompressed through an LRU)"""
+    trip = archive.load(trip_id)
+    if trip is None:
+        abort(404)
+    if session.get("user_id") not in trip.get_participant_ids():
+        flash("You do not have permission to view this trip.", "danger")
+        return redirect(url_for("trips.view_trips"))
+    return render_template("archived_trip.html", trip=trip, section=section)
+
+#==========================================================================================================
+
+@trips_bp.route("/trip/<int:trip_id>/events")
+def trip_events(trip_id):
+    """Server-Sent Events stream of changes made to a trip by any participant"""
+    if "user_id" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    trip = Trip.query.get_or_404(trip_id)
+    if session["user_id"] not in trip.get_participant_ids():
+        return jsonify({"error": "Not a participant of this trip"}), 403
+
+    return live_updates.stream(trip_id)
 
 #==========================================================================================================
 
@@ -184,7 +312,7 @@ def delete_user_trips(user_id):
     if request.method == "POST":
         password = request.form.get("password")
 
-        if not check_password_hash(user.password, password):
+        if not passwords.verify_password(user.password, password):
             flash("Incorrect password. Trips not deleted.", "danger")
             return redirect(url_for("trips.delete_user_trips", user_id=user_id))
         
@@ -213,16 +341,22 @@ def add_itinerary(trip_id):
     time = request.form.get("time")
     location = request.form.get("location")
     notes = request.form.get("notes")
+    duration_minutes = request.form.get("duration_minutes", type=int)
 
     if not title or not date:
         flash("Itinerary item must have a title and date", "info")
         return redirect(url_for("trips.trip_detail", trip_id=trip_id))
-    
+    if not valid_duration(duration_minutes):
+        flash("Duration must be between 0 minutes and 31 days", "danger")
+        return redirect(url_for("trips.trip_detail", trip_id=trip_id))
+
     date = datetime.strptime(date, "%Y-%m-%d").date()
     time = datetime.strptime(time, "%H:%M").time() if time else None
-    trip.add_itinerary_item(title, date, location, notes, time)
+    item = trip.add_itinerary_item(title, date, location, notes, time, duration_minutes)
 
     flash("Itinerary item added!", "success")
+    for warning in item.warnings:
+        flash(warning, "warning")
     return redirect(url_for("trips.trip_detail", trip_id=trip_id))
 
 #==========================================================================================================
@@ -243,6 +377,10 @@ def edit_itinerary(item_id):
         time = request.form.get("time")
         location = request.form.get("location")
         notes = request.form.get("notes")
+        duration_minutes = request.form.get("duration_minutes", 0, type=int)
+        if not valid_duration(duration_minutes):
+            flash("Duration must be between 0 minutes and 31 days", "danger")
+            return redirect(url_for("trips.edit_itinerary", item_id=item_id))
 
         if date:
             date = datetime.strptime(date, "%Y-%m-%d").date()
@@ -250,8 +388,14 @@ def edit_itinerary(item_id):
             time = time[:5]
             time = datetime.strptime(time, "%H:%M").time()
 
-        item.update(title=title, date=date, location=location, notes=notes, time=time)
+        try:
+            item.update(title=title, date=date, location=location, notes=notes, time=time,
+                        duration_minutes=duration_minutes, version=request.form.get("version", type=int))
+        except EditConflict as conflict:
+            return edit_conflict(conflict, "edit_itinerary.html", item=conflict.current, trip=conflict.current.trip)
         flash("Itinerary item updated!", "success")
+        for warning in item.warnings:
+            flash(warning, "warning")
         return redirect(url_for("trips.all_itineraries", trip_id=item.trip_id))
     
     trip = item.trip
@@ -277,7 +421,121 @@ def delete_itinerary(item_id):
 @trips_bp.route('/trip/<int:trip_id>/itineraries')
 def all_itineraries(trip_id):
     trip = Trip.query.get_or_404(trip_id)
-    return render_template('all_itineraries.html', trip=trip)
+    timeline = trip.get_timeline()
+    overlapping_ids = {item.id for pair in timeline.overlaps for item in pair}
+    routes = trip.suggest_routes(timeline)
+    return stream_page('all_itineraries.html', trip=trip, timeline=timeline, overlapping_ids=overlapping_ids,
+                       routes=routes)
+
+#==========================================================================================================
+# CHECKLIST ROUTES
+#==========================================================================================================
+
+@trips_bp.route("/trip/<int:trip_id>/checklist")
+def trip_checklist(trip_id):
+    """The trip's checklist, shared by every participant"""
+    trip = Trip.query.get_or_404(trip_id)
+    user_id = session.get("user_id")
+
+    if user_id not in trip.get_participant_ids():
+        flash("You do not have permission to view this checklist.", "danger")
+        return redirect(url_for("trips.view_trips"))
+
+    return render_template("trip_checklist.html", trip=trip, tasks=Task.checklist(trip_id),
+                           templates=ChecklistTemplate.available_to(user_id))
+
+#==========================================================================================================
+
+@trips_bp.route("/trip/<int:trip_id>/checklist/add", methods=["POST"])
+def add_checklist_task(trip_id):
+    """Add an item to the trip's checklist"""
+    trip = Trip.query.get_or_404(trip_id)
+    user_id = session.get("user_id")
+
+    if user_id not in trip.get_participant_ids():
+        flash("You do not have permission to edit this checklist.", "danger")
+        return redirect(url_for("trips.view_trips"))
+
+    title = request.form.get("title")
+    due_date = request.form.get("due_date")
+    due_time = request.form.get("due_time")
+
+    if not title:
+        flash("Checklist item must have a title", "info")
+        return redirect(url_for("trips.trip_checklist", trip_id=trip_id))
+
+    due_date = datetime.strptime(due_date, "%Y-%m-%d").date() if due_date else None
+    due_time = datetime.strptime(due_time, "%H:%M").time() if due_time else None
+    Task.create(title=title, user_id=user_id, due_date=due_date, due_time=due_time, trip_id=trip_id)
+    flash("Checklist item added!", "success")
+    return redirect(url_for("trips.trip_checklist", trip_id=trip_id))
+
+#==========================================================================================================
+
+@trips_bp.route("/trip/<int:trip_id>/checklist/<int:task_id>/toggle", methods=["POST"])
+def toggle_checklist_task(trip_id, task_id):
+    """Advance a checklist item's status; any participant may do so"""
+    task = Task.query.filter_by(id=task_id, trip_id=trip_id).first_or_404()
+
+    if session.get("user_id") in task.trip.get_participant_ids():
+        task.toggle_status()
+    return redirect(url_for("trips.trip_checklist", trip_id=trip_id))
+
+#==========================================================================================================
+
+@trips_bp.route("/trip/<int:trip_id>/checklist/<int:task_id>/delete", methods=["POST"])
+def delete_checklist_task(trip_id, task_id):
+    """Remove an item from the trip's checklist"""
+    task = Task.query.filter_by(id=task_id, trip_id=trip_id).first_or_404()
+
+    if session.get("user_id") not in task.trip.get_participant_ids():
+        flash("You do not have permission to edit this checklist.", "danger")
+        return redirect(url_for("trips.view_trips"))
+
+    task.delete()
+    flash("Checklist item deleted!", "info")
+    return redirect(url_for("trips.trip_checklist", trip_id=trip_id))
+
+#==========================================================================================================
+
+@trips_bp.route("/trip/<int:trip_id>/checklist/apply_template", methods=["POST"])
+def apply_checklist_template(trip_id):
+    """Copy a checklist template into the trip"""
+    trip = Trip.query.get_or_404(trip_id)
+    user_id = session.get("user_id")
+
+    if user_id not in trip.get_participant_ids():
+        flash("You do not have permission to edit this checklist.", "danger")
+        return redirect(url_for("trips.view_trips"))
+
+    template = ChecklistTemplate.query.get(request.form.get("template_id", type=int) or 0)
+    if not template or template.user_id not in (None, user_id):
+        flash("Checklist template not found.", "danger")
+        return redirect(url_for("trips.trip_checklist", trip_id=trip_id))
+
+    added = trip.apply_checklist_template(template, user_id)
+    flash(f"Added {added} items from {template.name}!", "success")
+    return redirect(url_for("trips.trip_checklist", trip_id=trip_id))
+
+#==========================================================================================================
+
+@trips_bp.route("/trip/<int:trip_id>/checklist/save_template", methods=["POST"])
+def save_checklist_template(trip_id):
+    """Save the trip's checklist as one of the user's templates"""
+    trip = Trip.query.get_or_404(trip_id)
+    user_id = session.get("user_id")
+
+    if user_id not in trip.get_participant_ids():
+        flash("You do not have permission to view this checklist.", "danger")
+        return redirect(url_for("trips.view_trips"))
+
+    name = (request.form.get("name") or "").strip()
+    if not name:
+        flash("Give the template a name", "info")
+    else:
+        ChecklistTemplate.from_trip(name[:100], trip, user_id)
+        flash(f"Saved checklist as template {name[:100]}!", "success")
+    return redirect(url_for("trips.trip_checklist", trip_id=trip_id))
 
 #==========================================================================================================
 # BUDGET ROUTES
@@ -286,7 +544,9 @@ def all_itineraries(trip_id):
 @trips_bp.route("/trip/<int:trip_id>/budget", methods=["GET", "POST"])
 def trip_budget(trip_id):
     """View and manage trip budget"""
-    trip = Trip.query.get_or_404(trip_id)
+    trip = Trip.query.get(trip_id)
+    if trip is None:
+        return archived_trip(trip_id, section="budget")
 
     if not trip.budget:
         trip.init_budget()
@@ -312,7 +572,7 @@ def trip_budget(trip_id):
         flash("Expense added successfully!", "success")
         return redirect(url_for("trips.trip_budget", trip_id=trip_id))
 
-    return render_template("budget.html", trip=trip)
+    return stream_page("budget.html", trip=Trip.with_budget(trip_id))
 
 #==========================================================================================================
 
@@ -408,7 +668,11 @@ def edit_expense(expense_id):
             flash("Invalid expense amount", "danger")
             return redirect(url_for("trips.trip_budget", trip_id=expense.budget.trip_id))
     
-        expense.update_details(amount=amount, description=description, shared_friends=users, category=category)
+        try:
+            expense.update_details(amount=amount, description=description, shared_friends=users, category=category,
+                                   version=request.form.get("version", type=int))
+        except EditConflict as conflict:
+            return edit_conflict(conflict, "edit_expense.html", expense=conflict.current)
 
         flash("Expense updated successfully!", "success")
         return redirect(url_for("trips.trip_budget", trip_id=expense.budget.trip_id))
@@ -447,6 +711,73 @@ def leave_expense(expense_id):
 
 #==========================================================================================================
 
+@trips_bp.route("/expense/<int:expense_id>/attachments", methods=["POST"])
+def upload_expense_attachment(expense_id):
+    """Attach receipts to an expense; the files stream to disk instead of being read into memory"""
+    expense = Expense.query.get_or_404(expense_id)
+    if session.get("user_id") not in expense.budget.trip.get_participant_ids():
+        abort(403)
+
+    try:
+        stored = attachments.receive(request)
+    except UnsupportedAttachment as error:
+        flash(f"{error}: receipts must be JPEG, PNG, WebP or PDF files.", "danger")
+        return redirect(url_for("trips.edit_expense", expense_id=expense_id))
+
+    if stored:
+        ExpenseAttachment.add_all(expense, stored, session["user_id"])
+        flash(f"{len(stored)} receipt{'s' if len(stored) > 1 else ''} attached.", "success")
+    else:
+        flash("Choose a file to attach.", "info")
+    return redirect(url_for("trips.edit_expense", expense_id=expense_id))
+
+#==========================================================================================================
+
+@trips_bp.route("/attachment/<int:attachment_id>")
+@trips_bp.route("/attachment/<int:attachment_id>/thumbnail", endpoint="expense_attachment_thumbnail",
+                defaults={"thumbnail": True})
+def expense_attachment(attachment_id, thumbnail=False):
+    """Serve a receipt. Range requests and conditional GETs are answered by send_file from the file on disk."""
+    attachment = ExpenseAttachment.query.get_or_404(attachment_id)
+    if session.get("user_id") not in attachment.expense.budget.trip.get_participant_ids():
+        abort(404)
+
+    path, mimetype, etag = attachments.path(attachment.sha256), attachment.content_type, attachment.sha256
+    final = True
+    if thumbnail:
+        thumbnail_path = attachments.thumbnail_path(attachment.sha256)
+        if thumbnail_path:
+            path, mimetype, etag = thumbnail_path, "image/webp", f"{etag}-thumb"
+        else:
+            # Until the thumbnail is made (or without Pillow, or for a PDF) the original stands in for it,
+            # so this answer must not be cached for good
+            final = False
+
+    # Content-addressed: the original, and a thumbnail once made, never change behind their URL
+    response = send_file(path, mimetype=mimetype, download_name=attachment.filename, conditional=True,
+                         etag=etag, max_age=31536000 if final else 60)
+    response.cache_control.private = True
+    response.cache_control.public = False
+    response.cache_control.immutable = final or None
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
+
+#==========================================================================================================
+
+@trips_bp.route("/attachment/<int:attachment_id>/delete", methods=["POST"])
+def delete_expense_attachment(attachment_id):
+    """Detach a receipt; the stored file goes once nothing references it (flask purge-attachments)"""
+    attachment = ExpenseAttachment.query.get_or_404(attachment_id)
+    expense_id = attachment.expense_id
+    if session.get("user_id") not in attachment.expense.budget.trip.get_participant_ids():
+        abort(403)
+
+    attachment.delete()
+    flash("Receipt removed.", "info")
+    return redirect(url_for("trips.edit_expense", expense_id=expense_id))
+
+#==========================================================================================================
+
 @trips_bp.route("/share_expense/<int:expense_id>", methods=["POST"])
 def share_expense(expense_id):
     """Share an expense with another user"""
@@ -492,8 +823,22 @@ def view_favorites():
 
     user = User.query.get(session["user_id"])
     favorites = user.get_favorite_destinations()
-    
-    return render_template("favorites.html", favorites=favorites)
+    recommended = recommendations.recommend_for_user(user)
+    similar = recommendations.similar_for_each([destination.id for destination in favorites])
+
+    # ?near=<destination id>: the user's favorites ordered by distance from that destination
+    near, distances = None, {}
+    near_id = request.args.get("near", type=int)
+    if near_id:
+        near = FavoriteDestination.query.get_or_404(near_id)
+        if near.locate():
+            ranked = geo.nearest(FavoriteDestination, near.latitude, near.longitude, k=len(favorites),
+                                 query=_user_favorites_query(user), exclude_id=near.id)
+            distances = {destination.id: km for destination, km in ranked}
+            favorites = sorted(favorites, key=lambda d: distances.get(d.id, float("inf")))
+
+    return render_template("favorites.html", favorites=favorites, recommended=recommended, similar=similar,
+                           near=near, distances=distances)
 
 #==========================================================================================================
 
@@ -598,7 +943,7 @@ def toggle_trip_destination_favorite(trip_id, destination_id):
 
     destination.toggle_favorite(user)
 
-    if destination.is_favorited:
+    if destination.is_favorited_by(user):
         flash(f"Added '{destination.name}' to your favorites!", "success")
     else:
         flash(f"Removed '{destination.name}' from your favorites", "info")
@@ -617,6 +962,95 @@ def popular_destinations():
 
 #==========================================================================================================
 
+@trips_bp.route("/api/favorites/nearby")
+def nearby_destinations():
+    """API endpoint: k nearest destinations to ?lat=&lon= (or ?destination_id=); ?mine=1 for own favorites"""
+    if "user_id" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    exclude_id = request.args.get("destination_id", type=int)
+    if exclude_id:
+        origin = FavoriteDestination.query.get_or_404(exclude_id)
+        if not origin.locate():
+            return jsonify({"error": "This destination has no coordinates"}), 404
+        lat, lon = origin.latitude, origin.longitude
+    else:
+        lat, lon = request.args.get("lat", type=float), request.args.get("lon", type=float)
+        if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return jsonify({"error": "lat and lon (or destination_id) are required"}), 400
+
+    k = max(1, min(request.args.get("k", 5, type=int), 100))
+    if request.args.get("mine"):
+        query = _user_favorites_query(User.query.get(session["user_id"]))
+    else:
+        query = FavoriteDestination.public()
+    ranked = geo.nearest(FavoriteDestination, lat, lon, k=k, query=query, exclude_id=exclude_id)
+
+    return jsonify({"destinations": [
+        {"id": d.id, "name": d.name, "country": d.country, "latitude": d.latitude, "longitude": d.longitude,
+         "distance_km": round(km, 1)} for d, km in ranked
+    ]})
+
+#==========================================================================================================
+
+@trips_bp.route("/api/favorites/within")
+def destinations_within():
+    """API endpoint: destinations inside ?bbox=min_lat,min_lon,max_lat,max_lon; ?mine=1 for own favorites"""
+    if "user_id" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    try:
+        min_lat, min_lon, max_lat, max_lon = (float(value) for value in request.args.get("bbox", "").split(","))
+    except ValueError:
+        return jsonify({"error": "bbox must be min_lat,min_lon,max_lat,max_lon"}), 400
+
+    if request.args.get("mine"):
+        query = _user_favorites_query(User.query.get(session["user_id"]))
+    else:
+        query = FavoriteDestination.public()
+    destinations = geo.within_box(FavoriteDestination, min_lat, min_lon, max_lat, max_lon, query=query)
+
+    return jsonify({"destinations": [
+        {"id": d.id, "name": d.name, "country": d.country, "latitude": d.latitude, "longitude": d.longitude}
+        for d in destinations
+    ]})
+
+
+def _user_favorites_query(user):
+    return FavoriteDestination.query.join(
+        user_favorite_destinations, user_favorite_destinations.c.destination_id == FavoriteDestination.id
+    ).filter(user_favorite_destinations.c.user_id == user.id)
+
+#==========================================================================================================
+
+@trips_bp.route("/favorites/trending")
+def trending_destinations():
+    """Destinations gaining favorites and trips recently (?window=day|week|month)"""
+    window = request.args.get("window", DEFAULT_WINDOW)
+    if window not in WINDOWS:
+        window = DEFAULT_WINDOW
+    limit = min(request.args.get("limit", 10, type=int), 100)
+    destinations = trending.top(window=window, limit=limit)
+
+    return render_template("trending_destinations.html", destinations=destinations, window=window, windows=WINDOWS)
+
+#==========================================================================================================
+
+@trips_bp.route("/api/favorites/trending")
+def trending_api():
+    """API endpoint returning the top trending destinations for a window"""
+    window = request.args.get("window", DEFAULT_WINDOW)
+    if window not in WINDOWS:
+        return jsonify({"error": f"window must be one of: {', '.join(WINDOWS)}"}), 400
+    limit = min(request.args.get("limit", 10, type=int), 100)
+
+    return jsonify({
+        "window": window,
+        "destinations": [{"name": name, "score": round(score, 3)} for name, score in trending.top(window, limit)],
+    })
+
+#==========================================================================================================
+
 @trips_bp.route("/favorites/search")
 def search_favorites():
     """Search for destinations"""
@@ -682,9 +1116,7 @@ def add_destination_from_favorites(trip_id):
     favorite_destination = FavoriteDestination.query.get_or_404(destination_id)
 
     # Check if destination already exists in trip
-    existing = any(d.name.lower() == favorite_destination.name.lower() for d in trip.destinations)
-    
-    if existing:
+    if trip.has_destination(favorite_destination.id):
         flash(f"'{favorite_destination.name}' is already in this trip!", "info")
     else:
         trip.add_destination(favorite_destination.name)
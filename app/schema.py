@@ -0,0 +1,93 @@
+import zlib
+from sqlalchemy import inspect, text
+from app import db
+from app.services import search, shards
+
+#==========================================================================================================
+
+# Boot-time fast path. The schema described by the models is fingerprinted and the fingerprint is kept in
+# SQLite's PRAGMA user_version. When they match, the database is already up to date and startup costs one
+# PRAGMA read instead of create_all() inspecting every table.
+# Trip shards (TRIP_SHARDS > 0) carry their own fingerprint and are prepared the same way.
+def prepare_database():
+    version = schema_version()
+    changed = False
+    if _user_version(db.engine) != version:
+        db.create_all()
+        upgrade_schema()
+        _set_user_version(db.engine, version)
+        changed = True
+
+    if shards.router.enabled:
+        changed = bool(shards.prepare_global_trip_tables()) or changed
+        for shard in shards.router.trip_shards():
+            engine = shards.router.engine(shard)
+            if _user_version(engine) != version:
+                shards.create_shard(shard, upgrade_schema)
+                _set_user_version(engine, version)
+                changed = True
+    return changed
+
+
+def _user_version(engine):
+    with engine.connect() as conn:
+        return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def _set_user_version(engine, version):
+    with engine.begin() as conn:
+        conn.execute(text(f"PRAGMA user_version = {version}"))
+
+
+def schema_version():
+    """Stable 31-bit fingerprint of every table, column and index declared by the models, and the search indexes"""
+    parts = []
+    for table in db.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{col.name}:{col.type!r}:{col.nullable}" for col in table.columns)
+        parts.extend(sorted(f"ix:{ix.name}" for ix in table.indexes))
+    # Full-text indexes are created next to the tables (app/services/search.py)
+    parts.extend(f"fts:{name}:{','.join(columns)}" for name, (_, columns, _) in search.INDEXES.items())
+    return zlib.crc32("|".join(parts).encode()) & 0x7FFFFFFF
+
+#==========================================================================================================
+
+# db.create_all() only creates missing tables, it never touches tables that already exist.
+# upgrade_schema() fills that gap for our SQLite database: it adds any column or index that was
+# added to a model after the table was first created, so an existing todo.db keeps working.
+def upgrade_schema(engine=None, metadata=None):
+    engine = engine or db.engine
+    metadata = metadata or db.metadata
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+
+            existing_columns = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    conn.execute(text(_add_column_sql(table, column, engine)))
+
+            existing_indexes = {ix["name"] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn, checkfirst=True)
+
+#==========================================================================================================
+
+def _add_column_sql(table, column, engine):
+    """Build an ALTER TABLE statement for a column missing from an existing table"""
+    column_type = column.type.compile(dialect=engine.dialect)
+    sql = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+
+    # SQLite only allows NOT NULL on an added column when it also has a default value
+    if column.server_default is not None:
+        default = column.server_default.arg
+        default = default.text if hasattr(default, "text") else f"'{default}'"
+        sql += f" DEFAULT {default}"
+        if not column.nullable:
+            sql += " NOT NULL"
+    return sql
@@ -0,0 +1,172 @@
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime, time
+from types import SimpleNamespace
+from app import db
+from app.services import shards
+from app.services.metrics import metrics
+
+ARCHIVE_FORMAT = 1
+CACHE_SIZE = 64         # archived trips kept decompressed
+
+# Finished trips leave the hot tables (trip, itinerary_item, budget, expense, ...) for trip_archive, one
+# compressed JSON document each, so scans and indexes over live data stop growing with history. Reads go
+# through load(), which decompresses on first use and keeps recently opened trips in an LRU.
+
+#==========================================================================================================
+# LRU CACHE
+#==========================================================================================================
+
+class _LRU:
+    def __init__(self, size=CACHE_SIZE):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = size
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = _LRU()
+
+#==========================================================================================================
+# ARCHIVING
+#==========================================================================================================
+
+def archive_trips(before, batch_size=50):
+    """Move trips that ended before `before` into the archive, one transaction per batch; returns the count.
+
+    The newest trip id is never archived: SQLite may hand the highest rowid out again once it is deleted,
+    and an archived trip must keep its id. Archived trips leave the sync feed (clients receive a delete).
+    With trip shards, each shard is archived in turn.
+    """
+    archived = 0
+    for shard in shards.router.shards():
+        with shards.pinned(shard):
+            archived += _archive_shard(before, batch_size)
+    return archived
+
+
+def _archive_shard(before, batch_size):
+    from app.models import Trip, TripArchive
+
+    newest = db.session.query(db.func.max(Trip.id)).scalar()
+    archived = 0
+    while newest is not None:
+        batch = Trip.query.filter(Trip.end_date < before, Trip.id < newest).order_by(Trip.id).limit(batch_size).all()
+        if not batch:
+            break
+        for trip in batch:
+            db.session.add(TripArchive(
+                trip_id=trip.id, title=trip.title, start_date=trip.start_date, end_date=trip.end_date,
+                payload=zlib.compress(json.dumps(_document(trip), default=_json_default).encode(), 9),
+                participants=list(trip.participants),
+            ))
+            db.session.delete(trip)     # children go through the relationship cascades
+        db.session.commit()
+        archived += len(batch)
+    return archived
+
+
+def _document(trip):
+    budget = trip.budget
+    return {
+        "format": ARCHIVE_FORMAT,
+        "trip": _row(trip),
+        "participants": [{"id": user.id, "username": user.username} for user in trip.participants],
+        "destinations": [_row(dest) for dest in trip.destinations],
+        "itinerary": [_row(item) for item in trip.itinerary],
+        "budget": _row(budget) if budget else None,
+        "planned_budgets": [_row(planned) for planned in budget.planned_budgets] if budget else [],
+        "expenses": [dict(_row(expense), shared_user_ids=[user.id for user in expense.shared_users],
+                          attachments=[_row(attachment) for attachment in expense.attachments])
+                     for expense in budget.expenses] if budget else [],
+        "reviews": [_row(review) for review in trip.reviews],
+        "tasks": [_row(task) for task in trip.tasks],
+    }
+
+
+def attachment_hashes():
+    """Receipt files (SHA-256) referenced from archived trips; the attachment rows left with the trip"""
+    from app.models import TripArchive
+    hashes = set()
+    for payload, in db.session.query(TripArchive.payload).yield_per(100):
+        document = json.loads(zlib.decompress(payload))
+        hashes.update(attachment["sha256"] for expense in document["expenses"]
+                      for attachment in expense.get("attachments", ()))
+    return hashes
+
+
+def _row(obj):
+    return {column.key: getattr(obj, column.key) for column in obj.__mapper__.column_attrs}
+
+
+def _json_default(value):
+    if isinstance(value, (date, time, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+#==========================================================================================================
+# READ-THROUGH
+#==========================================================================================================
+
+def load(trip_id):
+    """Read-only ArchivedTrip for an archived trip id, or None when there is no such archive"""
+    cached = _cache.get(trip_id)
+    metrics.cache_lookup("archived_trips", hits=cached is not None, misses=cached is None)
+    if cached is not None:
+        return cached
+
+    from app.models import TripArchive
+    payload = db.session.query(TripArchive.payload).filter_by(trip_id=trip_id).scalar()
+    if payload is None:
+        return None
+    trip = ArchivedTrip(json.loads(zlib.decompress(payload)))
+    _cache.put(trip_id, trip)
+    return trip
+
+
+class ArchivedTrip:
+    """An archived trip shaped like the Trip attributes the read-only views use"""
+
+    archived = True
+
+    def __init__(self, document):
+        trip = document["trip"]
+        self.id = trip["id"]
+        self.title = trip["title"]
+        self.start_date = trip["start_date"]
+        self.end_date = trip["end_date"]
+        self.description = trip["description"]
+        self.participants = [SimpleNamespace(**user) for user in document["participants"]]
+        self.destinations = [SimpleNamespace(**dest) for dest in document["destinations"]]
+        self.itinerary = [SimpleNamespace(**item) for item in document["itinerary"]]
+        self.reviews = [SimpleNamespace(**review) for review in document["reviews"]]
+        self.tasks = [SimpleNamespace(**task) for task in document["tasks"]]
+
+        self.budget = None
+        if document["budget"]:
+            self.budget = SimpleNamespace(**document["budget"])
+            self.budget.planned_budgets = [SimpleNamespace(**planned) for planned in document["planned_budgets"]]
+            self.budget.expenses = [SimpleNamespace(**expense) for expense in document["expenses"]]
+            self.budget.remaining = self.budget.total_planned - self.budget.total_spent
+
+    def get_participant_ids(self):
+        return [user.id for user in self.participants]
@@ -0,0 +1,252 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser
+
+try:
+    from PIL import Image
+except ImportError:         # Pillow is optional: without it receipts are stored and served, just not thumbnailed
+    Image = None
+
+# Receipts are stored once per content: the file name is the SHA-256 of the bytes (<root>/ab/cd/<sha256>).
+# Uploads stream from the request straight into a temp file in the store, hashed on the way, so a large
+# receipt never sits in worker memory and is written to disk exactly once. A file that is already stored
+# (the same receipt attached twice, or by two participants) costs only the hash: the temp file is dropped.
+# Thumbnails are made in a small process pool after the response is sent.
+
+# Leading bytes of the accepted types; the client's Content-Type is never trusted
+SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"%PDF-", "application/pdf"),
+)
+THUMBNAIL_TYPES = {"image/jpeg", "image/png", "image/webp"}
+FORM_MEMORY_SIZE = 500 * 1024     # text fields and parser buffer; file parts go to disk
+MAX_FILES_PER_UPLOAD = 10
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+#==========================================================================================================
+
+class UnsupportedAttachment(ValueError):
+    """The upload is not one of the accepted receipt types"""
+
+
+def sniff_type(head):
+    """MIME type from a file's first bytes, or None"""
+    for signature, mimetype in SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+#==========================================================================================================
+# UPLOAD STREAM
+#==========================================================================================================
+
+class _HashingFile:
+    """Temp file the form parser writes an uploaded part into, hashing and counting the bytes as they pass"""
+
+    def __init__(self, folder, max_size):
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix="upload-")
+        self._file = os.fdopen(fd, "w+b")
+        self._hash = hashlib.sha256()
+        self._max_size = max_size
+        self.size = 0
+        self.head = b""
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self._max_size:
+            raise RequestEntityTooLarge()
+        if len(self.head) < 16:
+            self.head += bytes(data[:16 - len(self.head)])
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+#==========================================================================================================
+# STORE
+#==========================================================================================================
+
+class AttachmentStore:
+    """Content-addressed file store for expense receipts"""
+
+    def __init__(self, app=None):
+        self.root = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ATTACHMENT_FOLDER", os.path.join(app.instance_path, "attachments"))
+        app.config.setdefault("ATTACHMENT_MAX_SIZE", 10 * 1024 * 1024)
+        app.config.setdefault("ATTACHMENT_THUMBNAIL_SIZE", 320)
+        app.config.setdefault("ATTACHMENT_THUMBNAIL_WORKERS", 1)
+
+        self.root = app.config["ATTACHMENT_FOLDER"]
+        self.max_size = app.config["ATTACHMENT_MAX_SIZE"]
+        self.thumbnail_size = app.config["ATTACHMENT_THUMBNAIL_SIZE"]
+        self.thumbnail_workers = app.config["ATTACHMENT_THUMBNAIL_WORKERS"]
+        for folder in ("tmp", "thumbs"):
+            os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+        app.extensions["attachments"] = self
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def thumbnail_path(self, sha256):
+        """Path of the blob's thumbnail, or None while it is not (or cannot be) made"""
+        path = os.path.join(self.root, "thumbs", sha256[:2], f"{sha256}.webp")
+        return path if os.path.exists(path) else None
+
+    def receive(self, request, field="file"):
+        """Stream the multipart upload in `field` into the store.
+
+        Returns [(sha256, size, content type, client filename), ...] for each non-empty file in the field.
+        Raises UnsupportedAttachment for other types, RequestEntityTooLarge above ATTACHMENT_MAX_SIZE.
+        """
+        written = []
+
+        def stream_factory(total_content_length, content_type, filename, content_length=None):
+            part = _HashingFile(os.path.join(self.root, "tmp"), self.max_size)
+            written.append(part)
+            return part
+
+        # A request may carry several files plus small form fields; only the fields (and the parser's 64 KiB
+        # read buffer) are held in memory
+        parser = FormDataParser(stream_factory=stream_factory, max_form_memory_size=FORM_MEMORY_SIZE,
+                                max_content_length=self.max_size * MAX_FILES_PER_UPLOAD + FORM_MEMORY_SIZE)
+        try:
+            _, _, files = parser.parse(request.stream, request.mimetype, request.content_length,
+                                       request.mimetype_params)
+            stored = []
+            for upload in files.getlist(field):
+                part = upload.stream
+                if not upload.filename or part.size == 0:
+                    continue
+                content_type = sniff_type(part.head)
+                if content_type is None:
+                    raise UnsupportedAttachment(upload.filename)
+                part.close()
+                self._keep(part)
+                stored.append((part.sha256, part.size, content_type, os.path.basename(upload.filename)[:200]))
+            return stored
+        finally:
+            for part in written:
+                part.discard()          # no-op for parts moved into the store
+
+    def _keep(self, part):
+        target = self.path(part.sha256)
+        if os.path.exists(target):
+            os.utime(target)            # already stored; refresh it so a concurrent purge leaves it alone
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(part.path, target)   # atomic: readers see the whole file or none
+        self._schedule_thumbnail(part.sha256, sniff_type(part.head))
+
+    def _schedule_thumbnail(self, sha256, content_type):
+        if Image is None or content_type not in THUMBNAIL_TYPES:
+            return
+        target = os.path.join(self.root, "thumbs", sha256[:2], f"{sha256}.webp")
+        pool = self._get_pool()
+        if pool is None:
+            make_thumbnail(self.path(sha256), target, self.thumbnail_size)
+        else:
+            pool.submit(make_thumbnail, self.path(sha256), target, self.thumbnail_size)     # fire and forget
+
+    def _get_pool(self):
+        global _pool, _pool_pid
+        if self.thumbnail_workers <= 0:
+            return None
+        with _pool_lock:
+            # A pool inherited through fork() belongs to the parent process, so each worker builds its own
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ProcessPoolExecutor(max_workers=self.thumbnail_workers)
+                _pool_pid = os.getpid()
+        return _pool
+
+    def purge(self, referenced, grace_seconds=3600):
+        """Delete stored files (and thumbnails) whose hash is not in `referenced`; returns the count.
+
+        Files touched within the grace period are kept: their upload may not have committed its row yet.
+        """
+        cutoff = time.time() - grace_seconds
+        purged = 0
+        for folder, _, names in os.walk(self.root):
+            relative = os.path.relpath(folder, self.root)
+            if relative.split(os.sep)[0] in ("tmp", "thumbs"):
+                continue
+            for name in names:
+                path = os.path.join(folder, name)
+                if name in referenced or os.path.getmtime(path) > cutoff:
+                    continue
+                os.remove(path)
+                thumbnail = self.thumbnail_path(name)
+                if thumbnail:
+                    os.remove(thumbnail)
+                purged += 1
+
+        # Temp files left by uploads that died mid-request
+        tmp = os.path.join(self.root, "tmp")
+        for name in os.listdir(tmp):
+            path = os.path.join(tmp, name)
+            if os.path.getmtime(path) <= cutoff:
+                os.remove(path)
+        return purged
+
+#==========================================================================================================
+
+def make_thumbnail(source, target, size):
+    """Write a WebP thumbnail of an image (runs in the thumbnail pool)"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f"{target}.{os.getpid()}.tmp"
+    try:
+        with Image.open(source) as image:
+            image.draft("RGB", (size, size))        # JPEG: decode at reduced scale, not full resolution
+            image.thumbnail((size, size))
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            image.save(partial, "WEBP", quality=80)
+        os.replace(partial, target)
+    except Exception:
+        # A corrupt image just gets no thumbnail; the receipt itself is still served
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def shutdown():
+    """Stop the thumbnail processes (at worker exit)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=True)
+        _pool = None
+
+
+attachments = AttachmentStore()
@@ -0,0 +1,124 @@
+from collections import namedtuple
+from datetime import date, time, datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session, attributes
+from app.models import ChangeLog, Task, Trip, TripDestination, ItineraryItem, Budget, PlannedBudget, Expense
+
+# Models whose changes are tracked: model -> (entity type, fields clients receive)
+TRACKED_MODELS = {
+    Trip: ("trip", ["title", "start_date", "end_date", "description", "version"]),
+    TripDestination: ("destination", ["name"]),
+    ItineraryItem: ("itinerary", ["title", "date", "time", "duration_minutes", "location", "notes", "version"]),
+    Budget: ("budget", ["total_planned", "total_spent", "version"]),
+    PlannedBudget: ("planned_budget", ["category", "amount"]),
+    Expense: ("expense", ["category", "amount", "description", "version"]),
+    Task: ("task", ["title", "due_date", "due_time", "status"]),
+}
+MODELS_BY_TYPE = {kind: (model, fields) for model, (kind, fields) in TRACKED_MODELS.items()}
+
+# A user joining or leaving a trip is logged as a "participant" change (entity_id = the user)
+PARTICIPANT = "participant"
+
+# One flushed change. data holds the tracked fields, read while the object is still loaded.
+Change = namedtuple("Change", "kind op entity_id trip_id user_id data")
+
+#==========================================================================================================
+
+class ChangeFeed:
+    """Capture every change at flush time, write it to the change log in the same transaction, and hand
+    the committed changes to subscribers (live updates)"""
+
+    def __init__(self, app=None):
+        self._subscribers = []
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not self._listening:
+            event.listen(Session, "after_flush", self._collect)
+            event.listen(Session, "after_commit", self._dispatch)
+            event.listen(Session, "after_rollback", self._discard)
+            self._listening = True
+        app.extensions["change_feed"] = self
+
+    def subscribe(self, callback):
+        """callback(changes) runs after each commit that changed tracked data"""
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    #------------------------------------------------------------------------------------------------------
+
+    def _collect(self, session, flush_context):
+        # In after_flush new/dirty/deleted still describe what was just written, and new rows have their ids
+        changes = list(collect(session))
+        if not changes:
+            return
+        # Written through the flush's own connection: the log commits or rolls back with the change itself
+        session.connection().execute(ChangeLog.__table__.insert(), [
+            dict(entity_type=c.kind, entity_id=c.entity_id, op=c.op, trip_id=c.trip_id, user_id=c.user_id)
+            for c in changes
+        ])
+        session.info.setdefault("changes", []).extend(changes)
+
+    def _dispatch(self, session):
+        changes = session.info.pop("changes", [])
+        if changes:
+            for callback in self._subscribers:
+                callback(changes)
+
+    def _discard(self, session):
+        session.info.pop("changes", None)
+
+#==========================================================================================================
+
+def collect(session):
+    """Changes described by the session's pending new/dirty/deleted objects"""
+    for op, objects in (("insert", session.new), ("update", session.dirty), ("delete", session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Trip):
+                yield from _participant_changes(obj, deleted=op == "delete")
+
+            spec = TRACKED_MODELS.get(type(obj))
+            if spec is None:
+                continue
+            if op == "update" and not session.is_modified(obj, include_collections=False):
+                continue
+            kind, fields = spec
+            user_id = obj.user_id if isinstance(obj, Task) else None
+            data = serialize(obj, fields) if op != "delete" else {}
+            yield Change(kind, op, obj.id, _trip_id(session, obj), user_id, data)
+
+
+def serialize(obj, fields):
+    data = {}
+    for field in fields:
+        value = getattr(obj, field)
+        data[field] = value.isoformat() if isinstance(value, (date, time, datetime)) else value
+    return data
+
+
+def _participant_changes(trip, deleted):
+    history = attributes.get_history(trip, "participants")
+    added, removed = history.added or (), history.deleted or ()
+    if deleted:     # every remaining participant loses the trip
+        removed = list(removed) + list(history.unchanged or ())
+        added = ()
+    for user in added:
+        yield Change(PARTICIPANT, "insert", user.id, trip.id, user.id, {"username": user.username})
+    for user in removed:
+        yield Change(PARTICIPANT, "delete", user.id, trip.id, user.id, {})
+
+
+def _trip_id(session, obj):
+    if isinstance(obj, Trip):
+        return obj.id
+    if isinstance(obj, (Expense, PlannedBudget)):
+        with session.no_autoflush:
+            budget = session.get(Budget, obj.budget_id) if obj.budget_id else None
+        return budget.trip_id if budget else None
+    return obj.trip_id
+
+
+# Shared instance, initialised in create_app() before live updates subscribe to it
+change_feed = ChangeFeed()
@@ -0,0 +1,82 @@
+import time
+import zlib
+from flask import request
+
+# Response types worth compressing; images and fonts are already compressed. Server-Sent Events are left out:
+# each event must reach the browser immediately, not wait in the compressor for the next flush.
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/calendar", "text/csv",
+    "application/json", "application/javascript", "image/svg+xml",
+}
+
+#==========================================================================================================
+
+class Compress:
+    """gzip dynamic responses above a size threshold; streamed responses are compressed chunk by chunk"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_LEVEL", 6)
+        app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+        app.config.setdefault("COMPRESS_STREAM_FLUSH_SIZE", 4096)
+        app.config.setdefault("COMPRESS_STREAM_FLUSH_INTERVAL", 0.05)
+
+        self.level = app.config["COMPRESS_LEVEL"]
+        self.min_size = app.config["COMPRESS_MIN_SIZE"]
+        self.flush_size = app.config["COMPRESS_STREAM_FLUSH_SIZE"]
+        self.flush_interval = app.config["COMPRESS_STREAM_FLUSH_INTERVAL"]
+
+        app.after_request(self._compress)
+        app.extensions["compress"] = self
+
+    def _compress(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough           # send_file(): static files handle their own encoding
+                or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or not request.accept_encodings["gzip"]):
+            return response
+
+        response.vary.add("Accept-Encoding")
+
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(gzip_compress(data, self.level))
+
+        response.headers["Content-Encoding"] = "gzip"
+        return response
+
+    def _compress_stream(self, chunks):
+        """Compress an iterable of chunks, flushing often enough that the page head reaches the client early"""
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)    # wbits=31: gzip container
+        pending, last_flush = 0, time.monotonic()
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                output = compressor.compress(chunk)
+                pending += len(chunk)
+
+                now = time.monotonic()
+                if pending >= self.flush_size or now - last_flush >= self.flush_interval:
+                    output += compressor.flush(zlib.Z_SYNC_FLUSH)
+                    pending, last_flush = 0, now
+                if output:
+                    yield output
+            yield compressor.flush()
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+
+def gzip_compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,83 @@
+from sqlalchemy import select, update
+from app import db
+
+#==========================================================================================================
+
+def destination_key(name):
+    """Canonical catalogue key: case- and whitespace-insensitive, so "Paris", "paris " and "PARIS" match"""
+    return " ".join((name or "").lower().split())
+
+#==========================================================================================================
+
+# One-off migration to the destination catalogue. Each batch is its own short transaction, so the writer
+# lock is never held for long and an interrupted run can simply be started again.
+def backfill_catalogue(batch_size=500):
+    """Fill FavoriteDestination.key (merging case/spacing duplicates) and link every TripDestination"""
+    from app.models import FavoriteDestination, TripDestination, DestinationCooccurrence
+
+    keyed, merged, linked = 0, 0, 0
+
+    # 1. Catalogue keys. Rows whose key is already taken are duplicates: move their fans, then drop them.
+    while True:
+        batch = FavoriteDestination.query.filter(FavoriteDestination.key.is_(None)) \
+            .order_by(FavoriteDestination.id).limit(batch_size).all()
+        if not batch:
+            break
+        for destination in batch:
+            key = destination_key(destination.name)
+            canonical = FavoriteDestination.query.filter_by(key=key).first()
+            if canonical is None:
+                destination.key = key
+                db.session.flush()
+                keyed += 1
+            else:
+                _merge_into(destination, canonical)
+                merged += 1
+        db.session.commit()
+
+    # 2. Trip destinations: one catalogue lookup per distinct key in the batch, then one UPDATE per key
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(TripDestination.id, TripDestination.name)
+            .where(TripDestination.destination_id.is_(None), TripDestination.id > last_id)
+            .order_by(TripDestination.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        by_key = {}
+        for row in rows:
+            by_key.setdefault(destination_key(row.name), ([], row.name))[0].append(row.id)
+        for key, (ids, name) in by_key.items():
+            if not key:
+                continue
+            catalogue_id = FavoriteDestination.get_or_create(name).id
+            db.session.execute(
+                update(TripDestination).where(TripDestination.id.in_(ids)).values(destination_id=catalogue_id)
+                .execution_options(synchronize_session=False)
+            )
+            linked += len(ids)
+        db.session.commit()
+
+    if merged:
+        DestinationCooccurrence.query.delete(synchronize_session=False)   # ids changed: rebuild from scratch
+        db.session.commit()
+    return keyed, merged, linked
+
+
+def _merge_into(duplicate, canonical):
+    from app.models import TripDestination, user_favorite_destinations
+
+    fans = user_favorite_destinations
+    already = select(fans.c.user_id).where(fans.c.destination_id == canonical.id)
+    db.session.execute(fans.delete().where(fans.c.destination_id == duplicate.id, fans.c.user_id.in_(already)))
+    db.session.execute(fans.update().where(fans.c.destination_id == duplicate.id)
+                       .values(destination_id=canonical.id))
+    db.session.execute(update(TripDestination).where(TripDestination.destination_id == duplicate.id)
+                       .values(destination_id=canonical.id).execution_options(synchronize_session=False))
+    for field in ("country", "description", "image_url"):
+        if not getattr(canonical, field) and getattr(duplicate, field):
+            setattr(canonical, field, getattr(duplicate, field))
+    db.session.delete(duplicate)
+    db.session.flush()
@@ -0,0 +1,174 @@
+import itertools
+import json
+import queue
+import threading
+import time
+from flask import Response
+from app.services.changes import change_feed
+
+# Change types pushed to trip participants (fields sent are those tracked in app/services/changes.py)
+LIVE_TYPES = {"trip", "destination", "itinerary", "budget", "planned_budget", "expense"}
+
+SUBSCRIBER_QUEUE_SIZE = 100     # events buffered per browser before it is told to reload instead
+BUSY_RETRY_MS = 30000           # reconnect delay sent to browsers turned away while the worker is full
+
+#==========================================================================================================
+# BROKERS
+#==========================================================================================================
+
+class Subscription(queue.Queue):
+    """Events waiting for one connected browser"""
+
+    def __init__(self):
+        super().__init__(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False     # events were dropped; the client has to resync
+
+
+class EventBroker:
+    """In-process pub/sub: one set of subscriber queues per trip"""
+
+    def __init__(self):
+        self._subscribers = {}      # trip_id -> set of Subscription
+        self._lock = threading.Lock()
+
+    def subscribe(self, trip_id):
+        subscription = Subscription()
+        with self._lock:
+            self._subscribers.setdefault(trip_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, trip_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(trip_id, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(trip_id, None)
+
+    def publish(self, trip_id, payload):
+        self._deliver(trip_id, payload)
+
+    def _deliver(self, trip_id, payload):
+        with self._lock:
+            subscribers = list(self._subscribers.get(trip_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(payload)
+            except queue.Full:      # a stalled browser must never block the request that made the change
+                subscription.overflowed = True
+
+
+class RedisEventBroker(EventBroker):
+    """Fan events out across worker processes through Redis pub/sub.
+
+    Each process keeps its own subscriber queues (as EventBroker does) and runs one listener thread that
+    relays messages published by any worker to them.
+    """
+
+    def __init__(self, url, prefix="trip-events:"):
+        super().__init__()
+        import redis    # optional dependency, only needed when EVENTS_BROKER_URL is set
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._listener = None
+
+    def subscribe(self, trip_id):
+        self._ensure_listener()
+        return super().subscribe(trip_id)
+
+    def publish(self, trip_id, payload):
+        self._client.publish(f"{self._prefix}{trip_id}", payload)
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, daemon=True, name="trip-events")
+                self._listener.start()
+
+    def _listen(self):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(f"{self._prefix}*")
+        for message in pubsub.listen():
+            trip_id = int(message["channel"].decode()[len(self._prefix):])
+            self._deliver(trip_id, message["data"].decode())
+
+#==========================================================================================================
+# FLASK EXTENSION
+#==========================================================================================================
+
+class LiveUpdates:
+    """Publish compact change events for trip data after each commit, and stream them as Server-Sent Events"""
+
+    def __init__(self, app=None):
+        self.broker = EventBroker()
+        self._ids = itertools.count(1)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("EVENTS_BROKER_URL", None)
+        app.config.setdefault("EVENTS_HEARTBEAT", 15)
+        app.config.setdefault("EVENTS_MAX_STREAMS", 2)
+        app.config.setdefault("EVENTS_MAX_STREAM_SECONDS", 300)
+
+        url = app.config["EVENTS_BROKER_URL"]
+        self.broker = RedisEventBroker(url) if url else EventBroker()
+        self.heartbeat = app.config["EVENTS_HEARTBEAT"]
+        self.max_stream_seconds = app.config["EVENTS_MAX_STREAM_SECONDS"]
+        self._slots = threading.BoundedSemaphore(app.config["EVENTS_MAX_STREAMS"])
+
+        change_feed.subscribe(self._publish)
+        app.extensions["live_updates"] = self
+
+    def stream(self, trip_id):
+        """SSE response for one trip; it holds no database connection while open.
+
+        Each open stream holds one of the worker's threads, so only EVENTS_MAX_STREAMS are served at a time
+        and each is closed after EVENTS_MAX_STREAM_SECONDS (the browser reconnects by itself). Browsers that
+        find no free slot are told to retry later; the page works without live updates meanwhile.
+        """
+        def generate():
+            # Slot and subscription are taken on the first read: a response that is never iterated never
+            # reaches the finally clause that gives them back
+            if not self._slots.acquire(blocking=False):
+                yield f"retry: {BUSY_RETRY_MS}\n\n"
+                return
+            subscription = self.broker.subscribe(trip_id)
+            deadline = time.monotonic() + self.max_stream_seconds
+            try:
+                yield "retry: 3000\n\n"
+                while time.monotonic() < deadline:
+                    if subscription.overflowed:
+                        yield "event: resync\ndata: {}\n\n"
+                        return
+                    try:
+                        payload = subscription.get(timeout=self.heartbeat)
+                    except queue.Empty:
+                        yield ": keep-alive\n\n"       # comment line; stops proxies closing an idle stream
+                        continue
+                    kind = json.loads(payload)["type"]
+                    yield f"id: {next(self._ids)}\nevent: {kind}\ndata: {payload}\n\n"
+            finally:
+                self.broker.unsubscribe(trip_id, subscription)
+                self._slots.release()
+
+        response = Response(generate(), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"   # tell nginx not to buffer the stream
+        return response
+
+    #------------------------------------------------------------------------------------------------------
+
+    def _publish(self, changes):
+        for change in changes:
+            if change.kind in LIVE_TYPES and change.trip_id is not None:
+                self.broker.publish(change.trip_id, _payload(change))
+
+#==========================================================================================================
+
+def _payload(change):
+    return json.dumps({"type": change.kind, "op": change.op, "id": change.entity_id, "data": change.data},
+                      separators=(",", ":"))
+
+
+# Shared instance, initialised in create_app() (it needs the models, so it cannot live in app/__init__.py)
+live_updates = LiveUpdates()
@@ -0,0 +1,237 @@
+import csv
+import math
+import os
+import re
+import time
+from sqlalchemy import DDL, column, event, inspect, select, table, text
+from app import db
+from app.services.destinations import destination_key
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "gazetteer.csv")
+EARTH_RADIUS_KM = 6371.0088
+
+# "48.8584, 2.2945" typed as a location is taken as coordinates
+_COORDINATES = re.compile(r"^\s*(-?\d{1,2}(?:\.\d+)?)\s*,\s*(-?\d{1,3}(?:\.\d+)?)\s*$")
+
+#==========================================================================================================
+# GEOCODING
+#==========================================================================================================
+
+_gazetteer = None
+
+
+def gazetteer():
+    """{destination key: (latitude, longitude)} from the offline gazetteer file, read once"""
+    global _gazetteer
+    if _gazetteer is None:
+        entries = {}
+        if os.path.exists(GAZETTEER_PATH):
+            with open(GAZETTEER_PATH, newline="", encoding="utf-8") as fh:
+                for row in csv.DictReader(fh):
+                    point = (float(row["latitude"]), float(row["longitude"]))
+                    entries.setdefault(destination_key(row["name"]), point)
+        _gazetteer = entries
+    return _gazetteer
+
+
+def geocode(text_value):
+    """(latitude, longitude) for a place name or "lat, lon" string, or None when unknown"""
+    if not text_value:
+        return None
+    match = _COORDINATES.match(text_value)
+    if match:
+        lat, lon = float(match.group(1)), float(match.group(2))
+        return (lat, lon) if -90 <= lat <= 90 and -180 <= lon <= 180 else None
+
+    places = gazetteer()
+    key = destination_key(text_value)
+    if key in places:
+        return places[key]
+    # "Louvre Museum, Paris": try the most specific part first, then the rest
+    for part in key.split(","):
+        part = part.strip()
+        if part in places:
+            return places[part]
+    return None
+
+#==========================================================================================================
+# R*TREE SPATIAL INDEX
+#==========================================================================================================
+
+# Points are stored as zero-size boxes. Each indexed model gets a virtual table <table>_rtree, created with
+# the schema and kept in step by mapper events, inside the same transaction as the row itself.
+def attach_spatial_index(model):
+    table = model.__table__
+    rtree = f"{table.name}_rtree"
+    model.__rtree__ = rtree
+
+    event.listen(table.metadata, "after_create", spatial_index_ddl(model).execute_if(dialect="sqlite"))
+
+    def _sync(mapper, connection, target):
+        state = inspect(target)
+        if not state.attrs.latitude.history.has_changes() and not state.attrs.longitude.history.has_changes():
+            return
+        connection.execute(text(f"DELETE FROM {rtree} WHERE id = :id"), {"id": target.id})
+        if target.latitude is not None and target.longitude is not None:
+            connection.execute(
+                text(f"INSERT INTO {rtree} VALUES (:id, :lat, :lat, :lon, :lon)"),
+                {"id": target.id, "lat": target.latitude, "lon": target.longitude},
+            )
+
+    def _remove(mapper, connection, target):
+        connection.execute(text(f"DELETE FROM {rtree} WHERE id = :id"), {"id": target.id})
+
+    event.listen(model, "after_insert", _sync)
+    event.listen(model, "after_update", _sync)
+    event.listen(model, "after_delete", _remove)
+
+
+def spatial_index_ddl(model):
+    """CREATE statement for a model's R*Tree (also run on trip shards, see app/services/shards.py)"""
+    return DDL(f"CREATE VIRTUAL TABLE IF NOT EXISTS {model.__rtree__} USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+
+
+def rebuild_spatial_index(model):
+    """Refill a model's R*Tree from its latitude/longitude columns; returns the number of points"""
+    rtree = model.__rtree__
+    table = model.__table__.name
+    db.session.execute(text(f"DELETE FROM {rtree}"))
+    result = db.session.execute(text(
+        f"INSERT INTO {rtree} SELECT id, latitude, latitude, longitude, longitude FROM {table} "
+        f"WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+    ))
+    db.session.commit()
+    return result.rowcount
+
+
+def index_rows(model, ids):
+    """Add rows written by bulk statements (which skip the mapper events) to the R*Tree, in one statement"""
+    source = model.__table__
+    rtree = table(model.__rtree__, column("id"), column("min_lat"), column("max_lat"),
+                  column("min_lon"), column("max_lon"))
+    points = select(source.c.id, source.c.latitude, source.c.latitude, source.c.longitude, source.c.longitude) \
+        .where(source.c.id.in_(ids), source.c.latitude.isnot(None), source.c.longitude.isnot(None))
+    db.session.execute(rtree.insert().from_select(["id", "min_lat", "max_lat", "min_lon", "max_lon"], points))
+
+
+def geocode_missing(model, batch_size=500):
+    """Locate rows without coordinates via model.locate(), one short transaction per batch"""
+    located, last_id = 0, 0
+    while True:
+        batch = model.query.filter(model.latitude.is_(None), model.id > last_id) \
+            .order_by(model.id).limit(batch_size).all()
+        if not batch:
+            return located
+        located += sum(1 for row in batch if row.locate())
+        last_id = batch[-1].id
+        db.session.commit()
+
+
+def within_box(model, min_lat, min_lon, max_lat, max_lon, query=None):
+    """Rows whose point lies in the box (an R*Tree range search)"""
+    ids = _box_ids(model.__rtree__, min_lat, min_lon, max_lat, max_lon)
+    if not ids:
+        return []
+    return (query or model.query).filter(model.id.in_(ids)).all()
+
+
+def nearest(model, lat, lon, k=5, query=None, exclude_id=None):
+    """[(row, km), ...] for the k rows closest to (lat, lon).
+
+    The R*Tree has no native k-NN search, so boxes of growing radius are searched until they hold k rows
+    within that radius; only rows inside the search circle are guaranteed to be the true nearest.
+    """
+    radius_km = 25.0
+    while True:
+        box = _box_around(lat, lon, radius_km)
+        ids = _box_ids(model.__rtree__, *box)
+        ids.discard(exclude_id)
+        candidates = (query or model.query).filter(model.id.in_(ids)).all() if ids else []
+        ranked = sorted(((row, haversine_km(lat, lon, row.latitude, row.longitude)) for row in candidates),
+                        key=lambda entry: entry[1])
+        inside = [entry for entry in ranked if entry[1] <= radius_km]
+        if len(inside) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+            return (inside if len(inside) >= k else ranked)[:k]
+        radius_km *= 4
+
+
+def _box_ids(rtree, min_lat, min_lon, max_lat, max_lon):
+    if min_lon <= max_lon:
+        boxes = [(min_lon, max_lon)]
+    else:       # the box crosses the antimeridian
+        boxes = [(min_lon, 180.0), (-180.0, max_lon)]
+    ids = set()
+    for low, high in boxes:
+        ids.update(db.session.execute(text(
+            f"SELECT id FROM {rtree} WHERE max_lat >= :min_lat AND min_lat <= :max_lat "
+            f"AND max_lon >= :min_lon AND min_lon <= :max_lon"
+        ), {"min_lat": min_lat, "max_lat": max_lat, "min_lon": low, "max_lon": high}).scalars())
+    return ids
+
+
+def _box_around(lat, lon, radius_km):
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    if min_lat <= -90 or max_lat >= 90 or math.cos(math.radians(lat)) < 1e-6:
+        return min_lat, -180.0, max_lat, 180.0
+    dlon = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(lat))))
+    if dlon >= 180:
+        return min_lat, -180.0, max_lat, 180.0
+    return min_lat, _wrap(lon - dlon), max_lat, _wrap(lon + dlon)
+
+
+def _wrap(lon):
+    return (lon + 180.0) % 360.0 - 180.0
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+#==========================================================================================================
+# ROUTE ORDERING
+#==========================================================================================================
+
+def order_stops(stops, time_limit=0.5):
+    """Short visiting order for located stops: nearest-neighbour tour improved by 2-opt.
+
+    Returns (ordered stops, route km, km in the given order). The route is an open path starting at the
+    first stop. 2-opt passes stop when nothing improves or after time_limit seconds.
+    """
+    n = len(stops)
+    if n < 3:
+        return list(stops), _path_length(stops), _path_length(stops)
+
+    dist = [[haversine_km(a.latitude, a.longitude, b.latitude, b.longitude) for b in stops] for a in stops]
+
+    # Nearest neighbour from the first stop
+    path, remaining = [0], set(range(1, n))
+    while remaining:
+        last = path[-1]
+        following = min(remaining, key=lambda j: dist[last][j])
+        path.append(following)
+        remaining.remove(following)
+
+    # 2-opt: reverse path[i..j] whenever that shortens the open path
+    deadline = time.monotonic() + time_limit
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, n - 1):
+            before = dist[path[i - 1]][path[i]]
+            for j in range(i + 1, n):
+                after = dist[path[j]][path[j + 1]] if j + 1 < n else 0.0
+                new_after = dist[path[i]][path[j + 1]] if j + 1 < n else 0.0
+                if dist[path[i - 1]][path[j]] + new_after < before + after - 1e-9:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    before = dist[path[i - 1]][path[i]]
+                    improved = True
+
+    ordered = [stops[index] for index in path]
+    return ordered, _path_length(ordered), _path_length(stops)
+
+
+def _path_length(stops):
+    return sum(haversine_km(a.latitude, a.longitude, b.latitude, b.longitude) for a, b in zip(stops, stops[1:]))
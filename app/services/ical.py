@@ -0,0 +1,227 @@
+import base64
+import hashlib
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, literal, union_all
+from app import db
+from app.models import Trip, ItineraryItem, Task, trip_users
+from app.services import shards
+
+PRODID = "-//JetSetGo//Travel Planner//EN"
+STREAM_BATCH_SIZE = 200     # rows fetched per round trip while streaming the feed
+
+# Task.status → VTODO STATUS
+TASK_STATUS = {"Pending": "NEEDS-ACTION", "Working": "IN-PROCESS", "Done": "COMPLETED"}
+
+#==========================================================================================================
+# FEED VERSION / SYNC TOKENS
+#==========================================================================================================
+
+def _user_trip_ids(user_id):
+    statement = select(trip_users.c.trip_id).where(trip_users.c.user_id == user_id)
+    if shards.router.enabled:       # trip_users is global: resolve it before querying the trip shards
+        return db.session.scalars(statement).all()
+    return statement
+
+
+def _scoped_tables(user_id):
+    """(kind, model, filter) for every table that contributes to a user's feed"""
+    trip_ids = _user_trip_ids(user_id)
+    return [
+        ("trip", Trip, Trip.id.in_(trip_ids)),
+        ("itinerary", ItineraryItem, ItineraryItem.trip_id.in_(trip_ids)),
+        ("task", Task, Task.user_id == user_id),
+    ]
+
+
+def trip_set_digest(user_id):
+    """Fingerprint of which trips the user is on: sharing a trip adds it to the feed without touching its
+    updated_at, so a delta based on the watermark alone would never send it"""
+    trip_ids = db.session.scalars(
+        select(trip_users.c.trip_id).where(trip_users.c.user_id == user_id).order_by(trip_users.c.trip_id))
+    return hashlib.sha1(",".join(map(str, trip_ids)).encode()).hexdigest()[:16]
+
+
+def feed_state(user_id):
+    """Row count, highest id and latest update per table, all in one statement"""
+    rows = _union_rows([
+        select(literal(kind).label("kind"), func.count(model.id), func.max(model.id), func.max(model.updated_at))
+        .where(condition)
+        for kind, model, condition in _scoped_tables(user_id)
+    ])
+    state = {}
+    for kind, count, max_id, updated in rows:      # one row per table, or per table and shard
+        total, highest, latest = state.get(kind, (0, 0, None))
+        state[kind] = (total + count, max(highest, max_id or 0), max(filter(None, (latest, updated)), default=None))
+    return state
+
+
+def feed_etag(state):
+    """Any insert, update or delete changes at least one value in the state, and therefore the ETag"""
+    fingerprint = repr(sorted((kind, count, max_id, str(updated)) for kind, (count, max_id, updated) in state.items()))
+    return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+
+def make_sync_token(state, user_id):
+    """Encode where this response leaves the client: the update watermark, row count/highest id per table and
+    the set of trips the user is on"""
+    # Rows created before updated_at existed have no timestamp; the epoch watermark still skips them
+    watermarks = [updated for _, _, updated in state.values() if updated] or [datetime(1970, 1, 1)]
+    payload = {
+        "since": max(watermarks).isoformat(),
+        "rows": {kind: [count, max_id] for kind, (count, max_id, _) in state.items()},
+        "trips": trip_set_digest(user_id),
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def parse_sync_token(token):
+    """Decode a sync token, returning None when it is missing or malformed"""
+    if not token:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return {
+            "since": datetime.fromisoformat(payload["since"]),
+            "rows": {kind: tuple(values) for kind, values in payload["rows"].items()},
+            "trips": payload.get("trips"),     # absent from older tokens: they get one full feed
+        }
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def token_is_current(token, user_id):
+    """A delta can only be served if no row known to the client has been deleted since the token was issued,
+    and the user has not joined or left a trip (that changes the feed without changing updated_at)"""
+    if token["trips"] != trip_set_digest(user_id):
+        return False
+    rows = _union_rows([
+        select(literal(kind), func.count(model.id)).where(condition, model.id <= token["rows"].get(kind, (0, 0))[1])
+        for kind, model, condition in _scoped_tables(user_id)
+    ])
+    surviving = {}
+    for kind, count in rows:
+        surviving[kind] = surviving.get(kind, 0) + count
+    return all(surviving.get(kind, 0) == count for kind, (count, _) in token["rows"].items())
+
+
+def _union_rows(statements):
+    """Rows of the per-table aggregates, in one UNION ALL; with trip shards the tables live in different
+    databases, so each runs on its own (once per shard holding the user's trips)"""
+    if not shards.router.enabled:
+        return db.session.execute(union_all(*statements)).all()
+    return [row for statement in statements for row in db.session.execute(statement)]
+
+#==========================================================================================================
+# FEED GENERATION
+#==========================================================================================================
+
+def generate_feed(user_id, since=None):
+    """Yield the iCalendar document line by line, streaming rows instead of loading them all"""
+    yield _line("BEGIN", "VCALENDAR")
+    yield _line("VERSION", "2.0")
+    yield _line("PRODID", PRODID)
+    yield _line("CALSCALE", "GREGORIAN")
+    yield _line("X-WR-CALNAME", "JetSetGo")
+
+    trip_ids = _user_trip_ids(user_id)
+
+    trips = select(Trip.id, Trip.title, Trip.description, Trip.start_date, Trip.end_date, Trip.updated_at) \
+        .where(Trip.id.in_(trip_ids))
+    for row in _stream(trips, Trip, since):
+        yield from _trip_event(row)
+
+    items = select(
+        ItineraryItem.id, ItineraryItem.title, ItineraryItem.date, ItineraryItem.time,
+        ItineraryItem.duration_minutes, ItineraryItem.location, ItineraryItem.notes,
+        ItineraryItem.updated_at, Trip.title.label("trip_title")
+    ).join(Trip, Trip.id == ItineraryItem.trip_id).where(ItineraryItem.trip_id.in_(trip_ids))
+    for row in _stream(items, ItineraryItem, since):
+        yield from _itinerary_event(row)
+
+    tasks = select(Task.id, Task.title, Task.due_date, Task.due_time, Task.status, Task.updated_at) \
+        .where(Task.user_id == user_id)
+    for row in _stream(tasks, Task, since):
+        yield from _task_todo(row)
+
+    yield _line("END", "VCALENDAR")
+
+
+def _stream(statement, model, since):
+    if since is not None:
+        statement = statement.where(model.updated_at > since)
+    statement = statement.order_by(model.id).execution_options(yield_per=STREAM_BATCH_SIZE)
+    return db.session.execute(statement)
+
+#==========================================================================================================
+
+def _trip_event(row):
+    yield _line("BEGIN", "VEVENT")
+    yield _line("UID", f"trip-{row.id}@jetsetgo")
+    yield _line("DTSTAMP", _utc(row.updated_at))
+    yield _line("DTSTART;VALUE=DATE", row.start_date.strftime("%Y%m%d"))
+    yield _line("DTEND;VALUE=DATE", (row.end_date + timedelta(days=1)).strftime("%Y%m%d"))    # DTEND is exclusive
+    yield _line("SUMMARY", _escape(row.title))
+    if row.description:
+        yield _line("DESCRIPTION", _escape(row.description))
+    yield _line("END", "VEVENT")
+
+
+def _itinerary_event(row):
+    yield _line("BEGIN", "VEVENT")
+    yield _line("UID", f"itinerary-{row.id}@jetsetgo")
+    yield _line("DTSTAMP", _utc(row.updated_at))
+    if row.time:
+        yield _line("DTSTART", datetime.combine(row.date, row.time).strftime("%Y%m%dT%H%M%S"))
+        if row.duration_minutes:
+            yield _line("DURATION", f"PT{row.duration_minutes}M")
+    else:
+        yield _line("DTSTART;VALUE=DATE", row.date.strftime("%Y%m%d"))
+    yield _line("SUMMARY", _escape(row.title))
+    if row.location:
+        yield _line("LOCATION", _escape(row.location))
+    yield _line("DESCRIPTION", _escape(f"{row.trip_title}\n{row.notes}" if row.notes else row.trip_title))
+    yield _line("END", "VEVENT")
+
+
+def _task_todo(row):
+    yield _line("BEGIN", "VTODO")
+    yield _line("UID", f"task-{row.id}@jetsetgo")
+    yield _line("DTSTAMP", _utc(row.updated_at))
+    if row.due_date and row.due_time:
+        yield _line("DUE", datetime.combine(row.due_date, row.due_time).strftime("%Y%m%dT%H%M%S"))
+    elif row.due_date:
+        yield _line("DUE;VALUE=DATE", row.due_date.strftime("%Y%m%d"))
+    yield _line("SUMMARY", _escape(row.title))
+    yield _line("STATUS", TASK_STATUS.get(row.status, "NEEDS-ACTION"))
+    yield _line("END", "VTODO")
+
+#==========================================================================================================
+
+def _utc(value):
+    return (value or datetime.utcnow()).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _escape(text):
+    """Escape a TEXT value as required by RFC 5545"""
+    return (text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def _line(name, value):
+    """Render one content line, folded at 75 octets without splitting a UTF-8 character"""
+    line = f"{name}:{value}"
+    if len(line.encode("utf-8")) <= 75:
+        return line + "\r\n"
+
+    parts, current, size = [], "", 0
+    for char in line:
+        char_size = len(char.encode("utf-8"))
+        limit = 75 if not parts else 74     # continuation lines start with a space
+        if size + char_size > limit:
+            parts.append(current)
+            current, size = "", 0
+        current += char
+        size += char_size
+    parts.append(current)
+    return "\r\n ".join(parts) + "\r\n"
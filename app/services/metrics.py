@@ -0,0 +1,362 @@
+import atexit
+import bisect
+import fcntl
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from flask import Response, abort, g, request, request_finished, request_started
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Prometheus-style metrics. Every thread counts into its own dictionaries, so recording a request or an
+# SQL statement takes no lock; an export adds the threads up. Pre-forked workers each keep their own
+# numbers: with METRICS_MULTIPROCESS_DIR set, every worker writes a snapshot file there now and then and
+# /metrics merges the files, so whichever worker answers the scrape reports the whole server.
+# The export names every endpoint and its traffic, so it needs METRICS_TOKEN; without one it only answers
+# in debug mode or when METRICS_PUBLIC says the port is not reachable from outside.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "http_requests_total": ("counter", "Requests handled, by blueprint, endpoint, method and status.", None),
+    "http_request_duration_seconds": ("histogram", "Time to produce a response, by blueprint and endpoint.",
+                                      LATENCY_BUCKETS),
+    "sql_statements_total": ("counter", "SQL statements executed, by statement kind.", None),
+    "sql_statement_duration_seconds": ("histogram", "SQL statement execution time, by statement kind.", SQL_BUCKETS),
+    "sqlite_busy_errors_total": ("counter", "Statements that failed with 'database is locked' after busy_timeout.",
+                                 None),
+    "sqlite_lock_waits_total": ("counter", "Write statements slower than METRICS_LOCK_WAIT_THRESHOLD, "
+                                           "almost always waiting for another writer's lock.", None),
+    "cache_requests_total": ("counter", "In-process cache lookups, by cache and result (hit or miss).", None),
+    "mail_sent_total": ("counter", "Emails handed to the SMTP server, by result.", None),
+    "mail_send_duration_seconds": ("histogram", "Time to send one email.", LATENCY_BUCKETS),
+    "db_pool_connections": ("gauge", "SQLAlchemy pool connections, by database and state.", None),
+}
+
+_WRITES = {"INSERT", "UPDATE", "DELETE", "REPLACE"}
+
+#==========================================================================================================
+# PER-THREAD STORAGE
+#==========================================================================================================
+
+class _Shard:
+    """One thread's numbers; only that thread writes to them"""
+
+    def __init__(self):
+        self.counters = {}          # (name, labels) -> value
+        self.histograms = {}        # (name, labels) -> [count per bucket (+Inf last), sum]
+
+
+def _merge(into, counters, histograms):
+    for key, value in counters:
+        into.counters[key] = into.counters.get(key, 0) + value
+    for key, (buckets, total) in histograms:
+        entry = into.histograms.get(key)
+        if entry is None:
+            into.histograms[key] = [list(buckets), total]
+        else:
+            entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+            entry[1] += total
+
+#==========================================================================================================
+
+class Metrics:
+    """Request, SQL, cache and mail metrics, exported at /metrics in the Prometheus text format"""
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self._shards = []               # [(thread, shard)], appended to once per thread
+        self._retired = _Shard()        # numbers of threads that have exited
+        self._registry_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._engine_events = False
+        os.register_at_fork(after_in_child=self._reset)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_MULTIPROCESS_DIR", None)
+        app.config.setdefault("METRICS_FLUSH_INTERVAL", 5)
+        app.config.setdefault("METRICS_LOCK_WAIT_THRESHOLD", 0.1)
+        app.config.setdefault("METRICS_TOKEN", None)
+        app.config.setdefault("METRICS_PUBLIC", False)
+
+        self.app = app
+        self.directory = app.config["METRICS_MULTIPROCESS_DIR"]
+        self.flush_interval = app.config["METRICS_FLUSH_INTERVAL"]
+        self.lock_wait_threshold = app.config["METRICS_LOCK_WAIT_THRESHOLD"]
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            atexit.register(self.flush)
+
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        if not self._engine_events:
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+            event.listen(Engine, "handle_error", self._handle_error)
+            self._engine_events = True
+
+        app.add_url_rule("/metrics", "metrics", self._export)
+        app.extensions["metrics"] = self
+
+    # --- Recording (lock free) ---
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard().counters
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        histograms = self._shard().histograms
+        key = (name, tuple(sorted(labels.items())))
+        entry = histograms.get(key)
+        if entry is None:
+            entry = histograms[key] = [[0] * (len(METRICS[name][2]) + 1), 0.0]
+        entry[0][bisect.bisect_left(METRICS[name][2], value)] += 1
+        entry[1] += value
+
+    def cache_lookup(self, cache, hits=0, misses=0):
+        """Count lookups in an in-process cache; the hit ratio is hit / (hit + miss)"""
+        if hits:
+            self.inc("cache_requests_total", hits, cache=cache, result="hit")
+        if misses:
+            self.inc("cache_requests_total", misses, cache=cache, result="miss")
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._registry_lock:
+                self._retire_finished_threads()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_finished_threads(self):
+        # Threads come and go (thread pools, the development server); fold their numbers into one shard
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(self._retired, shard.counters.items(), shard.histograms.items())
+        self._shards = alive
+
+    def _reset(self):
+        # A forked worker starts from zero instead of repeating what the master counted before the fork
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()
+        self._registry_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    # --- Collection ---
+
+    def collect(self):
+        """This process's counters and histograms, summed over its threads"""
+        total = _Shard()
+        with self._registry_lock:
+            self._retire_finished_threads()
+            shards = [self._retired] + [shard for _, shard in self._shards]
+        for shard in shards:
+            # dict() copies in one step under the GIL, so a thread writing meanwhile cannot break the iteration
+            _merge(total, dict(shard.counters).items(), dict(shard.histograms).items())
+        return total
+
+    def _gauges(self):
+        from app import db
+        gauges = {}
+        for bind, engine in db.engines.items():
+            pool = engine.pool
+            if hasattr(pool, "checkedout"):
+                labels = (("database", bind or "default"),)
+                gauges[("db_pool_connections", labels + (("state", "checked_out"),))] = pool.checkedout()
+                gauges[("db_pool_connections", labels + (("state", "idle"),))] = pool.checkedin()
+        return gauges
+
+    # --- Multiprocess snapshots ---
+
+    def flush(self):
+        """Write this process's snapshot to METRICS_MULTIPROCESS_DIR"""
+        if not self.directory:
+            return
+        self._last_flush = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        _write_snapshot(os.path.join(self.directory, f"metrics-{os.getpid()}.json"), self.collect())
+
+    def mark_process_dead(self, pid):
+        """Fold an exited worker's snapshot into the archive file (gunicorn's child_exit hook calls this)"""
+        path = os.path.join(self.directory, f"metrics-{pid}.json")
+        with self._directory_lock():
+            if not os.path.exists(path):
+                return
+            archive_path = os.path.join(self.directory, "archive.json")
+            archive = _Shard()
+            for source in (archive_path, path):
+                _merge(archive, *_read_snapshot(source))
+            _write_snapshot(archive_path, archive)
+            os.remove(path)
+
+    def _directory_lock(self):
+        os.makedirs(self.directory, exist_ok=True)     # gunicorn's on_starting empties it after the app is loaded
+        return _FileLock(os.path.join(self.directory, ".lock"))
+
+    def _merged(self):
+        if not self.directory:
+            return self.collect()
+        self.flush()
+        total = _Shard()
+        with self._directory_lock():
+            for path in glob.glob(os.path.join(self.directory, "*.json")):
+                _merge(total, *_read_snapshot(path))
+        return total
+
+    # --- Flask and SQLAlchemy hooks ---
+
+    def _request_started(self, sender, **extra):
+        g.metrics_start = time.perf_counter()
+
+    def _request_finished(self, sender, response, **extra):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return
+        blueprint = request.blueprint or "app"
+        endpoint = request.endpoint or "none"        # unmatched URLs share one label
+        self.inc("http_requests_total", blueprint=blueprint, endpoint=endpoint, method=request.method,
+                 status=str(response.status_code))
+        self.observe("http_request_duration_seconds", time.perf_counter() - start,
+                     blueprint=blueprint, endpoint=endpoint)
+        if self.directory and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        kind = _statement_kind(statement)
+        self.inc("sql_statements_total", statement=kind)
+        self.observe("sql_statement_duration_seconds", elapsed, statement=kind)
+        if kind in _WRITES and elapsed >= self.lock_wait_threshold:
+            self.inc("sqlite_lock_waits_total")
+
+    def _handle_error(self, context):
+        message = str(context.original_exception)
+        if "database is locked" in message or "database is busy" in message:
+            self.inc("sqlite_busy_errors_total")
+
+    # --- Export ---
+
+    def _export(self):
+        token = self.app.config["METRICS_TOKEN"]
+        if token:
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+                abort(401)
+        elif not (self.app.debug or self.app.config["METRICS_PUBLIC"]):
+            abort(404)
+        total = self._merged()
+        return Response(render(total.counters, total.histograms, self._gauges()),
+                        mimetype="text/plain", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+#==========================================================================================================
+
+class _FileLock:
+    """flock() on a file: merging snapshots must not race a worker's exit being folded into the archive"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._fh = open(self.path, "a")
+        fcntl.flock(self._fh, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._fh, fcntl.LOCK_UN)
+        self._fh.close()
+
+
+def _write_snapshot(path, shard):
+    snapshot = {
+        "counters": [[name, labels, value] for (name, labels), value in shard.counters.items()],
+        "histograms": [[name, labels, buckets, total] for (name, labels), (buckets, total) in shard.histograms.items()],
+    }
+    with open(f"{path}.tmp", "w") as fh:
+        json.dump(snapshot, fh)
+    os.replace(f"{path}.tmp", path)        # a scrape never reads a half-written file
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as fh:
+            snapshot = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return [], []
+    counters = [((name, tuple(map(tuple, labels))), value) for name, labels, value in snapshot["counters"]]
+    histograms = [((name, tuple(map(tuple, labels))), (buckets, total))
+                  for name, labels, buckets, total in snapshot["histograms"]]
+    return counters, histograms
+
+
+def _statement_kind(statement):
+    word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return word if word in {"SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH", "PRAGMA", "CREATE",
+                            "DROP", "ALTER", "BEGIN", "COMMIT", "SAVEPOINT", "RELEASE"} else "OTHER"
+
+#==========================================================================================================
+# TEXT EXPOSITION FORMAT
+#==========================================================================================================
+
+def render(counters, histograms, gauges):
+    """Prometheus text format (version 0.0.4)"""
+    series = {}         # name -> {labels: [lines]}
+    for (name, labels), value in {**counters, **gauges}.items():
+        series.setdefault(name, {})[labels] = [_sample(name, labels, value)]
+    for (name, labels), (buckets, total) in histograms.items():
+        lines, cumulative = [], 0
+        for bound, count in zip(METRICS[name][2] + (float("inf"),), buckets):
+            cumulative += count
+            lines.append(_sample(f"{name}_bucket", labels + (("le", _number(bound)),), cumulative))
+        lines.append(_sample(f"{name}_sum", labels, total))
+        lines.append(_sample(f"{name}_count", labels, cumulative))
+        series.setdefault(name, {})[labels] = lines
+
+    output = []
+    for name, (kind, help_text, _) in METRICS.items():
+        if name in series:
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            for labels in sorted(series[name]):
+                output.extend(series[name][labels])
+    return "\n".join(output) + "\n"
+
+
+def _sample(name, labels, value):
+    if not labels:
+        return f"{name} {_number(value)}"
+    pairs = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels)
+    return f"{name}{{{pairs}}} {_number(value)}"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+metrics = Metrics()
@@ -0,0 +1,55 @@
+import base64
+import json
+from datetime import date, time
+from sqlalchemy import and_, or_
+
+# Keyset ("seek") pagination: instead of OFFSET, the next page starts after the last row's sort key, so
+# every page is one index range scan however deep the user pages. Sort keys may contain NULLs, which
+# SQLite orders first in ascending order; keyset_after() follows the same rule.
+
+#==========================================================================================================
+
+def keyset_after(columns, values):
+    """WHERE clause for rows strictly after `values` in ascending (columns) order, NULLs first"""
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        equal_so_far = [_equal(c, v) for c, v in zip(columns[:i], values[:i])]
+        greater = column.isnot(None) if value is None else column > value
+        clauses.append(and_(*equal_so_far, greater))
+    return or_(*clauses)
+
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+#==========================================================================================================
+
+def encode_cursor(values):
+    """Opaque, URL-safe cursor for a row's sort key"""
+    payload = [_encode_value(value) for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, columns):
+    """Sort key from a cursor, each value converted to its column's Python type; None if malformed"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(payload, list) or len(payload) != len(columns):
+            return None
+        return [None if value is None else _decode_value(value, column.type.python_type)
+                for value, column in zip(payload, columns)]
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def _encode_value(value):
+    return value.isoformat() if isinstance(value, (date, time)) else value
+
+
+def _decode_value(value, kind):
+    if kind is date:
+        return date.fromisoformat(value)
+    if kind is time:
+        return time.fromisoformat(value)
+    return kind(value)
@@ -0,0 +1,90 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from functools import lru_cache
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing is deliberately slow and CPU bound. Running it on the request thread holds the GIL
+# for the whole hash, so a burst of logins starves every other request in the worker. Instead the work
+# is shipped to a small process pool, and the request thread just waits on the result. When the pool is
+# saturated for longer than PASSWORD_HASH_TIMEOUT the request is answered 503 with Retry-After.
+
+RETRY_AFTER = 5         # seconds suggested to clients turned away by a saturated pool
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+#==========================================================================================================
+
+def hash_password(password):
+    """Hash a password with the configured algorithm and cost"""
+    return _run(generate_password_hash, password, current_app.config["PASSWORD_HASH_METHOD"])
+
+
+def verify_password(password_hash, password):
+    """Check a password against a stored hash"""
+    if not password_hash or password is None:
+        return False
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """True if the hash was made with a different algorithm or cost than the one configured now"""
+    return password_hash.split("$", 1)[0] != _method_prefix(current_app.config["PASSWORD_HASH_METHOD"])
+
+#==========================================================================================================
+
+@lru_cache(maxsize=8)
+def _method_prefix(method):
+    # Werkzeug fills in default parameters ("pbkdf2" → "pbkdf2:sha256:1000000"), so take the prefix
+    # from a real hash instead of comparing against the configured string
+    return generate_password_hash("", method).split("$", 1)[0]
+
+
+def _run(func, *args):
+    pool, slots = _get_pool()
+    if pool is None:
+        return func(*args)
+
+    # Bound the number of queued jobs, so a login flood waits here instead of piling up in the pool
+    if not slots.acquire(timeout=current_app.config["PASSWORD_HASH_TIMEOUT"]):
+        raise _busy()
+    try:
+        return pool.submit(func, *args).result(timeout=current_app.config["PASSWORD_HASH_TIMEOUT"])
+    except FutureTimeout:
+        raise _busy() from None
+    finally:
+        slots.release()
+
+
+def _busy():
+    # An HTTP error, so every caller (login, register, password reset) answers 503 instead of failing with 500
+    return ServiceUnavailable("Too many sign-ins at the moment. Please try again shortly.", retry_after=RETRY_AFTER)
+
+
+def _get_pool():
+    global _pool, _pool_pid, _pool_slots
+    workers = current_app.config["PASSWORD_HASH_WORKERS"]
+    if workers <= 0:
+        return None, None
+
+    with _pool_lock:
+        # A pool inherited through fork() belongs to the parent process, so each worker builds its own
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_pid = os.getpid()
+            _pool_slots = threading.BoundedSemaphore(workers * current_app.config["PASSWORD_HASH_QUEUE_FACTOR"])
+    return _pool, _pool_slots
+
+
+def shutdown():
+    """Stop the hashing processes (used by benchmarks and by gunicorn's worker_exit hook)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=True)
+        _pool = None
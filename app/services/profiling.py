@@ -0,0 +1,209 @@
+import gc
+import io
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# On-demand profiling of the live worker, for the /admin/profile pages. Nothing here runs until an admin
+# asks for it, and everything it starts stops by itself after a bounded window:
+# - CPU: a sampling profiler. The requesting thread wakes every PROFILE_INTERVAL, reads the Python stack of
+#   every other thread (sys._current_frames) and counts it. The result is in "folded stacks" format, one
+#   "frame;frame;... count" line per distinct stack, which flamegraph.pl, speedscope and inferno read directly.
+# - Memory: tracemalloc, started with a baseline snapshot and stopped when the window ends. The diff against
+#   the baseline shows which lines allocated what is still alive; snapshots download in tracemalloc's own
+#   format (tracemalloc.Snapshot.load) for offline comparison.
+# - Objects: live object counts by type after a full collection, plus the SQLAlchemy instances still held
+#   in memory per mapped class, the usual sign of a session that outlives its request.
+# Each worker profiles itself: with several gunicorn workers a request reaches one of them, named by its pid.
+
+# Leaf frames of a thread that is waiting, not working (idle gthread workers, the trace writer, ...)
+_IDLE_FILES = {"threading.py", "selectors.py", "queue.py", "socket.py", "socketserver.py"}
+
+
+class ProfilerBusy(RuntimeError):
+    """A profile of the same kind is already running in this worker"""
+
+#==========================================================================================================
+# CPU
+#==========================================================================================================
+
+def sample_stacks(seconds, interval, include_idle=False):
+    """Sample every other thread's stack for `seconds`; returns (Counter of folded stack -> samples, samples)"""
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if not include_idle and os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_label(frame.f_code))
+                frame = frame.f_back
+            frames.append(names.get(ident, f"thread-{ident}"))
+            stacks[";".join(reversed(frames))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+def folded(stacks):
+    """Folded-stacks text, heaviest stacks first"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _label(code):
+    # Per function, not per line, so the samples of one call add up; ";" and " " separate folded fields
+    filename = code.co_filename
+    for root in sys.path:
+        if root and filename.startswith(root + os.sep):
+            filename = filename[len(root) + 1:]
+            break
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name}({filename}:{code.co_firstlineno})".replace(";", ":").replace(" ", "_")
+
+#==========================================================================================================
+# OBJECTS
+#==========================================================================================================
+
+def object_counts(limit=30):
+    """Live objects after a full collection: [(type, count, shallow bytes), ...], most numerous first"""
+    gc.collect()
+    counts = Counter()
+    sizes = Counter()
+    for obj in gc.get_objects():
+        kind = type(obj)
+        name = f"{kind.__module__}.{kind.__qualname__}"
+        counts[name] += 1
+        sizes[name] += sys.getsizeof(obj, 0)
+    return [(name, count, sizes[name]) for name, count in counts.most_common(limit)]
+
+
+def orm_instances():
+    """SQLAlchemy instances alive in this worker: [(class, in a session, detached), ...], most first"""
+    from sqlalchemy.orm.state import InstanceState
+    attached = Counter()
+    detached = Counter()
+    for obj in gc.get_objects():
+        if isinstance(obj, InstanceState) and obj.obj() is not None:
+            name = obj.class_.__name__
+            if obj.session_id is not None:
+                attached[name] += 1
+            else:
+                detached[name] += 1
+    names = set(attached) | set(detached)
+    rows = [(name, attached[name], detached[name]) for name in names]
+    return sorted(rows, key=lambda row: row[1] + row[2], reverse=True)
+
+#==========================================================================================================
+# PROFILER
+#==========================================================================================================
+
+class Profiler:
+    """Flask extension: bounded, one-at-a-time CPU and memory profiles of the current worker"""
+
+    def __init__(self, app=None):
+        self._cpu_lock = threading.Lock()
+        self._memory_lock = threading.Lock()
+        self._baseline = None
+        self._latest = None
+        self._timer = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PROFILE_MAX_SECONDS", 30)
+        app.config.setdefault("PROFILE_INTERVAL", 0.005)
+        app.config.setdefault("TRACEMALLOC_FRAMES", 25)
+        app.config.setdefault("TRACEMALLOC_MAX_SECONDS", 600)
+
+        self.max_seconds = app.config["PROFILE_MAX_SECONDS"]
+        self.interval = app.config["PROFILE_INTERVAL"]
+        self.frames = app.config["TRACEMALLOC_FRAMES"]
+        self.memory_max_seconds = app.config["TRACEMALLOC_MAX_SECONDS"]
+        app.extensions["profiling"] = self
+
+    # --- CPU ---
+
+    def cpu(self, seconds, include_idle=False):
+        """Folded stacks of this worker's threads over the next `seconds` (capped at PROFILE_MAX_SECONDS).
+
+        Blocks the calling request for the window; the other threads keep serving and are what gets sampled.
+        """
+        if not self._cpu_lock.acquire(blocking=False):
+            raise ProfilerBusy("A CPU profile is already running in this worker")
+        try:
+            stacks, samples = sample_stacks(min(seconds, self.max_seconds), self.interval, include_idle)
+        finally:
+            self._cpu_lock.release()
+        return folded(stacks), samples
+
+    # --- Memory ---
+
+    @property
+    def tracing_memory(self):
+        return tracemalloc.is_tracing()
+
+    def start_memory(self, seconds):
+        """Start tracemalloc with a baseline snapshot; it stops by itself after `seconds` (capped)"""
+        with self._memory_lock:
+            if tracemalloc.is_tracing():
+                raise ProfilerBusy("Memory tracing is already on in this worker")
+            tracemalloc.start(self.frames)
+            self._baseline = self._take()
+            self._latest = None
+            self._timer = threading.Timer(min(seconds, self.memory_max_seconds), self.stop_memory)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop_memory(self):
+        """Take the final snapshot and stop tracemalloc (and its per-allocation overhead)"""
+        with self._memory_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if tracemalloc.is_tracing():
+                self._latest = self._take()
+                tracemalloc.stop()
+
+    def snapshot(self):
+        """A snapshot now while tracing, otherwise the one taken when tracing stopped (None if never run)"""
+        with self._memory_lock:
+            if tracemalloc.is_tracing():
+                self._latest = self._take()
+            return self._latest
+
+    def memory_diff(self, key_type="lineno", limit=30):
+        """Text report of what was allocated since the baseline and is still alive, biggest growth first"""
+        latest = self.snapshot()
+        if latest is None or self._baseline is None:
+            return None
+        out = io.StringIO()
+        stats = latest.compare_to(self._baseline, key_type)
+        growth = sum(stat.size_diff for stat in stats)
+        out.write(f"pid {os.getpid()}: {growth / 1024:+.1f} KiB since the baseline, "
+                  f"{'still tracing' if tracemalloc.is_tracing() else 'tracing stopped'}\n\n")
+        for stat in stats[:limit]:
+            out.write(f"{stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8} blocks  "
+                      f"(now {stat.size / 1024:.1f} KiB in {stat.count})\n")
+            for line in stat.traceback.format(limit=self.frames if key_type == "traceback" else 1):
+                out.write(f"    {line}\n")
+        return out.getvalue()
+
+    def _take(self):
+        # Leave out tracemalloc's own bookkeeping and import machinery
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+
+profiler = Profiler()
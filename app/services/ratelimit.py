@@ -0,0 +1,213 @@
+import math
+import threading
+import time
+from flask import request, session, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request methods that write to the database (and, for /forgot_password, send mail)
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+# SQL statements that need SQLite's writer lock
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+WRITE_WAIT_SMOOTHING = 0.2      # weight of each new write statement in the average
+WRITE_WAIT_HALF_LIFE = 5.0      # seconds; the average halves over this when no write is measured
+
+#==========================================================================================================
+# STORAGE BACKENDS
+#==========================================================================================================
+
+class MemoryBackend:
+    """Token buckets kept in this process.
+
+    Each bucket is a (tokens, timestamp) tuple. A bucket that has refilled completely holds no information,
+    so it is dropped by the periodic sweep; the store only ever holds clients that were active recently.
+    """
+
+    def __init__(self, sweep_interval=60):
+        self._buckets = {}      # key -> (tokens, timestamp, expires_at)
+        self._lock = threading.Lock()
+        self._sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def take(self, keys, rate, capacity, now=None):
+        """Take one token from each bucket, or from none unless all have one.
+
+        Returns (allowed, seconds until every bucket has a token).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            levels = {}
+            for key in keys:
+                tokens, stamp, _ = self._buckets.get(key, (capacity, now, now))
+                levels[key] = min(capacity, tokens + (now - stamp) * rate)
+            allowed = all(tokens >= 1 for tokens in levels.values())
+            for key, tokens in levels.items():
+                if allowed:
+                    tokens -= 1
+                self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            return allowed, 0.0 if allowed else (1 - min(levels.values())) / rate
+
+    def _sweep(self, now):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        self._next_sweep = now + self._sweep_interval
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisBackend:
+    """Token buckets shared by every worker, stored in Redis (or any server speaking its protocol).
+
+    The refill-and-take step runs as one Lua script over all of a request's buckets, so concurrent workers
+    never race on a bucket.
+    """
+
+    SCRIPT = """
+    local rate, capacity, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local levels, lowest = {}, capacity
+    for i, key in ipairs(KEYS) do
+        local bucket = redis.call('HMGET', key, 'tokens', 'stamp')
+        local tokens = tonumber(bucket[1]) or capacity
+        local stamp = tonumber(bucket[2]) or now
+        levels[i] = math.min(capacity, tokens + (now - stamp) * rate)
+        lowest = math.min(lowest, levels[i])
+    end
+    local allowed = 0
+    if lowest >= 1 then
+        allowed = 1
+    end
+    for i, key in ipairs(KEYS) do
+        local tokens = levels[i] - allowed
+        redis.call('HSET', key, 'tokens', tokens, 'stamp', now)
+        redis.call('PEXPIRE', key, math.ceil((capacity - tokens) / rate * 1000) + 1000)
+    end
+    return {allowed, tostring(lowest)}
+    """
+
+    def __init__(self, url, prefix="ratelimit:"):
+        import redis    # optional dependency, only needed when RATELIMIT_STORAGE_URL is set
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+        self._prefix = prefix
+
+    def take(self, keys, rate, capacity, now=None):
+        now = time.time() if now is None else now
+        allowed, tokens = self._script(keys=[self._prefix + key for key in keys], args=[rate, capacity, now])
+        return bool(allowed), 0.0 if allowed else (1 - float(tokens)) / rate
+
+#==========================================================================================================
+# FLASK EXTENSION
+#==========================================================================================================
+
+def parse_limit(limit):
+    """'10/minute' -> (refill rate per second, bucket capacity)"""
+    count, period = limit.split("/")
+    count = int(count)
+    return count / PERIODS[period.strip()], count
+
+
+class RateLimiter:
+    """Per-IP and per-user token buckets for write requests, plus load shedding while SQLite writes queue up.
+
+    Every process sees the same writer lock, so each one measures it from its own write statements: their
+    latency, averaged over the last few seconds, is mostly time spent waiting (busy_timeout) for other
+    writers. Above RATELIMIT_MAX_WRITE_WAIT new write requests get a 503 instead of joining the queue; the
+    average decays while they are refused, so writes are let through again within seconds.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self._write_wait = 0.0      # decaying average of write statement latency, seconds
+        self._write_wait_stamp = time.monotonic()
+        self._write_wait_lock = threading.Lock()
+        self._engine_events = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RATELIMIT_ENABLED", True)
+        app.config.setdefault("RATELIMIT_STORAGE_URL", None)
+        app.config.setdefault("RATELIMITS", {})
+        app.config.setdefault("RATELIMIT_MAX_WRITE_WAIT", 1.0)
+
+        url = app.config["RATELIMIT_STORAGE_URL"]
+        self.backend = RedisBackend(url) if url else MemoryBackend()
+        self._limits = {name: parse_limit(limit) for name, limit in app.config["RATELIMITS"].items()}
+        self._max_write_wait = app.config["RATELIMIT_MAX_WRITE_WAIT"]
+        self._enabled = app.config["RATELIMIT_ENABLED"]
+
+        app.before_request(self._before_request)
+        if not self._engine_events:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+            self._engine_events = True
+        app.extensions["ratelimit"] = self
+
+    def limit_for(self, endpoint):
+        """(name, limit) configured for an endpoint ('auth.login'), falling back to its blueprint ('trips').
+
+        Buckets are keyed by that name, so a blueprint limit is shared by all of the blueprint's endpoints.
+        """
+        if not endpoint:
+            return None, None
+        for name in (endpoint, endpoint.split(".", 1)[0]):
+            if name in self._limits:
+                return name, self._limits[name]
+        return None, None
+
+    @property
+    def write_wait(self):
+        """Recent average write statement latency in this process, in seconds"""
+        with self._write_wait_lock:
+            return self._write_wait * _decay(time.monotonic() - self._write_wait_stamp)
+
+    def _before_request(self):
+        if not self._enabled or request.method not in WRITE_METHODS:
+            return None
+
+        name, limit = self.limit_for(request.endpoint)
+        if limit:
+            rate, capacity = limit
+            keys = [f"{name}:ip:{request.remote_addr}"]
+            if "user_id" in session:
+                keys.append(f"{name}:user:{session['user_id']}")
+            # All or nothing: a request refused by one bucket takes no token from the other
+            allowed, retry_after = self.backend.take(keys, rate, capacity)
+            if not allowed:
+                return _refuse(429, "Too many requests. Please slow down.", retry_after)
+
+        # Shed load instead of queueing behind SQLite's single writer lock
+        if self.write_wait > self._max_write_wait:
+            return _refuse(503, "The server is busy. Please try again shortly.", WRITE_WAIT_HALF_LIFE)
+        return None
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_ratelimit_start", None)
+        if start is None or not statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+            return
+        now = time.monotonic()
+        with self._write_wait_lock:
+            # Moving average over statements, which also fades with time since the last one
+            current = self._write_wait * _decay(now - self._write_wait_stamp)
+            self._write_wait = current + WRITE_WAIT_SMOOTHING * (now - start - current)
+            self._write_wait_stamp = now
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._ratelimit_start = time.monotonic()
+
+
+def _decay(elapsed):
+    return 0.5 ** (elapsed / WRITE_WAIT_HALF_LIFE)
+
+
+def _refuse(status, message, retry_after):
+    return Response(message, status=status, headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+                    mimetype="text/plain")
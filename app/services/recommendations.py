@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import Counter
+from itertools import combinations
+from sqlalchemy import func, select
+from app import db
+from app.services.metrics import metrics
+
+try:        # optional: the full rebuild multiplies sparse matrices when scipy is available
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+NEIGHBOURS_CACHED = 50      # best co-occurring destinations kept per destination
+CACHE_TTL = 300             # seconds; other worker processes pick up changes at least this often
+
+#==========================================================================================================
+# TOP-K CACHE
+#==========================================================================================================
+
+class _TopKCache:
+    """Small TTL cache: key -> ranked [(destination_id, score), ...]"""
+
+    def __init__(self, name, ttl=CACHE_TTL):
+        self.name = name
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._ttl = ttl
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            found = {key: entry[1] for key in keys
+                     if (entry := self._entries.get(key)) is not None and entry[0] > now}
+        metrics.cache_lookup(self.name, hits=len(found), misses=len(keys) - len(found))
+        return found
+
+    def put(self, key, ranked):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, ranked)
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_neighbours = _TopKCache("destination_neighbours")     # destination id -> neighbours by co-occurrence count
+_for_user = _TopKCache("user_recommendations")          # user id -> recommended destinations
+
+#==========================================================================================================
+# QUERIES
+#==========================================================================================================
+
+def similar_destinations(destination_id, k=5):
+    """Destinations most often favorited together with this one: [(FavoriteDestination, count), ...]"""
+    return _resolve(neighbours([destination_id])[destination_id][:k])
+
+
+def similar_for_each(destination_ids, k=3):
+    """{destination id: [(FavoriteDestination, count), ...]} for a page of destinations, in two queries"""
+    ranked = {dest_id: ranks[:k] for dest_id, ranks in neighbours(destination_ids).items()}
+    destinations = _load({other for ranks in ranked.values() for other, _ in ranks})
+    return {dest_id: [(destinations[other], score) for other, score in ranks if other in destinations]
+            for dest_id, ranks in ranked.items()}
+
+
+def recommend_for_user(user, k=5):
+    """Destinations the user has not favorited, scored by co-occurrence with the ones they have"""
+    cached = _for_user.get_many([user.id])
+    if user.id not in cached:
+        favorites = {dest.id for dest in user.favorite_destinations}
+        scores = Counter()
+        for ranks in neighbours(favorites).values():
+            for other, count in ranks:
+                if other not in favorites:
+                    scores[other] += count
+        cached[user.id] = scores.most_common(NEIGHBOURS_CACHED)
+        _for_user.put(user.id, cached[user.id])
+    return _resolve(cached[user.id][:k])
+
+
+def neighbours(destination_ids):
+    """Ranked neighbour lists from the cache; misses are filled by one windowed query"""
+    from app.models import DestinationCooccurrence
+
+    destination_ids = set(destination_ids)
+    found = _neighbours.get_many(destination_ids)
+    missing = destination_ids - found.keys()
+    if missing:
+        table = DestinationCooccurrence.__table__
+        rank = func.row_number().over(
+            partition_by=table.c.destination_id, order_by=(table.c.count.desc(), table.c.other_id)
+        ).label("rank")
+        ranked = select(table.c.destination_id, table.c.other_id, table.c.count, rank).where(
+            table.c.destination_id.in_(missing)).subquery()
+        rows = db.session.execute(
+            select(ranked.c.destination_id, ranked.c.other_id, ranked.c.count)
+            .where(ranked.c.rank <= NEIGHBOURS_CACHED)
+            .order_by(ranked.c.destination_id, ranked.c.rank)
+        )
+        filled = {dest_id: [] for dest_id in missing}
+        for dest_id, other, count in rows:
+            filled[dest_id].append((other, count))
+        for dest_id, ranks in filled.items():
+            _neighbours.put(dest_id, ranks)
+        found.update(filled)
+    return found
+
+
+def invalidate(destination_ids, user_id=None):
+    """Drop cached rankings touched by a favorite being added or removed"""
+    _neighbours.discard(destination_ids)
+    if user_id is not None:
+        _for_user.discard([user_id])
+
+#==========================================================================================================
+# FULL REBUILD
+#==========================================================================================================
+
+def rebuild(batch_size=1000):
+    """Recompute the whole co-occurrence matrix from user_favorite_destinations; returns the pair count"""
+    from app.models import DestinationCooccurrence, user_favorite_destinations
+
+    session = db.session
+    favorites = session.execute(
+        select(user_favorite_destinations.c.user_id, user_favorite_destinations.c.destination_id)).all()
+    pairs = _cooccurrence_sparse(favorites) if sparse is not None else _cooccurrence_python(favorites)
+
+    session.query(DestinationCooccurrence).delete(synchronize_session=False)
+    for start in range(0, len(pairs), batch_size):
+        session.execute(DestinationCooccurrence.__table__.insert(), [
+            {"destination_id": a, "other_id": b, "count": count} for a, b, count in pairs[start:start + batch_size]
+        ])
+    session.commit()
+
+    _neighbours.clear()
+    _for_user.clear()
+    return len(pairs)
+
+
+def _cooccurrence_sparse(favorites):
+    """C = XᵀX for the binary user x destination matrix X, diagonal dropped"""
+    if not favorites:
+        return []
+    users, destinations = (np.asarray(column) for column in zip(*favorites))
+    user_index, user_rows = np.unique(users, return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(users), dtype=np.int32), (user_rows, destinations)),
+                               shape=(len(user_index), destinations.max() + 1))
+    product = (matrix.T @ matrix).tocoo()
+    off_diagonal = product.row != product.col
+    return list(zip(product.row[off_diagonal].tolist(), product.col[off_diagonal].tolist(),
+                    product.data[off_diagonal].tolist()))
+
+
+def _cooccurrence_python(favorites):
+    by_user = {}
+    for user_id, destination_id in favorites:
+        by_user.setdefault(user_id, []).append(destination_id)
+    counts = Counter()
+    for destination_ids in by_user.values():
+        for a, b in combinations(sorted(set(destination_ids)), 2):
+            counts[a, b] += 1
+    return [pair for (a, b), count in counts.items() for pair in ((a, b, count), (b, a, count))]
+
+#==========================================================================================================
+
+def _resolve(ranked):
+    destinations = _load([dest_id for dest_id, _ in ranked])
+    return [(destinations[dest_id], score) for dest_id, score in ranked if dest_id in destinations]
+
+
+def _load(destination_ids):
+    from app.models import FavoriteDestination
+    if not destination_ids:
+        return {}
+    query = FavoriteDestination.query.filter(FavoriteDestination.id.in_(destination_ids))
+    return {dest.id: dest for dest in query}
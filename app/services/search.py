@@ -0,0 +1,145 @@
+import re
+from collections import namedtuple
+from markupsafe import Markup, escape
+from sqlalchemy import column, event, func, literal, literal_column, null, or_, select, table, text, union_all
+from app import db
+from app.services import shards
+
+# Full-text search over a user's trips. Each searched table has an FTS5 index, <table>_fts, that stores only
+# the inverted index: it is an "external content" table, reading the text back from the table itself when
+# results are highlighted. Triggers keep it in step with every write, including bulk INSERT ... SELECT and
+# DELETE statements that skip the ORM. A query matches each index, keeps rows from the user's trips (and the
+# user's own tasks), and ranks everything together by BM25.
+
+# table -> (search kind, indexed columns, BM25 weight of each column)
+INDEXES = {
+    "trip": ("trip", ("title", "description"), (10.0, 2.0)),
+    "trip_destination": ("destination", ("name",), (5.0,)),
+    "itinerary_item": ("itinerary", ("title", "location", "notes"), (10.0, 4.0, 1.0)),
+    "expense": ("expense", ("description",), (3.0,)),
+    "task": ("task", ("title",), (5.0,)),
+}
+TOKENIZER = "unicode61 remove_diacritics 2"
+MAX_TERMS = 8
+
+# Highlight markers no user text contains; swapped for <mark> after the text is HTML-escaped
+_OPEN, _CLOSE = "\x02", "\x03"
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+Hit = namedtuple("Hit", "kind id trip_id title snippet rank")
+
+#==========================================================================================================
+# INDEX DDL
+#==========================================================================================================
+
+def attach(metadata):
+    """Create the indexes whenever the schema is created (see app/schema.py)"""
+    def _create(target, connection, **kw):
+        if connection.dialect.name == "sqlite":
+            create_indexes(connection)
+    event.listen(metadata, "after_create", _create)
+
+
+def create_indexes(connection):
+    """Create missing FTS5 indexes (filled from their table) and triggers for the tables in this database"""
+    existing = set(connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).scalars())
+    for name, (_, columns, _) in INDEXES.items():
+        if name not in existing:
+            continue                    # e.g. task on a trip shard
+        fts = f"{name}_fts"
+        if fts not in existing:
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5({', '.join(columns)}, content='{name}', "
+                f"content_rowid='id', tokenize='{TOKENIZER}', prefix='2 3')"
+            ))
+            connection.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+        create_triggers(connection, name)
+
+
+def create_triggers(connection, name):
+    """(Re)create a table's sync triggers; dropping a table drops its triggers with it"""
+    _, columns, _ = INDEXES[name]
+    fts = f"{name}_fts"
+    names = ", ".join(columns)
+    new = ", ".join(f"new.{c}" for c in columns)
+    old = ", ".join(f"old.{c}" for c in columns)
+    insert = f"INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {new});"
+    delete = f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    for statement in (
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {name} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {name} BEGIN {delete} END",
+        # Only edits of the indexed text touch the index, not version bumps or timestamp updates
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {names} ON {name} BEGIN {delete} {insert} END",
+    ):
+        connection.execute(text(statement))
+
+#==========================================================================================================
+# QUERIES
+#==========================================================================================================
+
+def match_expression(query):
+    """FTS5 query for free text: every word must appear, as a word or a word prefix ("muse" finds "museum").
+
+    Words are quoted, so FTS5 operators and punctuation typed by the user are matched as plain text.
+    """
+    terms = _TERM.findall(query or "")[:MAX_TERMS]
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search(user_id, query, limit=20):
+    """Best [Hit, ...] for the query among everything the user can see, with the matches highlighted"""
+    match = match_expression(query)
+    if not match:
+        return []
+
+    from app.models import trip_users
+    trip_ids = select(trip_users.c.trip_id).where(trip_users.c.user_id == user_id)
+    if shards.router.enabled:       # trip_users is global: resolve it before querying the trip shards
+        trip_ids = db.session.scalars(trip_ids).all()
+
+    statements = [_matches(name, match, trip_ids, user_id, limit) for name in INDEXES]
+    if shards.router.enabled:
+        # The indexes live in different databases: each runs on its own, the best hits are merged here
+        rows = sorted((row for statement in statements for row in db.session.execute(statement)),
+                      key=lambda row: row.rank)[:limit]
+    else:
+        combined = union_all(*(select(statement.subquery()) for statement in statements)).subquery()
+        rows = db.session.execute(select(combined).order_by(combined.c.rank).limit(limit)).all()
+    return [Hit(row.kind, row.id, row.trip_id, _markup(row.title), _markup(row.snippet), row.rank) for row in rows]
+
+
+def _matches(name, match, trip_ids, user_id, limit):
+    from app.models import Budget, Expense, ItineraryItem, Task, Trip, TripDestination
+    kind, columns, weights = INDEXES[name]
+    fts = table(f"{name}_fts", column("rowid"))
+    index = literal_column(fts.name)            # the hidden column FTS5's functions and MATCH take
+
+    model = {"trip": Trip, "trip_destination": TripDestination, "itinerary_item": ItineraryItem,
+             "expense": Expense, "task": Task}[name]
+    snippet = func.snippet(index, -1, _OPEN, _CLOSE, "…", 12) if len(columns) > 1 else null()
+    statement = select(
+        literal(kind).label("kind"),
+        model.id.label("id"),
+        (model.id if model is Trip else Budget.trip_id if model is Expense else model.trip_id).label("trip_id"),
+        func.highlight(index, 0, _OPEN, _CLOSE).label("title"),
+        snippet.label("snippet"),
+        func.bm25(index, *weights).label("rank"),
+    ).select_from(fts).join(model.__table__, model.id == fts.c.rowid).where(index.op("MATCH")(match))
+
+    if model is Trip:
+        statement = statement.where(Trip.id.in_(trip_ids))
+    elif model is Expense:
+        statement = statement.join(Budget, Budget.id == Expense.budget_id).where(Budget.trip_id.in_(trip_ids))
+    elif model is Task:
+        # Checklist items of the user's trips, and the user's own to-do list
+        statement = statement.where(or_(Task.trip_id.in_(trip_ids),
+                                        db.and_(Task.trip_id.is_(None), Task.user_id == user_id)))
+    else:
+        statement = statement.where(model.trip_id.in_(trip_ids))
+    return statement.order_by(literal_column("rank")).limit(limit)
+
+
+def _markup(value):
+    if value is None:
+        return None
+    return Markup(str(escape(value)).replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>"))
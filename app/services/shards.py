@@ -0,0 +1,426 @@
+import itertools
+import math
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import MetaData, bindparam, inspect, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.sql.util import find_tables
+from app import db
+from app.services import geo
+
+# Trip data can be spread over several SQLite files. The global database (todo.db, shard "0") keeps users,
+# auth, tasks, favorites, the change log and the trip_users / expense_shared association tables; trips and
+# the rows stored per trip live on one of TRIP_SHARDS trip databases (shards "1".."N"), picked round-robin
+# when the trip is created. With TRIP_SHARDS = 0 (the default) nothing is routed and db.session is the
+# usual Flask-SQLAlchemy session.
+#
+# Every trip table on a shard uses AUTOINCREMENT, and shard k hands out ids from k << SHARD_BITS, so ids are
+# unique across shards and a trip's shard is its id >> SHARD_BITS, unless `flask rebalance-shards` moved it
+# (trip_shard then has a row for it). Trips created before sharding was enabled stay on the global database
+# until a rebalance moves them.
+#
+# Statements are routed by the tables they touch: global tables go to the global database, a trip's
+# children follow the trip, and `trip.id` / `trip_id` criteria pick the shards of those trips. Anything
+# else on trip tables runs on every shard and the rows are concatenated, so ORDER BY, LIMIT and aggregates
+# apply per shard. One statement cannot join global and trip tables, and a commit touching both is two
+# SQLite transactions, not one.
+
+GLOBAL_SHARD = "0"
+SHARD_BITS = 40
+TRIP_TABLES = ("trip", "trip_destination", "itinerary_item", "budget", "planned_budget", "expense", "review")
+
+_PINNED = "trip_shard"      # db.session.info key set by pinned()
+
+#==========================================================================================================
+# FLASK EXTENSION
+#==========================================================================================================
+
+class ShardRouter:
+    """Chooses the database for every statement, row write and identity lookup of db.session"""
+
+    def __init__(self, app=None):
+        self.count = 0
+        self._directory = None      # trip id -> shard for moved trips, read once per process
+        self._placement = itertools.count()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # Runs before db.init_app(), which creates one engine per SQLALCHEMY_BINDS entry
+        app.config.setdefault("TRIP_SHARDS", 0)
+        app.config.setdefault("TRIP_SHARD_URI", "sqlite:///trips_{shard}.db")
+        self.count = app.config["TRIP_SHARDS"]
+        self._directory = None
+
+        binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+        for shard in self.trip_shards():
+            binds.setdefault(_bind_key(shard), app.config["TRIP_SHARD_URI"].format(shard=shard))
+        if self.count and not issubclass(db.session.session_factory.class_, RoutingSession):
+            db.session = db._make_scoped_session({"class_": RoutingSession})
+        app.extensions["shards"] = self
+
+    @property
+    def enabled(self):
+        return self.count > 0
+
+    def trip_shards(self):
+        return [str(k) for k in range(1, self.count + 1)]
+
+    def shards(self):
+        return [GLOBAL_SHARD] + self.trip_shards()
+
+    def engine(self, shard):
+        return db.engines[None if shard == GLOBAL_SHARD else _bind_key(shard)]
+
+    def shard_for_trip(self, trip_id):
+        return self._moved().get(trip_id) or shard_for_id(trip_id)
+
+    def _moved(self):
+        if self._directory is None:
+            from app.models import TripShard
+            with db.engine.connect() as conn:
+                self._directory = dict(conn.execute(select(TripShard.trip_id, TripShard.shard)).all())
+        return self._directory
+
+    #------------------------------------------------------------------------------------------------------
+
+    def shard_chooser(self, mapper, instance, clause=None, **kw):
+        """Shard for a row being flushed. Writes without an instance are association rows, which are global."""
+        if instance is None or mapper.local_table.name not in TRIP_TABLES:
+            return GLOBAL_SHARD
+        if mapper.local_table.name == "trip":
+            trip_shards = self.trip_shards()
+            return trip_shards[next(self._placement) % len(trip_shards)]
+        return self._parent_shard(instance)
+
+    def identity_chooser(self, mapper, primary_key, *, lazy_loaded_from=None, **kw):
+        """Shards to search the identity map on for a primary key"""
+        if mapper.local_table.name not in TRIP_TABLES:
+            return [GLOBAL_SHARD]
+        if lazy_loaded_from is not None and lazy_loaded_from.mapper.local_table.name in TRIP_TABLES:
+            return [lazy_loaded_from.identity_token]
+        if mapper.local_table.name == "trip":
+            return [self.shard_for_trip(primary_key[0])]
+        home = shard_for_id(primary_key[0])
+        return [home] + [shard for shard in self.shards() if shard != home]
+
+    def execute_chooser(self, context):
+        """Shards a statement runs on; the results of several shards are merged (scatter-gather)"""
+        tables = {table.name for table in find_tables(context.statement, include_crud=True, include_joins=True)}
+        pinned = context.session.info.get(_PINNED)
+        if not tables:                      # text(): raw SQL on the global database unless pinned
+            return [pinned or GLOBAL_SHARD]
+        if tables.isdisjoint(TRIP_TABLES):
+            return [GLOBAL_SHARD]
+        if pinned:
+            return [pinned]
+        parent = context.lazy_loaded_from
+        if parent is not None and parent.mapper.local_table.name in TRIP_TABLES:
+            return [parent.identity_token]  # a trip's children live with it
+        trip_ids = _trip_ids(context.statement, context.parameters)
+        if trip_ids is not None:
+            return sorted({self.shard_for_trip(trip_id) for trip_id in trip_ids}) or [GLOBAL_SHARD]
+        return self.shards()
+
+    def _parent_shard(self, instance):
+        from app.models import Budget
+        session = object_session(instance)
+        parent = instance.__dict__.get("trip") or instance.__dict__.get("budget")   # set through a backref
+        if parent is None and getattr(instance, "trip_id", None) is not None:
+            return self.shard_for_trip(instance.trip_id)
+        if parent is None and getattr(instance, "budget_id", None) is not None:
+            with session.no_autoflush:
+                parent = session.get(Budget, instance.budget_id)
+        if parent is None:
+            raise ValueError(f"{instance!r} belongs to no trip, so it has no shard")
+        state = inspect(parent)
+        if state.key is not None:
+            return state.key[2]
+        if state.identity_token is None:
+            state.identity_token = self.shard_chooser(state.mapper, parent)
+        return state.identity_token
+
+
+class RoutingSession(ShardedSession):
+    """db.session while TRIP_SHARDS is set: a sharded session over the global database and the trip shards"""
+
+    def __init__(self, db, **options):
+        router = current_app.extensions["shards"]
+        super().__init__(
+            shard_chooser=router.shard_chooser,
+            identity_chooser=router.identity_chooser,
+            execute_chooser=router.execute_chooser,
+            shards={shard: router.engine(shard) for shard in router.shards()},
+            **options,
+        )
+
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        if shard_id is None and mapper is None and instance is None:
+            shard_id = GLOBAL_SHARD         # session.connection(): the change log and other global writes
+        return super().get_bind(mapper, shard_id=shard_id, instance=instance, clause=clause, **kw)
+
+
+def _bind_key(shard):
+    return f"trip_shard_{shard}"
+
+
+def shard_for_id(row_id):
+    return str(row_id >> SHARD_BITS)
+
+
+def _trip_ids(statement, parameters):
+    """Trip ids a statement is restricted to by `trip.id` / `<table>.trip_id` criteria in its top-level
+    AND, or None when it is not restricted (and has to run on every shard)"""
+    if getattr(statement, "select", None) is not None:     # INSERT ... SELECT
+        statement = statement.select
+    where = getattr(statement, "whereclause", None)
+    if where is None:
+        return None
+    if isinstance(where, BooleanClauseList) and where.operator is operators.and_:
+        clauses = where.clauses
+    else:
+        clauses = [where]
+
+    found = None
+    params = parameters if isinstance(parameters, dict) else {}
+    for clause in clauses:
+        if not isinstance(clause, BinaryExpression) or not isinstance(clause.right, BindParameter):
+            continue
+        column = clause.left
+        table = getattr(column, "table", None)
+        if table is None or table.name not in TRIP_TABLES:
+            continue
+        if column.key != "trip_id" and not (table.name == "trip" and column.key == "id"):
+            continue
+        value = params.get(clause.right.key, clause.right.effective_value)
+        if clause.operator is operators.eq:
+            values = {value}
+        elif clause.operator is operators.in_op:
+            values = set(value or ())
+        else:
+            continue
+        found = values if found is None else found & values
+    return found
+
+#==========================================================================================================
+# HELPERS
+#==========================================================================================================
+
+def shard_of(obj):
+    """Shard holding a loaded row ("0" when unsharded)"""
+    return inspect(obj).identity_token or GLOBAL_SHARD
+
+
+@contextmanager
+def pinned(shard):
+    """Run every trip-table statement (and raw SQL) of db.session on one shard; no effect when unsharded"""
+    info = db.session.info
+    previous = info.get(_PINNED)
+    info[_PINNED] = shard
+    try:
+        yield
+    finally:
+        info[_PINNED] = previous
+
+
+def trips_for_user(user_id):
+    """A user's trips, gathered from the shards that hold them (one statement per shard), in id order"""
+    from app.models import Trip, trip_users
+
+    trip_ids = db.session.scalars(select(trip_users.c.trip_id).where(trip_users.c.user_id == user_id)).all()
+    if not trip_ids:
+        return []
+    return sorted(Trip.query.filter(Trip.id.in_(trip_ids)), key=lambda trip: trip.id)
+
+#==========================================================================================================
+# SHARD SCHEMA
+#==========================================================================================================
+
+def shard_metadata():
+    """The trip tables as created on a trip shard: AUTOINCREMENT ids, no foreign keys into the global database"""
+    metadata = MetaData()
+    for name in TRIP_TABLES:
+        table = db.metadata.tables[name].to_metadata(metadata)
+        table.dialect_options["sqlite"]["autoincrement"] = True
+        for constraint in list(table.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split(".")[0] not in TRIP_TABLES:
+                table.constraints.discard(constraint)
+                for fk in constraint.elements:
+                    fk.parent.foreign_keys.discard(fk)
+                    table.foreign_keys.discard(fk)
+    return metadata
+
+
+def create_shard(shard, upgrade):
+    """Create or upgrade a trip shard's tables; a new shard starts its id sequences at shard << SHARD_BITS"""
+    from app.models import ItineraryItem
+    from app.services import search
+
+    engine = router.engine(shard)
+    metadata = shard_metadata()
+    metadata.create_all(engine)
+    upgrade(engine, metadata)
+    with engine.begin() as conn:
+        conn.execute(geo.spatial_index_ddl(ItineraryItem))
+        search.create_indexes(conn)
+        conn.execute(text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"
+        ), [{"name": name, "seq": int(shard) << SHARD_BITS} for name in TRIP_TABLES])
+
+
+def prepare_global_trip_tables():
+    """Rebuild the global database's trip tables with AUTOINCREMENT, once, when sharding is enabled.
+
+    Without it SQLite may hand the id of a trip (or child row) moved to another shard out again, and the
+    same id would then exist on two shards. Returns the names of the rebuilt tables.
+    """
+    rebuilt = []
+    with db.engine.begin() as conn:
+        for name in TRIP_TABLES:
+            sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                               {"name": name}).scalar()
+            if sql is not None and "AUTOINCREMENT" not in sql.upper():
+                _rebuild_with_autoincrement(conn, db.metadata.tables[name])
+                rebuilt.append(name)
+    return rebuilt
+
+
+def _rebuild_with_autoincrement(conn, table):
+    # SQLite cannot alter a primary key: create the new table, copy, drop the old one, rename the new one
+    from app.services import search
+
+    metadata = MetaData()
+    for other in db.metadata.tables.values():
+        other.to_metadata(metadata)
+    replacement = table.to_metadata(metadata, name=f"{table.name}_rebuild")
+    replacement.dialect_options["sqlite"]["autoincrement"] = True
+    replacement.indexes.clear()         # same names as the old table's; created again after the rename
+    replacement.create(conn)
+
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    conn.execute(text(f'INSERT INTO "{replacement.name}" ({columns}) SELECT {columns} FROM "{table.name}"'))
+    conn.execute(text(f'DROP TABLE "{table.name}"'))
+    conn.execute(text(f'ALTER TABLE "{replacement.name}" RENAME TO "{table.name}"'))
+    for index in table.indexes:
+        index.create(conn)
+    if table.name in search.INDEXES:
+        search.create_triggers(conn, table.name)     # dropped with the old table; the ids, and so the index, are unchanged
+
+#==========================================================================================================
+# REBALANCING
+#==========================================================================================================
+
+def trip_counts():
+    """{shard: number of trips stored there}"""
+    counts = {}
+    for shard in router.shards():
+        with router.engine(shard).connect() as conn:
+            counts[shard] = conn.execute(text("SELECT count(*) FROM trip")).scalar()
+    return counts
+
+
+def rebalance(limit=None, dry_run=False):
+    """Move trips until every trip shard holds about the same number; trips still on the global database
+    move first. Returns the moves as [(trip id, from shard, to shard), ...].
+
+    Run it while the app is stopped (or restart the workers afterwards): workers read the moved-trip
+    directory once, when they route their first trip.
+    """
+    counts = trip_counts()
+    trip_shards = router.trip_shards()
+    per_shard = math.ceil(sum(counts.values()) / len(trip_shards))
+
+    moves = []
+    for shard in router.shards():
+        excess = counts[shard] - (0 if shard == GLOBAL_SHARD else per_shard)
+        if excess <= 0:
+            continue
+        with router.engine(shard).connect() as conn:
+            trip_ids = conn.execute(text("SELECT id FROM trip ORDER BY id DESC LIMIT :n"), {"n": excess}).scalars()
+            for trip_id in trip_ids:
+                target = min(trip_shards, key=counts.get)
+                if counts[target] >= per_shard or (limit is not None and len(moves) >= limit):
+                    break
+                moves.append((trip_id, shard, target))
+                counts[shard] -= 1
+                counts[target] += 1
+
+    if not dry_run:
+        for trip_id, _, target in moves:
+            move_trip(trip_id, target)
+    return moves
+
+
+def move_trip(trip_id, target):
+    """Copy a trip and every row stored with it to another shard, point the directory at the copy, then
+    delete the original. Ids are kept, so links, the change log and clients are unaffected.
+
+    The steps are separate transactions on separate files: if one fails, the trip stays readable where the
+    directory points, and a leftover copy can be removed by moving the trip again.
+    """
+    from app.models import ItineraryItem, TripShard
+
+    source = router.shard_for_trip(trip_id)
+    if source == target:
+        return False
+    tables = [db.metadata.tables[name] for name in TRIP_TABLES]     # parents first
+
+    with router.engine(source).connect() as conn:
+        rows = _trip_rows(conn, tables, trip_id)
+    item_ids = [row["id"] for row in rows["itinerary_item"]]
+    rtree = ItineraryItem.__rtree__
+
+    with router.engine(target).begin() as conn:
+        sequences = conn.execute(text("SELECT name, seq FROM sqlite_sequence")).all()
+        for table in tables:
+            if rows[table.name]:
+                conn.execute(table.delete().where(table.c.id.in_([row["id"] for row in rows[table.name]])))
+                conn.execute(table.insert(), rows[table.name])
+        if item_ids:
+            conn.execute(text(f"DELETE FROM {rtree} WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                         {"ids": item_ids})
+            conn.execute(text(
+                f"INSERT INTO {rtree} SELECT id, latitude, latitude, longitude, longitude "
+                f"FROM itinerary_item WHERE id IN :ids AND latitude IS NOT NULL AND longitude IS NOT NULL"
+            ).bindparams(bindparam("ids", expanding=True)), {"ids": item_ids})
+        # Explicit ids from another shard's range must not move this shard's id sequences
+        conn.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = :name"),
+                     [{"name": name, "seq": seq} for name, seq in sequences])
+
+    with db.engine.begin() as conn:
+        statement = sqlite_insert(TripShard.__table__).values(trip_id=trip_id, shard=target)
+        conn.execute(statement.on_conflict_do_update(index_elements=["trip_id"], set_={"shard": target}))
+    router._moved()[trip_id] = target
+
+    with router.engine(source).begin() as conn:
+        for table in reversed(tables):
+            if rows[table.name]:
+                conn.execute(table.delete().where(table.c.id.in_([row["id"] for row in rows[table.name]])))
+        if item_ids:
+            conn.execute(text(f"DELETE FROM {rtree} WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                         {"ids": item_ids})
+    return True
+
+
+def _trip_rows(conn, tables, trip_id):
+    rows, budget_ids = {}, []
+    for table in tables:
+        if table.name == "trip":
+            condition = table.c.id == trip_id
+        elif "trip_id" in table.c:
+            condition = table.c.trip_id == trip_id
+        else:
+            condition = table.c.budget_id.in_(budget_ids)
+        rows[table.name] = [dict(row) for row in conn.execute(select(table).where(condition)).mappings()]
+        if table.name == "budget":
+            budget_ids = [row["id"] for row in rows["budget"]]
+    return rows
+
+
+# Shared instance, initialised in create_app()
+router = ShardRouter()
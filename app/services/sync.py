@@ -0,0 +1,134 @@
+from sqlalchemy import or_, select
+from app import db
+from app.models import ChangeLog, Budget, User, trip_users
+from app.services.changes import MODELS_BY_TYPE, PARTICIPANT, serialize
+
+# Entity types stored per trip; planned budgets and expenses reach their trip through the budget.
+# Tasks belong to a trip when they are on its shared checklist.
+TRIP_TYPES = ("trip", "destination", "itinerary", "budget", "planned_budget", "expense", "task")
+
+#==========================================================================================================
+
+class ResyncRequired(Exception):
+    """The client's sequence number is older than the retained change log"""
+
+
+def changes_since(user_id, since, limit):
+    """Compacted deltas after `since` for everything the user can see.
+
+    Returns {"upserts": [...], "deletes": [...], "next": seq, "has_more": bool}. Only the last state of each
+    entity is sent, so a client that was offline pays for the number of changed rows, not every change.
+    """
+    oldest = ChangeLog.oldest_seq()
+    if since and (oldest is None or since < oldest - 1):
+        raise ResyncRequired()
+
+    my_trips = select(trip_users.c.trip_id).where(trip_users.c.user_id == user_id)
+    rows = ChangeLog.query.filter(
+        ChangeLog.seq > since,
+        or_(ChangeLog.trip_id.in_(my_trips), ChangeLog.user_id == user_id),
+    ).order_by(ChangeLog.seq).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Compact: keep the first and last operation seen for each entity
+    entities = {}
+    for row in rows:
+        if row.entity_type == PARTICIPANT and row.user_id != user_id and row.trip_id is not None:
+            key = (PARTICIPANT, row.trip_id, row.entity_id)
+        else:
+            key = (row.entity_type, None, row.entity_id)
+        first = entities[key][0] if key in entities else row.op
+        entities[key] = (first, row.op, row.trip_id)
+
+    upserts, deletes = [], []
+    joined_trips, new_participants, to_load = set(), [], {}
+    for (kind, _, entity_id), (first, last, trip_id) in entities.items():
+        if first == "insert" and last == "delete":
+            continue                            # created and removed while the client was away
+        if kind == PARTICIPANT and entity_id == user_id:
+            if last == "delete":
+                deletes.append({"type": "trip", "id": trip_id})   # the client drops the trip and its children
+            else:
+                joined_trips.add(trip_id)
+        elif kind == PARTICIPANT:
+            if last == "delete":
+                deletes.append({"type": PARTICIPANT, "id": entity_id, "trip_id": trip_id})
+            else:
+                new_participants.append((entity_id, trip_id))
+        elif last == "delete":
+            deletes.append({"type": kind, "id": entity_id, "trip_id": trip_id})
+        else:
+            to_load.setdefault(kind, {})[entity_id] = trip_id
+
+    for kind, ids in to_load.items():
+        ids = {entity_id: trip_id for entity_id, trip_id in ids.items() if trip_id not in joined_trips}
+        found = _load(kind, ids)
+        upserts.extend(found)
+        loaded = {entry["id"] for entry in found}
+        # Rows deleted after this page's last change still have to disappear on the client
+        deletes.extend({"type": kind, "id": entity_id, "trip_id": ids[entity_id]}
+                       for entity_id in ids if entity_id not in loaded)
+
+    if new_participants:
+        usernames = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_([uid for uid, _ in new_participants])))
+        upserts.extend({"type": PARTICIPANT, "id": uid, "trip_id": trip_id, "data": {"username": usernames[uid]}}
+                       for uid, trip_id in new_participants if uid in usernames and trip_id not in joined_trips)
+
+    if joined_trips:
+        upserts.extend(trip_snapshot(joined_trips))
+
+    return {
+        "upserts": upserts,
+        "deletes": deletes,
+        "next": rows[-1].seq if rows else since,
+        "has_more": has_more,
+    }
+
+
+def snapshot(user_id):
+    """Everything the user can see, plus the sequence number to sync from afterwards"""
+    latest = ChangeLog.latest_seq()      # read first: changes made meanwhile are sent again, never missed
+    trip_ids = [trip_id for trip_id, in db.session.execute(
+        select(trip_users.c.trip_id).where(trip_users.c.user_id == user_id))]
+    upserts = trip_snapshot(trip_ids)
+    model, fields = MODELS_BY_TYPE["task"]
+    upserts.extend(_entry("task", task, None, fields) for task in model.query.filter_by(user_id=user_id, trip_id=None))
+    return {"upserts": upserts, "deletes": [], "next": latest, "has_more": False}
+
+
+def trip_snapshot(trip_ids):
+    """Every synced row belonging to the given trips"""
+    trip_ids = list(trip_ids)
+    if not trip_ids:
+        return []
+
+    entries = []
+    for kind in TRIP_TYPES:
+        model, fields = MODELS_BY_TYPE[kind]
+        if kind == "trip":
+            query = db.session.query(model, model.id).filter(model.id.in_(trip_ids))
+        elif hasattr(model, "trip_id"):
+            query = db.session.query(model, model.trip_id).filter(model.trip_id.in_(trip_ids))
+        else:
+            query = db.session.query(model, Budget.trip_id).join(Budget).filter(Budget.trip_id.in_(trip_ids))
+        entries.extend(_entry(kind, obj, trip_id, fields) for obj, trip_id in query)
+
+    participants = db.session.query(User.id, User.username, trip_users.c.trip_id).join(
+        trip_users, trip_users.c.user_id == User.id).filter(trip_users.c.trip_id.in_(trip_ids))
+    entries.extend({"type": PARTICIPANT, "id": uid, "trip_id": trip_id, "data": {"username": username}}
+                   for uid, username, trip_id in participants)
+    return entries
+
+#==========================================================================================================
+
+def _load(kind, ids):
+    """Current state of changed rows; ids maps entity id -> trip id"""
+    model, fields = MODELS_BY_TYPE[kind]
+    return [_entry(kind, obj, ids[obj.id], fields) for obj in model.query.filter(model.id.in_(list(ids)))]
+
+
+def _entry(kind, obj, trip_id, fields):
+    return {"type": kind, "id": obj.id, "trip_id": trip_id, "data": serialize(obj, fields)}
@@ -0,0 +1,108 @@
+import heapq
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+#==========================================================================================================
+
+# A day of the trip with its itinerary items in (time, id) order
+TimelineDay = namedtuple("TimelineDay", ["date", "items", "in_range"])
+
+# Full timeline of a trip: day buckets, overlapping item pairs and items outside the trip dates
+Timeline = namedtuple("Timeline", ["days", "overlaps", "out_of_range"])
+
+MAX_DURATION_MINUTES = 31 * 24 * 60     # longest accepted itinerary item (a month-long booking)
+
+#==========================================================================================================
+
+def build_timeline(trip):
+    """Bucket a trip's itinerary by day and run every check over it in one pass"""
+    items = _ordered_items(trip.id)
+
+    days = []
+    for item in items:      # items arrive sorted by (date, time), so each day is one contiguous run
+        if not days or days[-1].date != item.date:
+            days.append(TimelineDay(item.date, [], trip.start_date <= item.date <= trip.end_date))
+        days[-1].items.append(item)
+
+    out_of_range = [item for day in days if not day.in_range for item in day.items]
+    return Timeline(days=days, overlaps=find_overlaps(items), out_of_range=out_of_range)
+
+#==========================================================================================================
+
+def find_overlaps(items):
+    """Return every (earlier, later) pair of timed items whose intervals intersect"""
+    intervals = sorted(
+        (interval + (item,) for item in items for interval in [item_interval(item)] if interval),
+        key=lambda entry: (entry[0], entry[1], entry[2].id or 0)
+    )
+
+    overlaps = []
+    active = []     # min-heap of (end, order, item) for the intervals still open at the sweep line
+    for order, (start, end, item) in enumerate(intervals):
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        overlaps.extend((other, item) for _, _, other in active)
+        heapq.heappush(active, (end, order, item))
+    return overlaps
+
+#==========================================================================================================
+
+def validate_item(item):
+    """Check one itinerary item against its trip, looking only at the days it can collide with"""
+    warnings = []
+    trip = item.trip
+
+    if not (trip.start_date <= item.date <= trip.end_date):
+        warnings.append(
+            f"'{item.title}' on {item.date} is outside the trip dates "
+            f"({trip.start_date} → {trip.end_date})."
+        )
+
+    interval = item_interval(item)
+    if interval:
+        # Earlier items can run into this one's day: look back as many days as the trip's longest item lasts
+        neighbours = _ordered_items(
+            trip.id,
+            first_day=item.date - timedelta(days=-(-_longest_duration(trip.id) // (24 * 60))),
+            last_day=interval[1].date()
+        )
+        for first, second in find_overlaps(neighbours):
+            if item in (first, second):
+                other = second if first is item else first
+                warnings.append(f"'{item.title}' overlaps with '{other.title}' on {other.date}.")
+    return warnings
+
+#==========================================================================================================
+
+def item_interval(item):
+    """Return the (start, end) datetimes of a timed item, or None for all-day items"""
+    if item.time is None:
+        return None
+    start = datetime.combine(item.date, item.time)
+    # An item without a duration still occupies its start minute, so two of them at the same time collide
+    end = start + timedelta(minutes=item.duration_minutes or 1)
+    return start, end
+
+
+def valid_duration(minutes):
+    """Whether a submitted duration (None for none) is acceptable"""
+    return minutes is None or 0 <= minutes <= MAX_DURATION_MINUTES
+
+
+def _longest_duration(trip_id):
+    from app.models import ItineraryItem
+    from app import db
+    return db.session.query(db.func.max(ItineraryItem.duration_minutes)).filter(
+        ItineraryItem.trip_id == trip_id).scalar() or 1
+
+
+def _ordered_items(trip_id, first_day=None, last_day=None):
+    """Load itinerary items through the (trip_id, date, time) index, already in timeline order"""
+    from app.models import ItineraryItem     # imported here because app.models imports this module
+
+    query = ItineraryItem.query.filter(ItineraryItem.trip_id == trip_id)
+    if first_day is not None:
+        query = query.filter(ItineraryItem.date >= first_day)
+    if last_day is not None:
+        query = query.filter(ItineraryItem.date <= last_day)
+    return query.order_by(ItineraryItem.date, ItineraryItem.time, ItineraryItem.id).all()
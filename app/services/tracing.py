@@ -0,0 +1,456 @@
+import functools
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from collections import deque
+from contextvars import ContextVar
+from flask import before_render_template, request, request_finished, request_started, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+# Request tracing. A sampled request gets a trace: one span for the request, and nested spans for model
+# methods marked @traced, every SQL statement, session commits and template renders. Finished traces are
+# kept in memory for /admin/traces and, when TRACE_FILE is set, appended one OTLP/JSON document per line to
+# it (the format of the OpenTelemetry Collector's file exporter, so a file can be replayed into any OTLP
+# backend or read back with `flask trace-report`); it is rotated at TRACE_FILE_MAX_BYTES. Requests are
+# recorded by route pattern only, so tokens in paths and query strings never reach a trace. Unsampled
+# requests cost one random() call and a few ContextVar reads.
+
+_trace = ContextVar("trace", default=None)
+
+SERVICE_NAME = "jetsetgo"
+SCOPE_NAME = "app.services.tracing"
+STATEMENT_LENGTH = 1000         # SQL text kept per span
+_SQL_TARGET = re.compile(r'^\s*(SELECT\b.*?\bFROM|INSERT\s+(?:OR\s+\w+\s+)?INTO|UPDATE|DELETE\s+FROM)\s+"?(\w+)',
+                         re.IGNORECASE | re.DOTALL)
+
+#==========================================================================================================
+# SPANS
+#==========================================================================================================
+
+class _Trace:
+    """Spans of one request, with the stack of spans currently open"""
+
+    def __init__(self, trace_id, parent_id, max_spans):
+        self.trace_id = trace_id
+        self.spans = []
+        self.stack = []
+        self.parent_id = parent_id      # the caller's span, from a traceparent header
+        self.max_spans = max_spans
+        self.dropped = 0
+
+    def start(self, name, attributes):
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return None
+        span = {
+            "name": name,
+            "span_id": os.urandom(8).hex(),
+            "parent_id": self.stack[-1]["span_id"] if self.stack else self.parent_id,
+            "start": time.time_ns(),
+            "end": None,
+            "attributes": attributes,
+            "error": None,
+        }
+        self.spans.append(span)
+        self.stack.append(span)
+        return span
+
+    def end(self, span, error=None):
+        """Close a span, and any child left open inside it (a render that raised, a commit that failed)"""
+        if span is None or not any(open_span is span for open_span in self.stack):
+            return
+        now = time.time_ns()
+        while self.stack:
+            top = self.stack.pop()
+            top["end"] = now
+            if top is span:
+                break
+        if error is not None:
+            span["error"] = f"{type(error).__name__}: {error}"
+
+    def end_named(self, name):
+        for span in reversed(self.stack):
+            if span["name"] == name:
+                self.end(span)
+                return
+
+
+class _NoSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    def __init__(self, trace, name, attributes):
+        self._trace, self._name, self._attributes = trace, name, attributes
+
+    def __enter__(self):
+        self._span = self._trace.start(self._name, self._attributes)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        self._trace.end(self._span, exc)
+        return False
+
+
+def span(name, **attributes):
+    """Context manager timing a block as a span of the current trace; does nothing outside a sampled request"""
+    trace = _trace.get()
+    return _NO_SPAN if trace is None else _Span(trace, name, attributes)
+
+
+def traced(func=None, name=None):
+    """Decorator: each call of the function becomes a span named after it (e.g. "Budget.update_totals")"""
+    if func is None:
+        return functools.partial(traced, name=name)
+    span_name = name or func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = _trace.get()
+        if trace is None:
+            return func(*args, **kwargs)
+        with _Span(trace, span_name, {"code.function": func.__qualname__}):
+            return func(*args, **kwargs)
+    return wrapper
+
+#==========================================================================================================
+# TRACER
+#==========================================================================================================
+
+class Tracer:
+    """Flask extension: samples requests and records, keeps and exports their traces"""
+
+    def __init__(self, app=None):
+        self.recent = deque(maxlen=100)
+        self._queue = None
+        self._writer = None
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        self._engine_events = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("TRACE_SAMPLE_RATE", 0.0)
+        app.config.setdefault("TRACE_FILE", None)
+        app.config.setdefault("TRACE_OTLP_ENDPOINT", None)
+        app.config.setdefault("TRACE_KEEP", 100)
+        app.config.setdefault("TRACE_MAX_SPANS", 2000)
+        app.config.setdefault("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024)
+        app.config.setdefault("TRACE_TRUST_TRACEPARENT", False)
+
+        self.sample_rate = app.config["TRACE_SAMPLE_RATE"]
+        self.file = app.config["TRACE_FILE"]
+        self.endpoint = app.config["TRACE_OTLP_ENDPOINT"]
+        self.max_spans = app.config["TRACE_MAX_SPANS"]
+        self.file_max_bytes = app.config["TRACE_FILE_MAX_BYTES"]
+        self.trust_traceparent = app.config["TRACE_TRUST_TRACEPARENT"]
+        self.recent = deque(maxlen=app.config["TRACE_KEEP"])
+
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+        app.teardown_request(self._teardown)
+        if not self._engine_events:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            event.listen(Engine, "handle_error", _handle_error)
+            event.listen(Session, "before_commit", _before_commit)
+            event.listen(Session, "after_commit", _after_commit)
+            event.listen(Session, "after_rollback", _after_commit)
+            self._engine_events = True
+        app.extensions["tracing"] = self
+
+    # --- Request lifecycle ---
+
+    def _request_started(self, sender, **extra):
+        trace_id, parent_id, sampled = _parse_traceparent(request.headers.get("traceparent"))
+        # A caller's sampled flag is only honoured from a trusted proxy or service, or any client could make
+        # every request it sends record (and write) a trace
+        sampled = sampled and self.trust_traceparent
+        if not sampled and not (self.sample_rate and random.random() < self.sample_rate):
+            _trace.set(None)
+            return
+        trace = _Trace(trace_id or os.urandom(16).hex(), parent_id, self.max_spans)
+        # Only the route pattern is kept, never the path or query string: they carry reset and calendar tokens
+        route = request.url_rule.rule if request.url_rule else None
+        trace.start(f"{request.method} {route or 'unmatched'}", {
+            "http.method": request.method,
+            "http.route": route,
+            "flask.endpoint": request.endpoint,
+        })
+        _trace.set(trace)
+
+    def _request_finished(self, sender, response, **extra):
+        trace = _trace.get()
+        if trace is not None and trace.spans:
+            trace.spans[0]["attributes"]["http.status_code"] = response.status_code
+
+    def _before_render(self, sender, template, context, **extra):
+        trace = _trace.get()
+        if trace is not None:
+            trace.start(f"render {template.name}", {"template": template.name})
+
+    def _rendered(self, sender, template, context, **extra):
+        trace = _trace.get()
+        if trace is not None:
+            trace.end_named(f"render {template.name}")
+
+    def _teardown(self, exc):
+        # After a streamed body has been sent, so streamed templates are inside the request span
+        trace = _trace.get()
+        if trace is None:
+            return
+        _trace.set(None)
+        trace.end(trace.spans[0], exc)
+        self._finish(trace)
+
+    # --- Export ---
+
+    def _finish(self, trace):
+        document = to_otlp(trace)
+        self.recent.append(document)
+        if self.file or self.endpoint:
+            self._get_queue().put(document)
+
+    def _get_queue(self):
+        with self._writer_lock:
+            # The writer thread does not survive fork(): each worker starts its own
+            if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+                self._queue = queue.Queue(maxsize=1000)
+                self._writer = threading.Thread(target=self._write_loop, args=(self._queue,), daemon=True,
+                                                name="trace-export")
+                self._writer_pid = os.getpid()
+                self._writer.start()
+        return self._queue
+
+    def _write_loop(self, documents):
+        while True:
+            document = documents.get()
+            line = json.dumps(document, separators=(",", ":"))
+            if self.file:
+                self._rotate()
+                # One write() per trace on an O_APPEND file: lines from several workers never interleave
+                with open(self.file, "a") as fh:
+                    fh.write(line + "\n")
+            if self.endpoint:
+                try:
+                    urllib.request.urlopen(urllib.request.Request(
+                        self.endpoint, data=line.encode(), headers={"Content-Type": "application/json"}), timeout=2)
+                except OSError:
+                    pass        # tracing must never take the app down with the collector
+
+    def _rotate(self):
+        # Keep one previous file (<file>.1). Two workers rotating at once lose at most a few traces.
+        try:
+            if os.path.getsize(self.file) >= self.file_max_bytes:
+                os.replace(self.file, self.file + ".1")
+        except OSError:
+            pass
+
+    def recent_traces(self, limit=None, tail_bytes=2 * 1024 * 1024):
+        """Traces (OTLP/JSON documents), newest last: from TRACE_FILE when set (every worker writes to it),
+        otherwise from this worker's memory"""
+        if not self.file or not os.path.exists(self.file):
+            documents = list(self.recent)
+        else:
+            documents = read_trace_file(self.file, tail_bytes)
+        return documents[-limit:] if limit else documents
+
+#==========================================================================================================
+# SQL AND SESSION HOOKS
+#==========================================================================================================
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _trace.get()
+    if trace is not None and context is not None:
+        context._trace_span = trace.start("sql", {"db.system": "sqlite",
+                                                  "db.statement": statement[:STATEMENT_LENGTH]})
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _trace.get()
+    if trace is not None:
+        trace.end(getattr(context, "_trace_span", None))
+
+
+def _handle_error(exception_context):
+    trace = _trace.get()
+    context = exception_context.execution_context
+    if trace is not None and context is not None:
+        trace.end(getattr(context, "_trace_span", None), exception_context.original_exception)
+
+
+def _before_commit(session):
+    trace = _trace.get()
+    if trace is not None:
+        trace.start("session.commit", {})
+
+
+def _after_commit(session):
+    trace = _trace.get()
+    if trace is not None:
+        trace.end_named("session.commit")
+
+#==========================================================================================================
+# OTLP/JSON
+#==========================================================================================================
+
+def _parse_traceparent(header):
+    """(trace id, parent span id, sampled) from a W3C traceparent header"""
+    parts = (header or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None, False
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None, None, False
+    return parts[1], parts[2], sampled
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def to_otlp(trace):
+    """An ExportTraceServiceRequest (OTLP/JSON encoding) holding one trace"""
+    spans = []
+    for index, span in enumerate(trace.spans):
+        attributes = [_attribute(key, value) for key, value in span["attributes"].items() if value is not None]
+        if index == 0 and trace.dropped:
+            attributes.append(_attribute("trace.dropped_spans", trace.dropped))
+        entry = {
+            "traceId": trace.trace_id,
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 2 if index == 0 else 1,         # SERVER for the request, INTERNAL for the rest
+            "startTimeUnixNano": str(span["start"]),
+            "endTimeUnixNano": str(span["end"] or span["start"]),
+            "attributes": attributes,
+            "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 0},
+        }
+        if span["parent_id"]:
+            entry["parentSpanId"] = span["parent_id"]
+        spans.append(entry)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attribute("service.name", SERVICE_NAME), _attribute("process.pid", os.getpid())]},
+        "scopeSpans": [{"scope": {"name": SCOPE_NAME}, "spans": spans}],
+    }]}
+
+
+def read_trace_file(path, tail_bytes=None):
+    """OTLP/JSON documents from a trace file, optionally only those in its last tail_bytes"""
+    with open(path, "rb") as fh:
+        if tail_bytes:
+            fh.seek(max(0, os.fstat(fh.fileno()).st_size - tail_bytes))
+            if fh.tell():
+                fh.readline()           # skip the partial first line
+        documents = []
+        for line in fh:
+            try:
+                documents.append(json.loads(line))
+            except ValueError:
+                continue                # a line still being written
+    return documents
+
+#==========================================================================================================
+# SUMMARIES
+#==========================================================================================================
+
+def spans_of(document):
+    """[{name, id, parent, start, end, attributes, error}, ...] from an OTLP/JSON document, times in ns"""
+    spans = []
+    for resource in document.get("resourceSpans", []):
+        for scope in resource.get("scopeSpans", []):
+            for span in scope.get("spans", []):
+                spans.append({
+                    "name": span["name"],
+                    "id": span["spanId"],
+                    "parent": span.get("parentSpanId"),
+                    "start": int(span["startTimeUnixNano"]),
+                    "end": int(span["endTimeUnixNano"]),
+                    "attributes": {a["key"]: next(iter(a["value"].values())) for a in span.get("attributes", [])},
+                    "error": span.get("status", {}).get("message"),
+                })
+    return spans
+
+
+def flame(document):
+    """Spans of one trace laid out for an icicle chart: (trace ms, [(span, depth, left %, width %, ms), ...])"""
+    spans = spans_of(document)
+    if not spans:
+        return 0.0, []
+    ids = {span["id"] for span in spans}
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent"] if span["parent"] in ids else None, []).append(span)
+    roots = children.get(None, [])
+    start = min(span["start"] for span in roots)
+    total = max(span["end"] for span in roots) - start or 1
+
+    rows = []
+
+    def walk(span, depth):
+        rows.append((span, depth, 100.0 * (span["start"] - start) / total,
+                     max(0.2, 100.0 * (span["end"] - span["start"]) / total), (span["end"] - span["start"]) / 1e6))
+        for child in sorted(children.get(span["id"], []), key=lambda s: s["start"]):
+            walk(child, depth + 1)
+
+    for root in sorted(roots, key=lambda s: s["start"]):
+        walk(root, 0)
+    return total / 1e6, rows
+
+
+def self_time_by_name(documents):
+    """[(span name, calls, total ms, self ms), ...] over many traces, most self time first.
+
+    Self time excludes time spent in child spans, so a slow page splits into "the template", "SQL issued
+    from the template" and "Budget.update_totals" instead of one number.
+    """
+    totals = {}
+    for document in documents:
+        spans = spans_of(document)
+        child_time = {}
+        for span in spans:
+            if span["parent"]:
+                child_time[span["parent"]] = child_time.get(span["parent"], 0) + span["end"] - span["start"]
+        for span in spans:
+            name = "sql " + _sql_kind(span) if span["name"] == "sql" else span["name"]
+            duration = span["end"] - span["start"]
+            entry = totals.setdefault(name, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] += max(0, duration - child_time.get(span["id"], 0))
+    rows = [(name, calls, total / 1e6, own / 1e6) for name, (calls, total, own) in totals.items()]
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+def _sql_kind(span):
+    # "SELECT expense" says more than "SELECT" when looking for lazy loads
+    statement = span["attributes"].get("db.statement", "")
+    match = _SQL_TARGET.match(statement)
+    if match:
+        return f"{match.group(1).split()[0].upper()} {match.group(2)}"
+    return statement.split(None, 1)[0].upper() if statement.strip() else ""
+
+
+tracer = Tracer()
@@ -0,0 +1,195 @@
+import atexit
+import math
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from app import db
+from app.services.destinations import destination_key
+
+# Windows and the half-life of their counters: an event counts 1 now, 1/2 one half-life later, and so on
+WINDOWS = {"day": 86400, "week": 7 * 86400, "month": 30 * 86400}
+DEFAULT_WINDOW = "week"
+
+# Scores are kept in log space relative to a fixed reference time: for one window, log_score holds
+# log(sum(exp(rate * t_i))) over all events t_i. Adding an event is one logaddexp (O(1), no decay pass over
+# old data), and since every destination shares the same reference, ordering by log_score orders by the
+# current decayed count, so the top N is a plain index scan. The count "now" is exp(log_score - rate * now).
+REFERENCE_TIME = datetime(2024, 1, 1)
+
+#==========================================================================================================
+
+def decay_rate(window):
+    return math.log(2) / WINDOWS[window]
+
+
+def log_weight(window, when):
+    """log of one event's weight at `when`, relative to REFERENCE_TIME"""
+    return decay_rate(window) * (when - REFERENCE_TIME).total_seconds()
+
+
+def logaddexp(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def current_score(window, log_score, now=None):
+    if log_score is None:
+        return 0.0
+    now = now or datetime.utcnow()
+    return math.exp(log_score - log_weight(window, now))
+
+
+# Every connection gets logaddexp(), so a checkpoint merges counters inside one UPSERT statement
+@event.listens_for(Engine, "connect")
+def _register_functions(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__.startswith("sqlite3"):
+        dbapi_connection.create_function("logaddexp", 2, logaddexp, deterministic=True)
+
+#==========================================================================================================
+# FLASK EXTENSION
+#==========================================================================================================
+
+class Trending:
+    """Exponentially decayed popularity counters for destinations.
+
+    Events are folded into in-memory log-space accumulators in O(1) and written to destination_trend
+    every TRENDING_CHECKPOINT_INTERVAL seconds. Each worker checkpoints its own increments; the upsert
+    merges them with logaddexp, so workers never overwrite each other.
+    """
+
+    def __init__(self, app=None):
+        self._pending = {}      # key -> [display name, {window: log_score}]
+        self._lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app.services.changes import change_feed
+
+        app.config.setdefault("TRENDING_CHECKPOINT_INTERVAL", 60)
+        self.interval = app.config["TRENDING_CHECKPOINT_INTERVAL"]
+
+        if self.app is None:
+            change_feed.subscribe(self._on_changes)     # new trip destinations count as events
+            atexit.register(self._final_checkpoint)
+        self.app = app
+        app.extensions["trending"] = self
+
+    def record(self, name, when=None):
+        """Count one event (a favorite or a trip destination) for a destination"""
+        key = destination_key(name)
+        if not key:
+            return
+        when = when or datetime.utcnow()
+        with self._lock:
+            entry = self._pending.setdefault(key, [name.strip(), {}])
+            for window in WINDOWS:
+                entry[1][window] = logaddexp(entry[1].get(window), log_weight(window, when))
+        if time.monotonic() - self._last_checkpoint >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Merge this process's pending increments into the database"""
+        from app.models import DestinationTrend
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_checkpoint = time.monotonic()
+        if not pending:
+            return 0
+
+        table = DestinationTrend.__table__
+        rows = [{"key": key, "name": name, "updated_at": datetime.utcnow(),
+                 **{f"score_{window}": scores[window] for window in WINDOWS}}
+                for key, (name, scores) in pending.items()]
+        statement = sqlite_insert(table)
+        merged = {f"score_{window}": db.func.logaddexp(table.c[f"score_{window}"],
+                                                       statement.excluded[f"score_{window}"])
+                  for window in WINDOWS}
+        statement = statement.on_conflict_do_update(
+            index_elements=["key"], set_={"updated_at": statement.excluded.updated_at, **merged})
+        # Own connection: a checkpoint must not ride along with (or commit) the caller's session
+        with db.engine.begin() as conn:
+            conn.execute(statement, rows)
+        return len(rows)
+
+    def top(self, window=DEFAULT_WINDOW, limit=10):
+        """[(name, current decayed count), ...], best first; reads limit rows from the score index"""
+        from app.models import DestinationTrend
+
+        column = DestinationTrend.__table__.c[f"score_{window}"]
+        rows = db.session.execute(
+            select(DestinationTrend.key, DestinationTrend.name, column)
+            .where(column.isnot(None)).order_by(column.desc()).limit(limit)
+        ).all()
+        scores = {key: [name, log_score] for key, name, log_score in rows}
+
+        # Fold in this process's increments that have not been checkpointed yet
+        with self._lock:
+            for key, (name, pending) in self._pending.items():
+                entry = scores.setdefault(key, [name, _stored_score(key, window)])
+                entry[1] = logaddexp(entry[1], pending.get(window))
+
+        now = datetime.utcnow()
+        ranked = sorted(scores.values(), key=lambda entry: entry[1], reverse=True)[:limit]
+        return [(name, current_score(window, log_score, now)) for name, log_score in ranked]
+
+    def rebuild(self):
+        """Recompute every counter from history (favorites' added_at, trip destinations' created_at)"""
+        from app.models import DestinationTrend, FavoriteDestination, TripDestination, user_favorite_destinations
+
+        with self._lock:
+            self._pending = {}
+        favorites = db.session.query(FavoriteDestination.name, user_favorite_destinations.c.added_at).join(
+            user_favorite_destinations, user_favorite_destinations.c.destination_id == FavoriteDestination.id)
+        trip_destinations = db.session.query(TripDestination.name, TripDestination.created_at)
+
+        totals = {}
+        for query in (favorites, trip_destinations):
+            for name, when in query.yield_per(1000):
+                key = destination_key(name)
+                if not key or when is None:
+                    continue
+                entry = totals.setdefault(key, [name.strip(), {}])
+                for window in WINDOWS:
+                    entry[1][window] = logaddexp(entry[1].get(window), log_weight(window, when))
+
+        rows = [{"key": key, "name": name, "updated_at": datetime.utcnow(),
+                 **{f"score_{window}": scores.get(window) for window in WINDOWS}}
+                for key, (name, scores) in totals.items()]
+        DestinationTrend.query.delete(synchronize_session=False)
+        if rows:
+            db.session.execute(DestinationTrend.__table__.insert(), rows)
+        db.session.commit()
+        return len(totals)
+
+    #------------------------------------------------------------------------------------------------------
+
+    def _on_changes(self, changes):
+        for change in changes:
+            if change.kind == "destination" and change.op == "insert":
+                self.record(change.data["name"])
+
+    def _final_checkpoint(self):
+        if self._pending and self.app is not None:
+            with self.app.app_context():
+                self.checkpoint()
+
+
+def _stored_score(key, window):
+    from app.models import DestinationTrend
+    return db.session.query(DestinationTrend.__table__.c[f"score_{window}"]).filter(
+        DestinationTrend.key == key).scalar()
+
+
+# Shared instance, initialised in create_app()
+trending = Trending()
@@ -0,0 +1,77 @@
+/* Live trip updates: listens to the trip's Server-Sent Events stream and patches the page in place,
+   so participants see each other's changes without reloading. */
+(function () {
+    const root = document.querySelector("[data-live-url]");
+    if (!root || !window.EventSource) return;
+
+    const source = new EventSource(root.dataset.liveUrl);
+    const notice = document.getElementById("live-notice");
+
+    function showNotice(text) {
+        if (!notice) return;
+        notice.textContent = text;
+        notice.hidden = false;
+    }
+
+    function setText(name, value) {
+        document.querySelectorAll(`[data-live="${name}"]`).forEach(el => { el.textContent = value; });
+    }
+
+    function parse(event) {
+        return JSON.parse(event.data);
+    }
+
+    // Budget totals change with every expense / planned budget edit
+    source.addEventListener("budget", event => {
+        const change = parse(event);
+        if (change.op === "delete") return;
+        const planned = change.data.total_planned || 0;
+        const spent = change.data.total_spent || 0;
+        setText("total_planned", planned);
+        setText("total_spent", spent);
+        setText("remaining", Math.round((planned - spent) * 100) / 100);
+    });
+
+    // Patch or remove list rows that are on the page; new rows are announced
+    function patchRow(selector, summary, change, label) {
+        const row = document.querySelector(selector);
+        if (change.op === "delete") {
+            if (row) row.remove();
+            showNotice(`A ${label} was removed.`);
+        } else if (row && change.op === "update") {
+            const target = row.querySelector(".live-summary");
+            if (target) target.innerHTML = summary;
+        } else if (change.op === "insert") {
+            showNotice(`New ${label} added — reload to see the full details.`);
+        }
+    }
+
+    const escape = text => String(text ?? "").replace(/[&<>"']/g, c => `&#${c.charCodeAt(0)};`);
+
+    source.addEventListener("expense", event => {
+        const change = parse(event);
+        patchRow(`[data-expense-id="${change.id}"]`,
+                 `<b>${escape(change.data.category)}</b> - ${escape(change.data.amount)}`, change, "expense");
+    });
+
+    source.addEventListener("planned_budget", event => {
+        const change = parse(event);
+        patchRow(`[data-planned-budget-id="${change.id}"]`,
+                 `<b>${escape(change.data.category)}</b> — $${escape(change.data.amount)}`, change, "planned budget");
+    });
+
+    source.addEventListener("itinerary", event => {
+        const change = parse(event);
+        const title = change.data.title ? `"${change.data.title}"` : "An item";
+        showNotice(change.op === "delete" ? "An itinerary item was removed." : `Itinerary updated: ${title} on ${change.data.date}.`);
+    });
+
+    source.addEventListener("destination", () => showNotice("The trip's destinations were changed."));
+    source.addEventListener("trip", () => showNotice("The trip details were changed — reload to see them."));
+
+    // Too many missed events: the server asks for a full reload
+    source.addEventListener("resync", () => {
+        source.close();
+        window.location.reload();
+    });
+})();
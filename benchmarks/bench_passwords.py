@@ -0,0 +1,65 @@
+"""Microbenchmark: logins per second per core, hashing on the request thread vs in the process pool.
+
+Run from the repository root:  python benchmarks/bench_passwords.py [--logins 64] [--threads 8]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from app.services import passwords
+
+
+def make_app(method, workers):
+    app = Flask(__name__)
+    app.config.update(
+        PASSWORD_HASH_METHOD=method,
+        PASSWORD_HASH_WORKERS=workers,
+        PASSWORD_HASH_QUEUE_FACTOR=4,
+        PASSWORD_HASH_TIMEOUT=60,
+    )
+    return app
+
+
+def run(method, workers, logins, threads):
+    app = make_app(method, workers)
+    with app.app_context():
+        stored = passwords.hash_password("correct horse battery staple")
+
+    def login(_):
+        with app.app_context():    # every request thread has its own app context
+            assert passwords.verify_password(stored, "correct horse battery staple")
+
+    with ThreadPoolExecutor(max_workers=threads) as request_threads:
+        list(request_threads.map(login, range(min(threads, logins))))     # warm up the pool
+        start = time.perf_counter()
+        list(request_threads.map(login, range(logins)))
+        elapsed = time.perf_counter() - start
+
+    passwords.shutdown()
+    cores = workers or 1      # inline hashing is limited to one core by the GIL
+    rate = logins / elapsed
+    return rate, rate / cores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=8, help="concurrent request threads")
+    parser.add_argument("--methods", nargs="+", default=["scrypt:32768:8:1", "pbkdf2:sha256:600000"])
+    args = parser.parse_args()
+
+    worker_counts = sorted({0, 1, min(4, os.cpu_count() or 1), os.cpu_count() or 1})
+    print(f"{'method':<24}{'workers':>8}{'logins/s':>12}{'per core':>12}")
+    for method in args.methods:
+        for workers in worker_counts:
+            rate, per_core = run(method, workers, args.logins, args.threads)
+            print(f"{method:<24}{workers:>8}{rate:>12.1f}{per_core:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Startup benchmark: import time, create_app(), schema preparation, first render, and fork-based respawn.
+
+Every measurement runs in a fresh interpreter against a throwaway copy of the database.
+Run from the repository root:  python benchmarks/bench_startup.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Executed in a child interpreter; prints one JSON object of timings in milliseconds
+PROBE = r"""
+import json, os, sys, time
+sys.path.insert(0, ROOT)
+timings = {}
+
+t0 = time.perf_counter()
+import app as package
+from app.schema import prepare_database
+timings["import"] = time.perf_counter() - t0
+
+t0 = time.perf_counter()
+application = package.create_app()
+timings["create_app"] = time.perf_counter() - t0
+
+with application.app_context():
+    t0 = time.perf_counter()
+    prepare_database()
+    timings["prepare_database"] = time.perf_counter() - t0
+
+t0 = time.perf_counter()
+application.test_client().get("/login")
+timings["first_request"] = time.perf_counter() - t0
+
+# Respawn cost under a pre-forking server: fork the loaded master and serve one request in the child
+with application.app_context():
+    package.db.engine.dispose()
+read_end, write_end = os.pipe()
+t0 = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    application.test_client().get("/login")
+    os.write(write_end, b"x")
+    os._exit(0)
+os.read(read_end, 1)
+timings["fork_and_serve"] = time.perf_counter() - t0
+os.waitpid(pid, 0)
+
+print(json.dumps({key: value * 1000 for key, value in timings.items()}))
+"""
+
+
+def probe(env):
+    output = subprocess.run(
+        [sys.executable, "-c", f"ROOT = {ROOT!r}\n" + PROBE],
+        env=env, capture_output=True, text=True, check=True, cwd=ROOT
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="jetsetgo-bench-")
+    try:
+        database = os.path.join(workdir, "todo.db")
+        source = os.path.join(ROOT, "instance", "todo.db")
+        if os.path.exists(source):
+            shutil.copy(source, database)
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{database}", PASSWORD_HASH_WORKERS="0")
+
+        cold = probe(env)       # first boot: schema upgrade and empty template cache
+        warm = [probe(env) for _ in range(args.runs)]
+
+        print(f"{'phase':<20}{'cold (ms)':>12}{'warm median (ms)':>20}")
+        for phase in cold:
+            print(f"{phase:<20}{cold[phase]:>12.1f}{statistics.median(run[phase] for run in warm):>20.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
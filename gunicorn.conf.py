@@ -0,0 +1,50 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Gunicorn settings for production:  gunicorn -c gunicorn.conf.py wsgi:app
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("WEB_THREADS", 4))
+worker_class = "gthread"
+
+# Import the app (Flask, SQLAlchemy, models, blueprints) once in the master. Workers are then plain forks,
+# so starting or respawning one takes milliseconds instead of re-importing everything.
+preload_app = True
+
+max_requests = 2000             # recycle workers now and then to cap slow memory growth
+max_requests_jitter = 200
+timeout = 30
+graceful_timeout = 30
+
+# Workers write metric snapshots here; /metrics merges them (see app/services/metrics.py)
+os.environ.setdefault("METRICS_MULTIPROCESS_DIR", os.path.join(tempfile.gettempdir(), "jetsetgo-metrics"))
+
+
+def on_starting(server):
+    # Snapshots of a previous run would be added to this run's counters
+    shutil.rmtree(os.environ["METRICS_MULTIPROCESS_DIR"], ignore_errors=True)
+
+
+def post_fork(server, worker):
+    # Connection pools are not fork-safe: each worker opens its own SQLite connections
+    from app import db
+    from wsgi import app
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    # Runs in the exiting worker: stop its process pools, so no orphaned children are left behind
+    from app.services import attachments, passwords
+    passwords.shutdown()
+    attachments.shutdown()
+
+
+def child_exit(server, worker):
+    # Keep an exited (or recycled) worker's counts, folded into one archive file instead of one file per pid
+    from app.services.metrics import metrics
+    if metrics.directory:
+        metrics.mark_process_dead(worker.pid)
@@ -1,11 +1,13 @@
-from app import create_app, db
+import os
+from app import create_app
+from app.schema import prepare_database
 
 app = create_app()      # Create an instance of the Flask application
 
 # The application context allows you to work with the app’s extensions (like SQLAlchemy)
 with app.app_context():
-    db.create_all()     # Creates all tables in the database if they don’t already exist
+    prepare_database()  # Creates/upgrades tables only when the models changed since the last start
 
 if __name__ == "__main__":
-    app.run(debug = True)       # Run the Flask development server with debug mode enabled
-                                # Debug mode automatically restarts the server on code changes
\ No newline at end of file
+    # Development server only; use wsgi.py with gunicorn in production
+    app.run(debug=os.environ.get("FLASK_DEBUG", "1") == "1")    # Debug mode automatically restarts the server on code changes
@@ -0,0 +1,10 @@
+from app import create_app, db
+from app.schema import prepare_database
+
+# Production entry point for a pre-forking WSGI server, e.g.  gunicorn -c gunicorn.conf.py wsgi:app
+# The app is built once in the master process and inherited by every worker through fork().
+app = create_app()
+
+with app.app_context():
+    prepare_database()      # one PRAGMA read when the schema is already current
+    db.engine.dispose()     # never hand the master's SQLite connections to forked workers